@@ -1,4 +1,6 @@
+import base64
 import os
+import struct
 from typing import Any, Dict, Optional
 
 from gql import Client, gql
@@ -11,6 +13,13 @@ from llama_index.core.workflow.events import Event
 DEFAULT_ENDPOINT = "http://localhost:8000/graphql"
 
 
+def encode_embedding(embedding: list[float]) -> str:
+    """
+    Packs an embedding as base64 of little-endian float32s, which is about a quarter the size of a JSON list.
+    """
+    return base64.b64encode(struct.pack(f"<{len(embedding)}f", *embedding)).decode()
+
+
 class AerisClient:
     """
     A client for interacting with the Aeris GraphQL API.
@@ -91,23 +100,30 @@ class AerisClient:
             raise RuntimeError(f"Error executing mutation: {str(e)}")
 
     async def fetch_similar_tasks(
-        self, task_input: Optional[str] = None, embedding: Optional[list[float]] = None
+        self,
+        task_input: Optional[str] = None,
+        embedding: Optional[list[float]] = None,
+        embedding_model: Optional[str] = None,
     ) -> list[str]:
         """
         Fetch similar tasks from Aeris.
 
         Args:
             task_input (Optional[str]): Text input to search for similar tasks.
-            embedding (Optional[List[float]]): Embedding to search for similar tasks.
+            embedding (Optional[List[float]]): Embedding to search for similar tasks, instead of embedding the input.
+            embedding_model (Optional[str]): The model that computed the embedding, which must be the server's.
+                Required with an embedding.
 
         Returns:
             List[Dict[str, Any]]: A list of similar tasks with similarity scores.
         """
         if not task_input and not embedding:
             raise ValueError("You must provide either 'task_input' or 'embedding'.")
+        if embedding and not embedding_model:
+            raise ValueError("You must provide 'embedding_model' with 'embedding'.")
 
-        query = """query FindSimilarTasks($input: String) {
-  findSimilarTasks(input: $input) {
+        query = """query FindSimilarTasks($input: String, $embeddingBase64: String, $embeddingModel: String) {
+  findSimilarTasks(input: $input, embeddingBase64: $embeddingBase64, embeddingModel: $embeddingModel) {
     similarity
     task {
       id
@@ -129,6 +145,9 @@ class AerisClient:
 }"""
 
         variables = {"input": task_input}
+        if embedding:
+            variables["embeddingBase64"] = encode_embedding(embedding)
+            variables["embeddingModel"] = embedding_model
         response = await self.execute_query(query, variables)
 
         similar_tasks = []
@@ -150,25 +169,48 @@ Human Feedback: {task['feedback']}
 
         return similar_tasks
 
-    async def register_task(self, name: str, task_input: str) -> str:
+    async def register_task(
+        self,
+        name: str,
+        task_input: str,
+        embedding: Optional[list[float]] = None,
+        embedding_model: Optional[str] = None,
+    ) -> str:
         """
         Register a task with Aeris.
 
         Args:
             name (str): The name of the task.
             task_input (str): The input for the task.
+            embedding (Optional[List[float]]): The input's embedding, if already computed. Otherwise Aeris embeds it.
+            embedding_model (Optional[str]): The model that computed the embedding, which must be the server's.
+                Required with an embedding.
 
         Returns:
             str: The ID of the created task.
         """
+        if embedding and not embedding_model:
+            raise ValueError("You must provide 'embedding_model' with 'embedding'.")
+
         mutation = """
-        mutation CreateTask($projectId: ID!, $name: String!, $input: String!) {
-            createTask(projectId: $projectId, name: $name, input: $input) {
+        mutation CreateTask(
+            $projectId: ID!, $name: String!, $input: String!, $embeddingBase64: String, $embeddingModel: String
+        ) {
+            createTask(
+                projectId: $projectId,
+                name: $name,
+                input: $input,
+                embeddingBase64: $embeddingBase64,
+                embeddingModel: $embeddingModel
+            ) {
                 id
             }
         }
         """
         variables = {"projectId": self.project_id, "name": name, "input": task_input}
+        if embedding:
+            variables["embeddingBase64"] = encode_embedding(embedding)
+            variables["embeddingModel"] = embedding_model
         response = await self.execute_mutation(mutation, variables)
         self.task_id = response["createTask"]["id"]
         if not self.task_id:
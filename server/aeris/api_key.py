@@ -1,74 +1,264 @@
+import asyncio
+import hashlib
+import logging
+import secrets
+from dataclasses import dataclass
 from datetime import datetime, timezone
 from typing import Optional
 
-from bcrypt import checkpw, gensalt, hashpw
-from pypika import Query, Table
+from asyncpg import Connection, Record
 
-from aeris.db import DB, init_db_pool
+from aeris.cache import TTLCache
+from aeris.db import DB, create_listener
+from aeris.env import get_setting
+from aeris.hashing import HashingBusyError, check_secret, hash_secret
+from aeris.statements import statement
 
+logger = logging.getLogger(__name__)
 
-def hash_api_key(api_key, salt: Optional[bytes] = None):
-    # Hash the API key
-    salt = salt or gensalt()
-    hashed = hashpw(api_key.encode(), salt)
-    return hashed.decode()
+# API keys are issued as "aeris_<key_id>_<secret>". The key id is public and indexed, so a key can be found with a
+# single lookup; only the secret part is hashed.
+API_KEY_PREFIX = "aeris"
 
+API_KEY_REVOKED_CHANNEL = "api_key_revoked"
 
-async def create_api_key(user_id, project_id):
-    import secrets
+API_KEY_BY_KEY_ID = statement(
+    "api_key_by_key_id",
+    """
+    SELECT id, user_id, project_id, key, expires_at FROM api_keys
+    WHERE key_id = $1 AND active AND (expires_at IS NULL OR expires_at > NOW())
+    """,
+)
+
+LEGACY_API_KEYS = statement(
+    "legacy_api_keys",
+    """
+    SELECT id, user_id, project_id, key, expires_at FROM api_keys
+    WHERE key_id IS NULL AND active AND (expires_at IS NULL OR expires_at > NOW())
+    """,
+)
+
+INSERT_API_KEY = statement(
+    "insert_api_key",
+    "INSERT INTO api_keys (user_id, project_id, key_id, key, expires_at) VALUES ($1, $2, $3, $4, $5)",
+)
+
+
+@dataclass(frozen=True)
+class VerifiedApiKey:
+    id: int
+    user_id: int
+    project_id: int
+    expires_at: datetime | None
+
+
+# Recently verified keys by fingerprint. Entries are evicted through API_KEY_REVOKED_CHANNEL when a key is changed or
+# deleted, and the cache is only consulted while that listener is connected.
+_verified_keys: TTLCache[str, VerifiedApiKey] = TTLCache(
+    max_size=int(get_setting("API_KEY_CACHE_SIZE", 10000)),
+    ttl=float(get_setting("API_KEY_CACHE_TTL", 300)),
+)
+_revocation_listener: Connection | None = None
+# Bumped on every revocation so a verification that raced with one doesn't cache what it read before it
+_revocation_generation = 0
+_revocation_listener_lock = asyncio.Lock()
+
+
+async def hash_api_key(api_key, salt: Optional[bytes] = None):
+    # Hash the API key on the hash pool so the event loop isn't blocked
+    return await hash_secret(api_key, salt)
+
+
+def format_api_key(key_id: str, secret: str) -> str:
+    return f"{API_KEY_PREFIX}_{key_id}_{secret}"
+
+
+def parse_api_key(api_key: str) -> tuple[str, str] | None:
+    """
+    Splits an API key into its (key_id, secret) parts.
+    Returns None for keys issued before key ids were introduced.
+    """
+    parts = api_key.split("_", 2)
+    if len(parts) != 3 or parts[0] != API_KEY_PREFIX or not parts[1] or not parts[2]:
+        return None
+
+    return parts[1], parts[2]
+
+
+def fingerprint_api_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def _on_api_key_revoked(connection, pid, channel, payload: str) -> None:
+    global _revocation_generation
+    _revocation_generation += 1
+    if payload == "*":
+        _verified_keys.clear()
+        return
+
+    key_id = int(payload)
+    _verified_keys.remove_matching(lambda verified: verified.id == key_id)
+
+
+def _on_revocation_listener_closed(connection) -> None:
+    global _revocation_listener, _revocation_generation
+    _revocation_generation += 1
+    logger.warning("API key revocation listener disconnected, clearing the verified key cache")
+    _revocation_listener = None
+    _verified_keys.clear()
+
+
+async def start_revocation_listener() -> bool:
+    """
+    Starts listening for API key revocations if this worker isn't already. Returns whether the listener is running.
+    """
+    global _revocation_listener
+    if _revocation_listener is not None:
+        return True
+
+    async with _revocation_listener_lock:
+        if _revocation_listener is None:
+            try:
+                _revocation_listener = await create_listener(
+                    API_KEY_REVOKED_CHANNEL, _on_api_key_revoked, _on_revocation_listener_closed
+                )
+            except Exception:
+                logger.exception("Could not start the API key revocation listener, verified keys won't be cached")
+                return False
+
+    return True
 
+
+async def stop_revocation_listener() -> None:
+    global _revocation_listener
+    if _revocation_listener is not None:
+        listener, _revocation_listener = _revocation_listener, None
+        await listener.close()
+    _verified_keys.clear()
+
+
+def api_key_cache_stats() -> dict[str, float]:
+    return {**_verified_keys.stats(), "listening": _revocation_listener is not None}
+
+
+async def create_api_key(user_id, project_id):
     # Generate a new API key
-    raw_key = secrets.token_urlsafe(32)
-    hashed_key = hash_api_key(raw_key)
+    key_id = secrets.token_hex(8)
+    secret = secrets.token_urlsafe(32)
+    hashed_key = await hash_api_key(secret)
 
     # Insert into the database
-    api_keys = Table("api_keys")
-    query = (
-        Query.into(api_keys)
-        .columns(api_keys.user_id, api_keys.project_id, api_keys.key)
-        .insert(user_id, project_id, hashed_key)
-    )
+    async with DB(transaction=True) as conn:
+        await INSERT_API_KEY.execute(conn, user_id, project_id, key_id, hashed_key, None)
 
-    async with DB() as conn:
-        conn.execute(query.get_sql())
+    return format_api_key(key_id, secret)  # Return raw key to the user (not the hash!)
 
-    return raw_key  # Return raw key to the user (not the hash!)
 
+async def verify_api_key(api_key: str) -> dict[str, int]:
+    fingerprint = fingerprint_api_key(api_key)
+    use_cache = await start_revocation_listener()
 
-async def verify_api_key(api_key: str) -> dict[str, str]:
-    await init_db_pool()
+    verified = _verified_keys.get(fingerprint) if use_cache else None
+    if verified is None:
+        generation = _revocation_generation
 
-    api_keys = Table("api_keys")
+        parsed = parse_api_key(api_key)
+        if parsed is None:
+            row = await verify_legacy_api_key(api_key)
+        else:
+            row = await verify_indexed_api_key(*parsed)
 
-    # Fetch the hashed key and associated fields
-    query = (
-        Query.from_(api_keys)
-        .select(api_keys.user_id, api_keys.project_id, api_keys.key, api_keys.expires_at, api_keys.active)
-        .where(api_keys.expires_at.isnull() | api_keys.expires_at >= datetime.now(timezone.utc))
-        .where(api_keys.active == True)  # noqa: E712
-    )
+        verified = VerifiedApiKey(row["id"], row["user_id"], row["project_id"], row["expires_at"])
+        if use_cache and generation == _revocation_generation:
+            _verified_keys.set(fingerprint, verified, ttl=_seconds_until(verified.expires_at))
 
+    elif verified.expires_at and verified.expires_at <= datetime.now(timezone.utc):
+        _verified_keys.pop(fingerprint)
+        raise ValueError("Invalid API key")
+
+    return {"user_id": verified.user_id, "project_id": verified.project_id}
+
+
+def _seconds_until(expires_at: datetime | None) -> float | None:
+    if expires_at is None:
+        return None
+    return (expires_at - datetime.now(timezone.utc)).total_seconds()
+
+
+async def verify_indexed_api_key(key_id: str, secret: str) -> Record:
     async with DB() as conn:
-        result = await conn.fetch(query.get_sql())
+        row = await API_KEY_BY_KEY_ID.fetchrow(conn, key_id)
 
-    # Loop through results and compare hashed keys (since keys are not unique)
-    for row in result:
-        user_id, project_id, hashed_key, expires_at, active = row
+    if not row or not await check_secret(secret, row["key"]):
+        raise ValueError("Invalid API key")
 
-        if not active:
-            continue
+    return row
 
-        try:
-            if checkpw(api_key.encode(), hashed_key.encode()):
-                # If match, validate other constraints
-                if expires_at and expires_at < datetime.now(timezone.utc):
-                    raise ValueError("API key has expired")
 
-                # Return relevant user/project data
-                return {"user_id": user_id, "project_id": project_id}
+async def verify_legacy_api_key(api_key: str) -> Record:
+    """
+    Verifies a key issued before key ids were introduced. These keys can only be found by comparing the hash of
+    every legacy key, so they should be replaced with `scripts/migrate_api_keys.py` and then disabled with
+    ALLOW_LEGACY_API_KEYS=false.
+    """
+    if get_setting("ALLOW_LEGACY_API_KEYS", "true").lower() != "true":
+        raise ValueError("Invalid API key")
+
+    async with DB() as conn:
+        result = await LEGACY_API_KEYS.fetch(conn)
+
+    # Loop through results and compare hashed keys (since legacy keys have no lookup id)
+    for row in result:
+        try:
+            if await check_secret(api_key, row["key"]):
+                logger.warning(f"API key {row['id']} uses the legacy format and should be reissued")
+                return row
+        except HashingBusyError:
+            raise
         except ValueError:
-            # Invalid key or hash
+            # Invalid hash
             pass
 
     # If no match found
     raise ValueError("Invalid API key")
+
+
+async def reissue_legacy_api_keys(deactivate: bool = False) -> list[dict]:
+    """
+    Issues a new-format key for every active legacy key, keeping the same user, project and expiry.
+    When `deactivate` is set the legacy keys are disabled in the same transaction.
+    """
+    reissued = []
+
+    async with DB(transaction=True) as conn:
+        legacy_keys = await conn.fetch(
+            "SELECT id, user_id, project_id, expires_at FROM api_keys WHERE key_id IS NULL AND active"
+        )
+
+        for legacy_key in legacy_keys:
+            key_id = secrets.token_hex(8)
+            secret = secrets.token_urlsafe(32)
+            await INSERT_API_KEY.execute(
+                conn,
+                legacy_key["user_id"],
+                legacy_key["project_id"],
+                key_id,
+                await hash_api_key(secret),
+                legacy_key["expires_at"],
+            )
+            reissued.append(
+                {
+                    "legacy_id": legacy_key["id"],
+                    "user_id": legacy_key["user_id"],
+                    "project_id": legacy_key["project_id"],
+                    "api_key": format_api_key(key_id, secret),
+                }
+            )
+
+        if deactivate and legacy_keys:
+            await conn.execute(
+                "UPDATE api_keys SET active = FALSE WHERE id = ANY($1::int[])",
+                [legacy_key["id"] for legacy_key in legacy_keys],
+            )
+
+    return reissued
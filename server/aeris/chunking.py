@@ -0,0 +1,63 @@
+import re
+from collections import deque
+from typing import Iterator
+
+# Words and punctuation marks, which approximate model tokens closely enough to bound a chunk's length. Subword
+# tokenizers split long and rare words further, so chunk sizes should leave the model some headroom, and text without
+# spaces, like Chinese or Japanese, takes about a model token per character, which a character budget bounds. A word
+# longer than MAX_TOKEN_CHARS, e.g. a hash or base64 data, counts as a token per MAX_TOKEN_CHARS characters.
+MAX_TOKEN_CHARS = 16
+TOKEN = re.compile(rf"\w{{1,{MAX_TOKEN_CHARS}}}|[^\w\s]")
+
+
+def chunk_text(text: str, max_tokens: int, overlap: int = 0, max_chars: int | None = None) -> Iterator[str]:
+    """
+    Splits text into chunks of up to `max_tokens` tokens, and `max_chars` characters unless a single token is longer,
+    each starting up to `overlap` tokens before the previous one ended so a passage cut in two is still whole in one of
+    them. Chunks keep the text's own whitespace between tokens, and text without tokens has no chunks.
+
+    Chunks are sliced from the text as they're reached, so the text is never copied whole, and a caller that only
+    needs the first few chunks never scans the rest.
+    """
+    if not 0 <= overlap < max_tokens:
+        raise ValueError("overlap must be at least 0 and less than max_tokens")
+
+    # The (start, end) offsets of the current chunk's tokens
+    window: deque[tuple[int, int]] = deque()
+    # Tokens not in any chunk yet
+    new = 0
+    for match in TOKEN.finditer(text):
+        start, end = match.span()
+        if max_chars is not None and window and end - window[0][0] > max_chars:
+            if new:
+                yield text[window[0][0] : window[-1][1]]
+                new = 0
+            # The overlap's share of the characters too, so every chunk is mostly new text
+            while window and (
+                len(window) > overlap
+                or window[-1][1] - window[0][0] > max_chars * overlap // max_tokens
+                or end - window[0][0] > max_chars
+            ):
+                window.popleft()
+
+        window.append((start, end))
+        new += 1
+        if len(window) == max_tokens:
+            yield text[window[0][0] : window[-1][1]]
+            for _ in range(max_tokens - overlap):
+                window.popleft()
+            new = 0
+
+    if new:
+        yield text[window[0][0] : window[-1][1]]
+
+
+def halve(chunk: str) -> tuple[str, str] | None:
+    """
+    Splits a chunk in two at the token nearest its middle, or returns None if it's a single token.
+    """
+    starts = [match.start() for match in TOKEN.finditer(chunk)]
+    if len(starts) < 2:
+        return None
+    middle = min(starts[1:], key=lambda start: abs(2 * start - len(chunk)))
+    return chunk[:middle].rstrip(), chunk[middle:]
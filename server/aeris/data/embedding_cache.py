@@ -0,0 +1,37 @@
+import numpy as np
+
+from aeris.db import DB
+from aeris.statements import statement
+
+CACHED_EMBEDDINGS = statement(
+    "cached_embeddings",
+    "SELECT key, embedding FROM embedding_cache WHERE key = ANY($1::bytea[])",
+)
+
+# Run with executemany(), which pipelines the rows in one round trip
+INSERT_CACHED_EMBEDDINGS = statement(
+    "insert_cached_embeddings",
+    """
+    INSERT INTO embedding_cache (key, model, embedding) VALUES ($1, $2, $3)
+    ON CONFLICT (key) DO NOTHING
+    """,
+)
+
+
+def as_array(embedding) -> np.ndarray:
+    # pgvector's asyncpg codec decodes to numpy arrays before 0.4, and to pgvector.Vector since
+    return embedding.to_numpy() if hasattr(embedding, "to_numpy") else embedding
+
+
+# The cache is read and written on detached connections, so an operation doesn't hold its unit of work's connection
+# while the provider embeds what the cache didn't have
+async def get_cached_embeddings(keys: list[bytes]) -> dict[bytes, np.ndarray]:
+    async with DB(detached=True) as conn:
+        return {row["key"]: as_array(row["embedding"]) for row in await CACHED_EMBEDDINGS.fetch(conn, keys)}
+
+
+async def cache_embeddings(model: str, embeddings: dict[bytes, np.ndarray]) -> None:
+    async with DB(transaction=True, detached=True) as conn:
+        await INSERT_CACHED_EMBEDDINGS.executemany(
+            conn, [(key, model, embedding) for key, embedding in embeddings.items()]
+        )
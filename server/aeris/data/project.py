@@ -1,82 +1,134 @@
+from functools import cache
 from uuid import UUID
 
 from asyncpg import Record
 
+from aeris.data.task import LARGE_TASK_COLUMNS, task_columns
 from aeris.db import DB
-
-
-async def get_project_by_uuid(uuid: UUID, user_id: int) -> Record:
+from aeris.filters import Filter, contains_pattern, filter_conditions, parse_timestamp, select_filters
+from aeris.pagination import Page
+from aeris.statements import Statement, statement
+
+PROJECT_BY_UUID = statement(
+    "project_by_uuid",
+    "SELECT * FROM projects WHERE uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = projects.id)",
+)
+
+PROJECTS_FOR_USER = statement(
+    "projects_for_user",
+    "SELECT * FROM projects WHERE exists(SELECT 1 FROM user_projects WHERE user_id = $1 AND project_id = projects.id)",
+)
+
+TASKS_FOR_PROJECT = """
+    SELECT {columns} FROM tasks
+    INNER JOIN projects ON projects.id = tasks.project_id
+    WHERE projects.uuid = $1
+      AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = projects.id)
+      AND (tasks.created_at, tasks.id) > ($3, $4)
+      AND (tasks.created_at, tasks.id) < ($5, $6){filters}
+    ORDER BY tasks.created_at {direction}, tasks.id {direction}
+    LIMIT $7
+"""
+
+TASK_FILTERS = {
+    "state": Filter("tasks.state = ${}"),
+    "createdAfter": Filter("tasks.created_at > ${}", parse_timestamp),
+    "createdBefore": Filter("tasks.created_at < ${}", parse_timestamp),
+    "nameContains": Filter("tasks.name ILIKE ${}", contains_pattern),
+}
+
+
+@cache
+def _tasks_for_project(backward: bool, filters: tuple[str, ...], large: tuple[str, ...]) -> Statement:
+    """
+    One statement per direction, combination of filters and selected large columns, so each is planned as a range
+    scan over the matching index instead of a generic plan full of optional conditions.
+    """
+    direction = "DESC" if backward else "ASC"
+    name = "_".join(["tasks_for_project", "backward" if backward else "forward", *filters, *large]).lower()
+    sql = TASKS_FOR_PROJECT.format(
+        columns=task_columns(large),
+        direction=direction,
+        filters=filter_conditions(TASK_FILTERS, filters, 8),
+    )
+    return statement(name, sql)
+
+
+# Registered up front so every new connection prepares them
+_tasks_for_project(False, (), LARGE_TASK_COLUMNS)
+_tasks_for_project(True, (), LARGE_TASK_COLUMNS)
+
+INSERT_PROJECT = statement(
+    "insert_project",
+    """
+    WITH project AS (
+        INSERT INTO projects (name, description) VALUES ($1, $2) RETURNING *
+    ), membership AS (
+        INSERT INTO user_projects (user_id, project_id) SELECT $3, id FROM project
+    )
+    SELECT * FROM project
+    """,
+)
+
+UPDATE_PROJECT = statement(
+    "update_project",
+    """
+    UPDATE projects SET name = COALESCE($3, name), description = COALESCE($4, description)
+    WHERE uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = projects.id)
+    RETURNING *
+    """,
+)
+
+DELETE_PROJECT = statement(
+    "delete_project",
+    """
+    DELETE FROM projects
+    WHERE uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = projects.id)
+    RETURNING *
+    """,
+)
+
+
+async def get_project_by_uuid(uuid: UUID, user_id: int) -> Record | None:
     async with DB() as conn:
-        return await conn.fetchrow(
-            "SELECT * FROM projects WHERE uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = projects.id)",
-            uuid,
-            user_id,
-        )
+        return await PROJECT_BY_UUID.fetchrow(conn, uuid, user_id)
 
 
 async def get_projects(user_id: int, pagination: None = None) -> list[Record]:
     async with DB() as conn:
-        return await conn.fetch(
-            "SELECT * FROM projects WHERE exists(SELECT 1 FROM user_projects WHERE user_id = $1 AND project_id = projects.id)",
-            user_id,
-        )
+        return await PROJECTS_FOR_USER.fetch(conn, user_id)
 
 
 async def get_tasks_for_project(
-    project_uuid: UUID, user_id: int, pagination: None = None, filters: None = None
+    project_uuid: UUID,
+    user_id: int,
+    page: Page | None = None,
+    filters: dict | None = None,
+    large: tuple[str, ...] = LARGE_TASK_COLUMNS,
 ) -> list[Record]:
-    project = await get_project_by_uuid(project_uuid, user_id)
-
-    if not project:
-        return []
-
-    async with DB() as conn:
-        return await conn.fetch(
-            "SELECT * FROM tasks WHERE project_id = $1",
-            project["id"],
-        )
-
-
-async def create_project(user_id: int, name: str, description: str | None = None) -> Record:
+    """
+    Returns up to `page.limit + 1` tasks matching the TaskFilters in the page's direction, for
+    aeris.pagination.paginate(). Of the large columns, only those in `large` are read.
+    """
+    page = page or Page()
+    names, args = select_filters(TASK_FILTERS, filters)
+    tasks_for_project = _tasks_for_project(page.backward, names, large)
     async with DB() as conn:
-        project = await conn.fetchrow(
-            "INSERT INTO projects (name, description) VALUES ($1, $2) RETURNING *",
-            name,
-            description,
-        )
+        return await tasks_for_project.fetch(conn, project_uuid, user_id, *page.bounds(), page.limit + 1, *args)
 
-        await conn.execute(
-            "INSERT INTO user_projects (user_id, project_id) VALUES ($1, $2)",
-            user_id,
-            project["id"],
-        )
 
-        return project
+async def create_project(user_id: int, name: str, description: str | None = None) -> Record | None:
+    async with DB(transaction=True) as conn:
+        return await INSERT_PROJECT.fetchrow(conn, name, description, user_id)
 
 
 async def update_project(
     uuid: UUID, user_id: int, name: str | None = None, description: str | None = None
 ) -> Record | None:
-    async with DB() as conn:
-        project = await get_project_by_uuid(uuid, user_id)
-        if not project:
-            return None
-
-        return await conn.fetchrow(
-            "UPDATE projects SET name = COALESCE($2, name), description = COALESCE($3, description) WHERE uuid = $1 RETURNING *",
-            uuid,
-            name,
-            description,
-        )
+    async with DB(transaction=True) as conn:
+        return await UPDATE_PROJECT.fetchrow(conn, uuid, user_id, name, description)
 
 
 async def delete_project(uuid: UUID, user_id: int) -> Record | None:
-    async with DB() as conn:
-        project = await get_project_by_uuid(uuid, user_id)
-        if not project:
-            return None
-
-        return await conn.fetchrow(
-            "DELETE FROM projects WHERE uuid = $1 RETURNING *",
-            uuid,
-        )
+    async with DB(transaction=True) as conn:
+        return await DELETE_PROJECT.fetchrow(conn, uuid, user_id)
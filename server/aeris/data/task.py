@@ -1,35 +1,413 @@
-import json
+from collections import defaultdict
+from datetime import datetime
+from functools import cache
 from uuid import UUID
 
+import numpy as np
 from asyncpg import Record
 
-from aeris.data.project import get_project_by_uuid
-from aeris.db import DB
+from aeris.db import DB, TEXT_SEARCH_CONFIG
+from aeris.env import get_setting
+from aeris.filters import Filter, filter_conditions, parse_timestamp, select_filters
+from aeris.pagination import Page
+from aeris.statements import Statement, statement
+from aeris.vector_index import (
+    EMBEDDING_DIMENSIONS,
+    HNSW_DEFAULT_EF_SEARCH,
+    MAX_SEARCH_EFFORT,
+    VECTOR_INDEX_TYPE,
+    candidate_count,
+    distance,
+    search_order,
+    set_search_effort,
+)
 
+DEFAULT_SIMILAR_TASKS = 5
+MAX_SIMILAR_TASKS = 100
+DEFAULT_MAX_DISTANCE = 0.5
+# Searches findSimilarTasksBatch runs at once
+MAX_SIMILAR_TASK_QUERIES = 100
+# How many nearest embeddings to fetch from the index per requested task. Candidates in other projects, unfinished
+# tasks and duplicate embeddings of one task are dropped afterwards, so this needs headroom. An HNSW index returns at
+# most hnsw.ef_search rows (40 by default) whatever the limit, see vector_index.set_search_effort().
+SIMILAR_TASKS_OVERFETCH = int(get_setting("SIMILAR_TASKS_OVERFETCH", 10))
+# Dampens how much a top rank in one ranking outweighs ranking well in both, for hybrid search. 60 is the usual value.
+HYBRID_RRF_K = int(get_setting("HYBRID_RRF_K", 60))
+# A task's input is embedded in chunks, see aeris.embedding_worker. With MAX aggregation a task ranks by its nearest
+# chunk; with SUM by the sum of its nearest chunks' similarities (1 - distance), up to this many of them.
+CHUNK_AGGREGATION_TOP_K = int(get_setting("CHUNK_AGGREGATION_TOP_K", 3))
+AGGREGATIONS = ("MAX", "SUM")
 
-async def get_task_by_uuid(uuid: UUID, user_id: int) -> Record:
-    async with DB() as conn:
-        return await conn.fetchrow(
-            "SELECT * FROM tasks WHERE uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)",
-            uuid,
-            user_id,
+TASK_COLUMNS = ("id", "uuid", "project_id", "name", "success", "state", "embedding_status", "created_at")
+# Only read when the query selects them, see aeris.selection.selected_columns()
+LARGE_TASK_COLUMNS = ("input", "feedback")
+
+
+def task_columns(large: tuple[str, ...] = LARGE_TASK_COLUMNS) -> str:
+    return ", ".join(f"tasks.{column}" for column in TASK_COLUMNS + large)
+
+
+@cache
+def _task_by_uuid(large: tuple[str, ...]) -> Statement:
+    return statement(
+        "_".join(["task_by_uuid", *large]),
+        f"""
+        SELECT {task_columns(large)} FROM tasks
+        WHERE uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)
+        """,
+    )
+
+
+_task_by_uuid(LARGE_TASK_COLUMNS)
+
+INSERT_TASK = statement(
+    "insert_task",
+    f"""
+    INSERT INTO tasks (project_id, name, input, embedding_status)
+    SELECT projects.id, $3, $4, $5 FROM projects
+    WHERE projects.uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = projects.id)
+    RETURNING {task_columns()}
+    """,
+)
+
+# Fixed shape so there is one prepared statement for every combination of fields. NULL leaves a field unchanged.
+UPDATE_TASK = statement(
+    "update_task",
+    f"""
+    UPDATE tasks SET
+        name = COALESCE($3, name),
+        input = COALESCE($4, input),
+        state = COALESCE($5, state),
+        success = COALESCE($6, success),
+        feedback = COALESCE($7, feedback)
+    WHERE uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)
+    RETURNING {task_columns()}
+    """,
+)
+
+DELETE_TASK = statement(
+    "delete_task",
+    f"""
+    DELETE FROM tasks
+    WHERE uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)
+    RETURNING {task_columns()}
+    """,
+)
+
+# Run with executemany(), which pipelines the rows in one round trip
+INSERT_TASK_EMBEDDING = statement(
+    "insert_task_embedding",
+    "INSERT INTO task_embeddings (task_id, embedding) VALUES ($1, $2)",
+)
+
+# Leases the oldest tasks waiting for an embedding, and those whose lease is older than $2 seconds because the worker
+# holding it died. The lease is the claim's timestamp, shared by the claimed rows. SKIP LOCKED lets concurrent workers
+# claim different tasks, and the row locks only last as long as this statement.
+CLAIM_PENDING_EMBEDDINGS = statement(
+    "claim_pending_embeddings",
+    """
+    UPDATE tasks SET embedding_claimed_at = now()
+    WHERE id IN (
+        SELECT id FROM tasks
+        WHERE embedding_status = 'PENDING'
+          AND (embedding_claimed_at IS NULL OR embedding_claimed_at < now() - make_interval(secs => $2))
+        ORDER BY id
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, input, embedding_claimed_at
+    """,
+)
+
+# Ends the lease ($2) on tasks still holding it, setting their embedding status. Returns the tasks it applied to, which
+# excludes tasks deleted or re-claimed since.
+FINISH_EMBEDDING_CLAIM = statement(
+    "finish_embedding_claim",
+    """
+    UPDATE tasks SET embedding_status = $3, embedding_claimed_at = NULL
+    WHERE id = ANY($1::int[]) AND embedding_status = 'PENDING' AND embedding_claimed_at = $2
+    RETURNING id
+    """,
+)
+
+# Inserts the event only if the task is visible to the user, so logging an event is a single round trip
+INSERT_EVENT = statement(
+    "insert_event",
+    """
+    INSERT INTO events (task_id, event_type, event_data)
+    SELECT tasks.id, $3, $4 FROM tasks
+    WHERE tasks.uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)
+    RETURNING id, task_id, event_type, event_data, created_at
+    """,
+)
+
+# The batch statements check visibility per task, so tasks the user can't see are simply absent from the results
+@cache
+def _embeddings_for_tasks(vectors: bool) -> Statement:
+    columns = "task_embeddings.id, task_embeddings.uuid, task_embeddings.task_id"
+    if vectors:
+        columns += ", task_embeddings.embedding"
+    return statement(
+        "embeddings_for_tasks" if vectors else "embeddings_for_tasks_without_vectors",
+        f"""
+        SELECT tasks.uuid AS task_uuid, {columns} FROM task_embeddings
+        INNER JOIN tasks ON tasks.id = task_embeddings.task_id
+        WHERE tasks.uuid = ANY($1::uuid[])
+          AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)
+        ORDER BY task_embeddings.id
+        """,
+    )
+
+
+_embeddings_for_tasks(True)
+
+METADATA_FOR_TASKS = statement(
+    "metadata_for_tasks",
+    """
+    SELECT tasks.uuid AS task_uuid, task_metadata.* FROM task_metadata
+    INNER JOIN tasks ON tasks.id = task_metadata.task_id
+    WHERE tasks.uuid = ANY($1::uuid[])
+      AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)
+    ORDER BY task_metadata.id
+    """,
+)
+
+# Pages each task's events separately, so every task gets up to $7 events
+EVENTS_FOR_TASKS = """
+    SELECT tasks.uuid AS task_uuid, events.* FROM tasks
+    CROSS JOIN LATERAL (
+        SELECT * FROM events
+        WHERE events.task_id = tasks.id
+          AND (events.created_at, events.id) > ($3, $4)
+          AND (events.created_at, events.id) < ($5, $6){filters}
+        ORDER BY events.created_at {direction}, events.id {direction}
+        LIMIT $7
+    ) events
+    WHERE tasks.uuid = ANY($1::uuid[])
+      AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)
+    ORDER BY tasks.id, events.created_at {direction}, events.id {direction}
+"""
+
+EVENT_FILTERS = {
+    "eventType": Filter("events.event_type = ${}"),
+    "createdAfter": Filter("events.created_at > ${}", parse_timestamp),
+    "createdBefore": Filter("events.created_at < ${}", parse_timestamp),
+}
+
+
+@cache
+def _events_for_tasks(backward: bool, filters: tuple[str, ...]) -> Statement:
+    """
+    One statement per direction and combination of filters, like data.project._tasks_for_project().
+    """
+    direction = "DESC" if backward else "ASC"
+    name = "_".join(["events_for_tasks", "backward" if backward else "forward", *filters]).lower()
+    sql = EVENTS_FOR_TASKS.format(direction=direction, filters=filter_conditions(EVENT_FILTERS, filters, 8))
+    return statement(name, sql)
+
+
+# Registered up front so every new connection prepares them
+_events_for_tasks(False, ())
+_events_for_tasks(True, ())
+
+
+# Finished tasks the user ($2) can see, optionally only in one project ($5)
+SEARCHABLE_TASK = """
+    tasks.state IN ('SUCCESS', 'FAILURE')
+    AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)
+    AND ($5::uuid IS NULL OR tasks.project_id = (SELECT id FROM projects WHERE uuid = $5))
+"""
+
+
+def _nearest_embeddings(embedding: str, aggregation: str = "MAX") -> str:
+    """
+    The innermost query is a plain ORDER BY distance LIMIT, the only shape the vector index can serve. Its candidates
+    are aggregated per task with their full-precision distance, which re-ranks the candidates of a quantized index:
+    the nearest chunk's distance, and with SUM aggregation the chunk_score of the task's nearest chunks within $3.
+    """
+    candidates = f"""
+        SELECT task_id, {distance(embedding)} AS distance
+        FROM task_embeddings
+        ORDER BY {search_order(embedding)}
+        LIMIT $4
+    """
+    if aggregation == "SUM":
+        return f"""
+            SELECT ranked.task_id, min(ranked.distance) AS distance, sum(1 - ranked.distance) AS chunk_score
+            FROM (
+                SELECT candidates.task_id, candidates.distance,
+                    row_number() OVER (PARTITION BY candidates.task_id ORDER BY candidates.distance) AS chunk_rank
+                FROM ({candidates}) candidates
+                WHERE candidates.distance < $3
+            ) ranked
+            WHERE ranked.chunk_rank <= {CHUNK_AGGREGATION_TOP_K}
+            GROUP BY ranked.task_id
+        """
+    return f"""
+        SELECT DISTINCT ON (candidates.task_id) candidates.task_id, candidates.distance
+        FROM ({candidates}) candidates
+        ORDER BY candidates.task_id, candidates.distance
+    """
+
+
+def _nearest_tasks(embedding: str, large: tuple[str, ...], aggregation: str = "MAX") -> str:
+    chunk_score = ", nearest.chunk_score" if aggregation == "SUM" else ""
+    order = "nearest.chunk_score DESC, nearest.distance" if aggregation == "SUM" else "nearest.distance"
+    return f"""
+        SELECT {task_columns(large)}, nearest.distance AS similarity_score{chunk_score}
+        FROM ({_nearest_embeddings(embedding, aggregation)}) nearest
+        INNER JOIN tasks ON tasks.id = nearest.task_id
+        WHERE nearest.distance < $3 AND {SEARCHABLE_TASK}
+        ORDER BY {order}
+        LIMIT $6
+    """
+
+
+def _statement_name(name: str, large: tuple[str, ...], aggregation: str) -> str:
+    # The default aggregation keeps the names statements had before there was a choice
+    return "_".join([name, *large] + (["sum"] if aggregation == "SUM" else []))
+
+
+@cache
+def _similar_tasks(large: tuple[str, ...], aggregation: str) -> Statement:
+    return statement(_statement_name("similar_tasks", large, aggregation), _nearest_tasks("$1", large, aggregation))
+
+
+_similar_tasks(LARGE_TASK_COLUMNS, "MAX")
+
+
+@cache
+def _hybrid_similar_tasks(large: tuple[str, ...]) -> Statement:
+    """
+    Fuses the vector search with a full-text search for $7 by reciprocal rank fusion: each ranks up to $4 tasks, and
+    a task scores 1 / (HYBRID_RRF_K + rank) for each ranking it's in. Full-text matches only count for embedded
+    tasks, so every result still has its nearest embedding's distance.
+    """
+    return statement(
+        "_".join(["hybrid_similar_tasks", *large]),
+        f"""
+        WITH semantic AS (
+            SELECT nearest.task_id, nearest.distance, row_number() OVER (ORDER BY nearest.distance) AS rank
+            FROM ({_nearest_embeddings("$1")}) nearest
+            INNER JOIN tasks ON tasks.id = nearest.task_id
+            WHERE nearest.distance < $3 AND {SEARCHABLE_TASK}
+        ),
+        lexical AS (
+            SELECT tasks.id AS task_id, row_number() OVER (ORDER BY ts_rank_cd(tasks.search_vector, query) DESC) AS rank
+            FROM tasks, websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', $7) query
+            WHERE tasks.search_vector @@ query AND tasks.embedding_status = 'READY' AND {SEARCHABLE_TASK}
+            ORDER BY rank
+            LIMIT $4
+        ),
+        fused AS (
+            SELECT coalesce(semantic.task_id, lexical.task_id) AS task_id, semantic.distance,
+                coalesce(1 / ({HYBRID_RRF_K} + semantic.rank)::float8, 0)
+                    + coalesce(1 / ({HYBRID_RRF_K} + lexical.rank)::float8, 0) AS score
+            FROM semantic FULL OUTER JOIN lexical ON lexical.task_id = semantic.task_id
         )
+        SELECT {task_columns(large)}, fused.score AS fusion_score, coalesce(
+            fused.distance, (SELECT min({distance("$1")}) FROM task_embeddings WHERE task_id = tasks.id)
+        ) AS similarity_score
+        FROM fused
+        INNER JOIN tasks ON tasks.id = fused.task_id
+        ORDER BY fused.score DESC, similarity_score
+        LIMIT $6
+        """,
+    )
+
+
+_hybrid_similar_tasks(LARGE_TASK_COLUMNS)
+
+
+@cache
+def _similar_tasks_batch(large: tuple[str, ...], aggregation: str) -> Statement:
+    """
+    Searches for every embedding in $1, concatenated into one real[], which unlike vector[] encodes the same with
+    every pgvector version. Each search is a LATERAL subquery, so each still uses the vector index.
+    """
+    return statement(
+        _statement_name("similar_tasks_batch", large, aggregation),
+        f"""
+        SELECT queries.query, results.*
+        FROM (
+            SELECT query, ($1::real[])[(query - 1) * {EMBEDDING_DIMENSIONS} + 1 : query * {EMBEDDING_DIMENSIONS}]::vector
+                AS embedding
+            FROM generate_series(1, cardinality($1::real[]) / {EMBEDDING_DIMENSIONS}) AS query
+        ) queries
+        CROSS JOIN LATERAL ({_nearest_tasks("queries.embedding", large, aggregation)}) results
+        ORDER BY queries.query, {"results.chunk_score DESC, " if aggregation == "SUM" else ""}results.similarity_score
+        """,
+    )
+
+
+_similar_tasks_batch(LARGE_TASK_COLUMNS, "MAX")
+
+# The embeddings of a project's finished tasks, the ones findSimilarTasks can return, for aeris.project_index
+PROJECT_ID = statement(
+    "project_id",
+    """
+    SELECT id FROM projects
+    WHERE uuid = $1 AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = projects.id)
+    """,
+)
+
+PROJECT_EMBEDDINGS = statement(
+    "project_embeddings",
+    """
+    SELECT task_embeddings.task_id, task_embeddings.embedding FROM task_embeddings
+    INNER JOIN tasks ON tasks.id = task_embeddings.task_id
+    WHERE tasks.project_id = $1 AND tasks.state IN ('SUCCESS', 'FAILURE')
+    ORDER BY task_embeddings.id
+    LIMIT $2
+    """,
+)
+
+# The same for some tasks ($1), if they're in one of the projects ($2)
+SEARCHABLE_TASK_EMBEDDINGS = statement(
+    "searchable_task_embeddings",
+    """
+    SELECT tasks.project_id, task_embeddings.task_id, task_embeddings.embedding FROM task_embeddings
+    INNER JOIN tasks ON tasks.id = task_embeddings.task_id
+    WHERE task_embeddings.task_id = ANY($1::int[]) AND tasks.project_id = ANY($2::int[])
+      AND tasks.state IN ('SUCCESS', 'FAILURE')
+    ORDER BY task_embeddings.id
+    """,
+)
+
+
+@cache
+def _searchable_tasks_by_id(large: tuple[str, ...]) -> Statement:
+    # Checks the state again, in case a task changed after the in-process index was searched
+    return statement(
+        "_".join(["searchable_tasks_by_id", *large]),
+        f"""
+        SELECT {task_columns(large)} FROM tasks
+        WHERE id = ANY($1::int[]) AND tasks.state IN ('SUCCESS', 'FAILURE')
+          AND exists(SELECT 1 FROM user_projects WHERE user_id = $2 AND project_id = tasks.project_id)
+        """,
+    )
+
+
+_searchable_tasks_by_id(LARGE_TASK_COLUMNS)
+
+
+async def get_task_by_uuid(uuid: UUID, user_id: int, large: tuple[str, ...] = LARGE_TASK_COLUMNS) -> Record | None:
+    async with DB() as conn:
+        return await _task_by_uuid(large).fetchrow(conn, uuid, user_id)
 
 
 async def create_task(
-    project_id: UUID, user_id: int, name: str, input: str
+    project_id: UUID, user_id: int, name: str, input: str, embedding: np.ndarray | None = None
 ) -> Record | None:
-    async with DB() as conn:
-        project = await get_project_by_uuid(project_id, user_id)
-        if not project:
-            return None
-
-        return await conn.fetchrow(
-            "INSERT INTO tasks (project_id, name, input) VALUES ($1, $2, $3) RETURNING *",
-            project["id"],
-            name,
-            input,
-        )
+    """
+    Creates a task, which the embedding worker embeds unless its `embedding` is given.
+    """
+    async with DB(transaction=True) as conn:
+        status = "PENDING" if embedding is None else "READY"
+        task = await INSERT_TASK.fetchrow(conn, project_id, user_id, name, input, status)
+        if task is not None and embedding is not None:
+            await INSERT_TASK_EMBEDDING.execute(conn, task["id"], embedding)
+        return task
 
 
 async def update_task(
@@ -41,104 +419,207 @@ async def update_task(
     success: bool | None = None,
     feedback: str | None = None,
 ) -> Record | None:
-    async with DB() as conn:
-        task = await get_task_by_uuid(uuid, user_id)
-        if not task:
-            return None
-
-        fields: list[str] = []
-        values: list[str | bool | UUID] = []
-
-        if name is not None:
-            fields.append("name = $1")
-            values.append(name)
-        if input is not None:
-            fields.append(f"input =  ${len(values) + 1}")
-            values.append(input)
-        if state is not None:
-            fields.append(f"state = ${len(values) + 1}")
-            values.append(state)
-        if success is not None:
-            fields.append(f"success = ${len(values) + 1}")
-            values.append(success)
-        if feedback is not None:
-            fields.append(f"feedback = ${len(values) + 1}")
-            values.append(feedback)
-
-        if not fields:
-            return task
-
-        query = f"UPDATE tasks SET {', '.join(fields)} WHERE id = ${len(values) + 1} RETURNING *"
-        values.append(task["id"])
-
-        return await conn.fetchrow(query, *values)
+    if name is None and input is None and state is None and success is None and feedback is None:
+        return await get_task_by_uuid(uuid, user_id)
+
+    async with DB(transaction=True) as conn:
+        return await UPDATE_TASK.fetchrow(conn, uuid, user_id, name, input, state, success, feedback)
 
 
 async def delete_task(uuid: UUID, user_id: int) -> Record | None:
-    async with DB() as conn:
-        task = await get_task_by_uuid(uuid, user_id)
-        if not task:
-            return None
+    async with DB(transaction=True) as conn:
+        return await DELETE_TASK.fetchrow(conn, uuid, user_id)
 
-        await conn.execute("DELETE FROM tasks WHERE uuid = $1", uuid)
-        return task
 
+async def claim_pending_embeddings(limit: int, lease_timeout: float) -> list[Record]:
+    """
+    Leases up to `limit` tasks waiting for an embedding, in a transaction of its own, and returns their ids, inputs
+    and the lease (embedding_claimed_at) to finish the claim with. Other workers skip them for `lease_timeout` seconds.
+    """
+    async with DB(transaction=True, detached=True) as conn:
+        return await CLAIM_PENDING_EMBEDDINGS.fetch(conn, limit, lease_timeout)
 
-async def create_task_embedding(task_id: int, embedding: list[float]) -> Record:
-    async with DB() as conn:
-        return await conn.fetchrow(
-            "INSERT INTO task_embeddings (task_id, embedding) VALUES ($1, $2) RETURNING *",
-            task_id,
-            embedding,
-        )
+
+async def create_task_embeddings(embeddings: list[tuple[int, np.ndarray]], lease: datetime) -> int:
+    """
+    Stores (task id, embedding) pairs and marks those tasks READY, for the tasks still holding `lease`. Returns how
+    many tasks that was.
+    """
+    async with DB(transaction=True, detached=True) as conn:
+        task_ids = list({task_id for task_id, _ in embeddings})
+        leased = {row["id"] for row in await FINISH_EMBEDDING_CLAIM.fetch(conn, task_ids, lease, "READY")}
+        await INSERT_TASK_EMBEDDING.executemany(conn, [row for row in embeddings if row[0] in leased])
+        return len(leased)
 
 
-async def create_event(task_id: int, event_type: str, event_data: dict) -> Record:
+async def finish_embedding_claim(task_ids: list[int], lease: datetime, status: str) -> int:
+    """
+    Sets the embedding status of the tasks still holding `lease`, and ends it. Returns how many tasks that was.
+    """
+    async with DB(transaction=True, detached=True) as conn:
+        return len(await FINISH_EMBEDDING_CLAIM.fetch(conn, task_ids, lease, status))
+
+
+async def release_embedding_claim(task_ids: list[int], lease: datetime) -> None:
+    """
+    Ends `lease` on the tasks still holding it, leaving them pending for any worker to claim again.
+    """
+    await finish_embedding_claim(task_ids, lease, "PENDING")
+
+
+async def create_event(task_uuid: UUID, user_id: int, event_type: str, event_data: dict) -> Record | None:
     """
     Insert a new event into the database.
+    Returns None if the task doesn't exist or isn't visible to the user.
     """
-    query = """
-    INSERT INTO events (task_id, event_type, event_data)
-    VALUES ($1, $2, $3)
-    RETURNING id, task_id, event_type, event_data, created_at
+    async with DB(transaction=True) as conn:
+        return await INSERT_EVENT.fetchrow(conn, task_uuid, user_id, event_type, event_data)
+
+
+async def find_similar_tasks(
+    embedding: np.ndarray,
+    user_id: int,
+    k: int = DEFAULT_SIMILAR_TASKS,
+    max_distance: float = DEFAULT_MAX_DISTANCE,
+    project_uuid: UUID | None = None,
+    large: tuple[str, ...] = LARGE_TASK_COLUMNS,
+    search_effort: int | None = None,
+    text: str | None = None,
+    aggregation: str = "MAX",
+) -> list[Record]:
+    """
+    Returns up to `k` finished tasks visible to the user, optionally only those in one project, whose nearest
+    embedding is closer than `max_distance` in the configured metric, nearest first.
+    `search_effort` overrides the index's recall/latency trade-off for this search, see set_search_effort().
+    With `text`, it's a hybrid search that also finds tasks whose name or input match it, ordered by fusion_score.
+    With SUM `aggregation`, tasks are ordered by the chunk_score of their nearest embeddings instead.
+    """
+    candidates, search_effort = _search_parameters(k, search_effort, aggregation)
+    if text is not None and aggregation != "MAX":
+        raise ValueError("Hybrid search ranks tasks by their nearest chunk, so it only supports MAX aggregation")
+    args = (embedding, user_id, max_distance, candidates, project_uuid, k)
+    # The search effort is transaction-local, so it needs a transaction to stay within
+    async with DB(transaction=search_effort is not None) as conn:
+        if search_effort is not None:
+            await set_search_effort(conn, search_effort)
+        if text is not None:
+            return await _hybrid_similar_tasks(large).fetch(conn, *args, text)
+        return await _similar_tasks(large, aggregation).fetch(conn, *args)
+
+
+async def find_similar_tasks_batch(
+    embeddings: list[np.ndarray],
+    user_id: int,
+    k: int = DEFAULT_SIMILAR_TASKS,
+    max_distance: float = DEFAULT_MAX_DISTANCE,
+    project_uuid: UUID | None = None,
+    large: tuple[str, ...] = LARGE_TASK_COLUMNS,
+    search_effort: int | None = None,
+    aggregation: str = "MAX",
+) -> list[list[Record]]:
+    """
+    Like find_similar_tasks(), for each of `embeddings`, in one statement. Returns the results in the same order.
+    """
+    if not 1 <= len(embeddings) <= MAX_SIMILAR_TASK_QUERIES:
+        raise ValueError(f"Send between 1 and {MAX_SIMILAR_TASK_QUERIES} queries")
+
+    candidates, search_effort = _search_parameters(k, search_effort, aggregation)
+    queries = np.concatenate([np.asarray(embedding, dtype=np.float32) for embedding in embeddings])
+    async with DB(transaction=search_effort is not None) as conn:
+        if search_effort is not None:
+            await set_search_effort(conn, search_effort)
+        rows = await _similar_tasks_batch(large, aggregation).fetch(
+            conn, queries, user_id, max_distance, candidates, project_uuid, k
+        )
+
+    grouped: list[list[Record]] = [[] for _ in embeddings]
+    for row in rows:
+        grouped[row["query"] - 1].append(row)
+    return grouped
+
+
+async def get_project_id(uuid: UUID, user_id: int) -> int | None:
+    """
+    Returns the project's id, if the user is one of its members.
     """
     async with DB() as conn:
-        return await conn.fetchrow(query, task_id, event_type, json.dumps(event_data))
+        return await PROJECT_ID.fetchval(conn, uuid, user_id)
 
 
-async def get_embeddings_for_task(task_id: int) -> list[Record]:
+async def get_project_embeddings(project_id: int, limit: int) -> list[Record]:
     async with DB() as conn:
-        return await conn.fetch(
-            "SELECT * FROM task_embeddings WHERE task_id = $1", task_id
-        )
+        return await PROJECT_EMBEDDINGS.fetch(conn, project_id, limit)
 
 
-async def get_metadata_for_task(task_id: int) -> Record:
+async def get_searchable_task_embeddings(task_ids: list[int], project_ids: list[int]) -> list[Record]:
     async with DB() as conn:
-        return await conn.fetchrow(
-            "SELECT * FROM task_metadata WHERE task_id = $1", task_id
-        )
+        return await SEARCHABLE_TASK_EMBEDDINGS.fetch(conn, task_ids, project_ids)
 
 
-async def find_similar_tasks(embedding: list[float]) -> list[Record]:
+async def get_searchable_tasks_by_id(
+    task_ids: list[int], user_id: int, large: tuple[str, ...] = LARGE_TASK_COLUMNS
+) -> dict[int, Record]:
+    """
+    Returns the finished tasks among `task_ids` that are visible to the user, by id.
+    """
     async with DB() as conn:
-        return await conn.fetch(
-            """
-                SELECT DISTINCT ON (embedding)
-                  *, embedding <-> $1 AS similarity_score
-                FROM task_embeddings
-                INNER JOIN tasks ON task_embeddings.task_id = tasks.id
-                WHERE embedding <-> $1 < 0.5 AND (state = 'SUCCESS' OR state = 'FAILURE')
-                ORDER BY embedding, embedding <-> $1
-                LIMIT 5
-            """,
-            embedding,
-        )
+        return {row["id"]: row for row in await _searchable_tasks_by_id(large).fetch(conn, task_ids, user_id)}
+
 
+def _search_parameters(k: int, search_effort: int | None, aggregation: str = "MAX") -> tuple[int, int | None]:
+    """
+    Returns how many candidates to fetch from the index for `k` tasks, and the search effort to use, if any.
+    """
+    if not 1 <= k <= MAX_SIMILAR_TASKS:
+        raise ValueError(f"k must be between 1 and {MAX_SIMILAR_TASKS}")
+    if aggregation not in AGGREGATIONS:
+        raise ValueError(f"aggregation must be one of {', '.join(AGGREGATIONS)}")
+
+    # Summing a task's nearest chunks needs them among the candidates, not just its nearest one
+    overfetch = SIMILAR_TASKS_OVERFETCH * (CHUNK_AGGREGATION_TOP_K if aggregation == "SUM" else 1)
+    candidates = candidate_count(k * overfetch)
+    if search_effort is None and VECTOR_INDEX_TYPE == "hnsw" and candidates > HNSW_DEFAULT_EF_SEARCH:
+        # hnsw.ef_search caps how many rows the index returns, so raise it to cover every candidate. The candidates
+        # are nearest across all users and projects, and only filtered afterwards, so each one counts.
+        search_effort = min(candidates, MAX_SEARCH_EFFORT)
+    return candidates, search_effort
+
+
+def _group_by_task(task_uuids: list[UUID], rows: list[Record]) -> dict[UUID, list[Record]]:
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[row["task_uuid"]].append(row)
+    return {task_uuid: grouped.get(UUID(str(task_uuid)), []) for task_uuid in task_uuids}
 
-async def get_events_for_task(task_id: int) -> list[Record]:
+
+async def get_embeddings_for_tasks(
+    task_uuids: list[UUID], user_id: int, vectors: bool = True
+) -> dict[UUID, list[Record]]:
     async with DB() as conn:
-        return await conn.fetch(
-            "SELECT * FROM events WHERE task_id = $1 ORDER BY created_at",
-            task_id,
-        )
+        return _group_by_task(task_uuids, await _embeddings_for_tasks(vectors).fetch(conn, task_uuids, user_id))
+
+
+async def get_metadata_for_tasks(task_uuids: list[UUID], user_id: int) -> dict[UUID, list[Record]]:
+    async with DB() as conn:
+        return _group_by_task(task_uuids, await METADATA_FOR_TASKS.fetch(conn, task_uuids, user_id))
+
+
+async def get_events_for_tasks(
+    task_uuids: list[UUID], user_id: int, page: Page | None = None, filters: dict | None = None
+) -> dict[UUID, list[Record]]:
+    """
+    Returns up to `page.limit + 1` events per task matching the EventFilters in the page's direction, for
+    aeris.pagination.paginate().
+    """
+    page = page or Page()
+    names, args = select_filters(EVENT_FILTERS, filters)
+    events_for_tasks = _events_for_tasks(page.backward, names)
+    async with DB() as conn:
+        rows = await events_for_tasks.fetch(conn, task_uuids, user_id, *page.bounds(), page.limit + 1, *args)
+    return _group_by_task(task_uuids, rows)
+
+
+async def get_events_for_task(
+    task_uuid: UUID, user_id: int, page: Page | None = None, filters: dict | None = None
+) -> list[Record]:
+    return (await get_events_for_tasks([task_uuid], user_id, page, filters))[task_uuid]
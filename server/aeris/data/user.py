@@ -1,6 +1,11 @@
+from asyncpg import Record
+
 from aeris.db import DB
+from aeris.statements import statement
+
+USER_BY_ID = statement("user_by_id", "SELECT * FROM users WHERE id = $1")
 
 
-async def get_user_by_id(user_id: int) -> dict:
+async def get_user_by_id(user_id: int) -> Record | None:
     async with DB() as conn:
-        return await conn.fetchrow("SELECT * FROM users WHERE id = $1", user_id)
+        return await USER_BY_ID.fetchrow(conn, user_id)
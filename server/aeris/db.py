@@ -1,62 +1,378 @@
+import asyncio
+import json
+import logging
 import os
+from contextvars import ContextVar
+from typing import Any, Callable
 
-from asyncpg import Pool, create_pool
+import asyncpg
+from asyncpg import Connection, Pool, connect, create_pool
+from asyncpg.pool import PoolConnectionProxy
 from bcrypt import gensalt, hashpw
 from pgvector.asyncpg import register_vector
 
-from aeris.env import env
+from aeris.env import env, get_setting
+from aeris.statements import registered_statements
+from aeris.vector_index import EMBEDDING_DIMENSIONS, VECTOR_INDEX, create_vector_index
 
 env()
 
+logger = logging.getLogger(__name__)
+
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+DB_POOL_MIN_SIZE = int(get_setting("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(get_setting("DB_POOL_MAX_SIZE", 10))
+# Must stay larger than the number of registered statements, or prepared statements get evicted
+DB_STATEMENT_CACHE_SIZE = int(get_setting("DB_STATEMENT_CACHE_SIZE", 256))
+# How long shutdown waits for in-flight queries to release their connections before terminating them
+DB_POOL_CLOSE_TIMEOUT = float(get_setting("DB_POOL_CLOSE_TIMEOUT", 10))
+
 
 # Create a connection pool globally
 _pool: Pool | None = None
 
 
+async def register_codecs(conn: asyncpg.Connection) -> None:
+    """
+    Registers the type codecs Aeris relies on. JSON and JSONB values are decoded to Python objects.
+    Setting a codec clears the connection's statement cache, so this should only run when a connection is opened.
+    """
+    for json_type in ("json", "jsonb"):
+        await conn.set_type_codec(json_type, schema="pg_catalog", encoder=json.dumps, decoder=json.loads)
+
+    try:
+        await register_vector(conn)
+    except ValueError as e:
+        # The vector extension is created by init_db(), which reopens the pool's connections afterwards
+        if not str(e).startswith("unknown type"):
+            raise
+        logger.warning("The vector extension isn't installed yet, vector columns can't be used on this connection")
+
+
+async def _init_connection(conn: Connection) -> None:
+    """
+    Runs once for every physical connection the pool opens. Preparing the registered statements loads the catalog
+    entries they touch into the backend's caches and checks they still parse, before a request waits on either.
+    """
+    await register_codecs(conn)
+    for registered in registered_statements():
+        try:
+            await conn.prepare(registered.sql)
+        except asyncpg.PostgresError as e:
+            # Warming is only an optimization, e.g. the tables may not exist yet while the schema is being created
+            logger.debug(f"Could not prepare statement {registered.name}: {e}")
+
+    # Preparing doesn't end the protocol's implicit transaction, which would hold locks on the prepared statements'
+    # tables until the connection is next used. A simple query ends it.
+    await conn.execute("SELECT 1")
+
+
 async def init_db_pool():
     """
-    Initializes the database connection pool.
+    Initializes the database connection pool. Opens DB_POOL_MIN_SIZE connections up front.
     """
     global _pool
     if _pool is None:
-        _pool = await create_pool(DATABASE_URL)
+        _pool = await create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            init=_init_connection,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        )
 
 
 async def close_db_pool():
     """
-    Closes the database connection pool.
+    Closes the database connection pool, waiting up to DB_POOL_CLOSE_TIMEOUT for connections to be released.
     """
     global _pool
     if _pool:
-        await _pool.close()
-        _pool = None
+        pool, _pool = _pool, None
+        try:
+            await asyncio.wait_for(pool.close(), DB_POOL_CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out waiting for database connections to be released, terminating them")
+            pool.terminate()
+
+
+async def create_listener(
+    channel: str, callback: Callable[[Any, int, str, Any], None], on_close: Callable[[Any], Any]
+) -> asyncpg.Connection:
+    """
+    Opens a dedicated connection, outside the pool, that LISTENs on `channel`.
+    `on_close` is called if the connection is lost.
+    """
+    conn = await connect(DATABASE_URL)
+    await conn.add_listener(channel, callback)
+    conn.add_termination_listener(on_close)
+    return conn
+
+
+class UnitOfWork:
+    """
+    Scopes a single connection to everything that runs inside it, e.g. one GraphQL operation.
+    The connection is acquired on first use. Writes made with DB(transaction=True) share one transaction, which
+    commits when the unit of work ends, or rolls back if it raised or was marked as failed.
+    """
+
+    def __init__(self):
+        self.conn: PoolConnectionProxy | None = None
+        self.failed = False
+        self._transaction = None
+        # Resolvers of one operation can run concurrently, but a connection runs one query at a time
+        self._lock = asyncio.Lock()
+        self._owner: asyncio.Task | None = None
+        self._depth = 0
+
+    async def __aenter__(self):
+        self._token = _unit_of_work.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        _unit_of_work.reset(self._token)
+        if self.conn is None:
+            return
+
+        try:
+            if self._transaction is not None:
+                if exc_type is None and not self.failed:
+                    await self._transaction.commit()
+                else:
+                    await self._transaction.rollback()
+        finally:
+            conn, self.conn, self._transaction = self.conn, None, None
+            await _pool.release(conn)
+
+    async def enter(self, transaction: bool) -> PoolConnectionProxy:
+        task = asyncio.current_task()
+        if self._owner is not task:
+            await self._lock.acquire()
+            self._owner = task
+        self._depth += 1
+
+        try:
+            conn = self.conn
+            if conn is None:
+                if _pool is None:
+                    raise RuntimeError("Database pool not initialized. Call init_db_pool() first.")
+                conn = self.conn = await _pool.acquire()
+            if transaction and self._transaction is None:
+                self._transaction = conn.transaction()
+                await self._transaction.start()
+        except BaseException:
+            self.exit()
+            raise
+
+        return conn
+
+    def exit(self) -> None:
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+            self._lock.release()
+
+
+_unit_of_work: ContextVar[UnitOfWork | None] = ContextVar("unit_of_work", default=None)
+
+
+def current_unit_of_work() -> UnitOfWork | None:
+    return _unit_of_work.get()
 
 
 class DB:
     """
     A context manager for acquiring a database connection.
-    Ensures that the connection is released back to the pool.
+    Inside a UnitOfWork this is the unit's connection, otherwise the connection is released back to the pool on exit.
+    With `transaction=True` the statements run inside a transaction: the unit of work's, or one for this block.
+    With `detached=True` the block gets a connection of its own even inside a UnitOfWork, for short reads and writes
+    that must neither join the unit's transaction nor make it hold a connection through slow work that follows.
     """
 
-    def __init__(self):
+    def __init__(self, transaction: bool = False, detached: bool = False):
         if _pool is None:
             raise RuntimeError(
                 "Database pool not initialized. Call init_db_pool() first."
             )
+        self.transaction = transaction
+        self.detached = detached
 
     async def __aenter__(self):
+        self.unit_of_work = None if self.detached else _unit_of_work.get()
+        if self.unit_of_work is not None:
+            self.conn = await self.unit_of_work.enter(self.transaction)
+            return self.conn
+
         self.conn = await _pool.acquire()
-        await register_vector(self.conn)
+        self._transaction = None
+        if self.transaction:
+            try:
+                self._transaction = self.conn.transaction()
+                await self._transaction.start()
+            except BaseException:
+                await _pool.release(self.conn)
+                raise
         return self.conn
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await _pool.release(self.conn)
+        if self.unit_of_work is not None:
+            self.unit_of_work.exit()
+            return
+
+        try:
+            if self._transaction is not None:
+                if exc_type is None:
+                    await self._transaction.commit()
+                else:
+                    await self._transaction.rollback()
+        finally:
+            await _pool.release(self.conn)
+
+
+# Tells every worker to evict a cached API key when it is changed or deleted. The payload is the api_keys.id.
+API_KEY_REVOKED_TRIGGER = """
+    CREATE OR REPLACE FUNCTION notify_api_key_revoked() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('api_key_revoked', OLD.id::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS api_key_revoked ON api_keys;
+    CREATE TRIGGER api_key_revoked AFTER UPDATE OR DELETE ON api_keys
+        FOR EACH ROW EXECUTE FUNCTION notify_api_key_revoked();
+"""
+
+
+# Embeddings by a hash of the model and normalized text, shared by every worker, see aeris.embeddings
+EMBEDDING_CACHE_TABLE = f"""
+CREATE TABLE IF NOT EXISTS embedding_cache (
+    key BYTEA PRIMARY KEY, -- sha256 of the model and normalized text
+    model TEXT NOT NULL,
+    embedding VECTOR({EMBEDDING_DIMENSIONS}) NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+"""
+
+# Wakes the embedding workers when tasks are created, see aeris.embedding_worker. Notifications are delivered on
+# commit, once the tasks are visible. The partial index keeps finding pending tasks cheap as the table grows.
+EMBEDDING_QUEUE = """
+    CREATE OR REPLACE FUNCTION notify_task_embedding_pending() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('task_embedding_pending', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS task_embedding_pending ON tasks;
+    CREATE TRIGGER task_embedding_pending AFTER INSERT ON tasks
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_task_embedding_pending();
+
+    CREATE INDEX IF NOT EXISTS tasks_embedding_pending_idx ON tasks (id) WHERE embedding_status = 'PENDING';
+"""
+
+# Tells the workers which tasks' searchable embeddings changed, for their project indexes and similar-task caches
+# (aeris.project_index and aeris.similarity_cache): embeddings inserted or deleted, including by deleting their task,
+# and tasks finishing or no longer being finished, which is all searches see of their state. There is one notification per statement, whose payload is a comma-separated
+# "task id:project uuid" for each changed task, without the uuid if the task was deleted. A payload over Postgres's
+# 8000 byte limit is sent as "*" instead, which drops every index and cache. Notifications with the same payload are
+# only delivered once per transaction.
+TASK_VECTORS_CHANGED = """
+    CREATE OR REPLACE FUNCTION notify_task_vectors_changed_for(task_ids INT[]) RETURNS void AS $$
+    DECLARE
+        payload TEXT;
+    BEGIN
+        SELECT string_agg(changed.task_id || ':' || coalesce(projects.uuid::text, ''), ',' ORDER BY changed.task_id)
+        INTO payload
+        FROM (SELECT DISTINCT unnest(task_ids) AS task_id) changed
+        LEFT JOIN tasks ON tasks.id = changed.task_id
+        LEFT JOIN projects ON projects.id = tasks.project_id;
+        IF payload IS NOT NULL THEN
+            PERFORM pg_notify('task_vectors_changed', CASE WHEN octet_length(payload) < 8000 THEN payload ELSE '*' END);
+        END IF;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION notify_task_embeddings_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM notify_task_vectors_changed_for(ARRAY(SELECT task_id FROM changed));
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION notify_task_states_changed() RETURNS trigger AS $$
+    BEGIN
+        PERFORM notify_task_vectors_changed_for(ARRAY(
+            SELECT changed.id FROM changed INNER JOIN previous ON previous.id = changed.id
+            WHERE (previous.state IN ('SUCCESS', 'FAILURE')) <> (changed.state IN ('SUCCESS', 'FAILURE'))
+        ));
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    -- Replaces the row-level triggers of earlier versions
+    DROP TRIGGER IF EXISTS task_vectors_changed ON task_embeddings;
+    DROP TRIGGER IF EXISTS task_state_changed ON tasks;
+    DROP FUNCTION IF EXISTS notify_task_vectors_changed();
+
+    -- Transition tables only work with one event per trigger, and without a column list
+    DROP TRIGGER IF EXISTS task_embeddings_inserted ON task_embeddings;
+    CREATE TRIGGER task_embeddings_inserted AFTER INSERT ON task_embeddings REFERENCING NEW TABLE AS changed
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_task_embeddings_changed();
+
+    DROP TRIGGER IF EXISTS task_embeddings_deleted ON task_embeddings;
+    CREATE TRIGGER task_embeddings_deleted AFTER DELETE ON task_embeddings REFERENCING OLD TABLE AS changed
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_task_embeddings_changed();
+
+    CREATE TRIGGER task_state_changed AFTER UPDATE ON tasks REFERENCING OLD TABLE AS previous NEW TABLE AS changed
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_task_states_changed();
+"""
+
+# Full-text search over task names and inputs, for hybrid similarity search. Name matches rank higher.
+TEXT_SEARCH_CONFIG = "english"
+# Only the start of an input is indexed: a tsvector can't reach 1 MB, which a long log with unique ids or hashes would,
+# failing the insert
+TASK_SEARCH_INPUT_CHARS = 100_000
+TASK_SEARCH = f"""
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS search_vector TSVECTOR GENERATED ALWAYS AS (
+    setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', name), 'A')
+    || setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', left(input, {TASK_SEARCH_INPUT_CHARS})), 'B')
+) STORED;
+CREATE INDEX IF NOT EXISTS tasks_search_vector_idx ON tasks USING gin (search_vector);
+"""
+
+PAGINATION_INDEXES = """
+CREATE INDEX IF NOT EXISTS tasks_project_id_created_at_id_idx ON tasks (project_id, created_at, id);
+CREATE INDEX IF NOT EXISTS events_task_id_created_at_id_idx ON events (task_id, created_at, id);
+"""
+
+# Serve the state and eventType filters in keyset order
+FILTER_INDEXES = """
+CREATE INDEX IF NOT EXISTS tasks_project_id_state_created_at_id_idx ON tasks (project_id, state, created_at, id);
+CREATE INDEX IF NOT EXISTS events_task_id_event_type_created_at_id_idx ON events (task_id, event_type, created_at, id);
+"""
+
+
+async def create_trigram_index(conn: Connection):
+    """
+    Indexes task names for nameContains. pg_trgm is a contrib extension that isn't always installed, in which case
+    nameContains still works but scans the project's tasks.
+    """
+    try:
+        await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+    except asyncpg.PostgresError as e:
+        logger.warning("Not indexing task names for nameContains, pg_trgm is unavailable: %s", e)
+        return
+
+    await conn.execute("CREATE INDEX IF NOT EXISTS tasks_name_trgm_idx ON tasks USING gin (name gin_trgm_ops);")
 
 
 async def drop_db():
     async with DB() as conn:
+        # Dropping tables doesn't fire row triggers, so tell every worker to forget cached API keys and project indexes
+        await conn.execute("NOTIFY api_key_revoked, '*'")
+        await conn.execute("NOTIFY task_vectors_changed, '*'")
         await conn.execute("DROP TABLE IF EXISTS task_embeddings")
         await conn.execute("DROP TABLE IF EXISTS task_metadata")
         await conn.execute("DROP TABLE IF EXISTS events")
@@ -67,12 +383,14 @@ async def drop_db():
         await conn.execute("DROP TABLE IF EXISTS tools")
         await conn.execute("DROP TABLE IF EXISTS tasks")
         await conn.execute("DROP TABLE IF EXISTS projects")
+        await conn.execute("DROP TABLE IF EXISTS embedding_cache")
 
 
 async def init_db():
     async with DB() as conn:
         await conn.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";')
         await conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+        await register_codecs(conn)
 
         await conn.execute(
             """
@@ -97,21 +415,24 @@ async def init_db():
                 success BOOLEAN, -- Task success status, null is incomplete
                 feedback TEXT, -- Human feedback on task output
                 state TEXT NOT NULL DEFAULT 'PENDING', -- Task state (e.g., "PENDING", "RUNNING", "COMPLETED")
-                created_at TIMESTAMPTZ DEFAULT NOW()
+                embedding_status TEXT NOT NULL DEFAULT 'PENDING', -- "PENDING" until embedded, then "READY" or "FAILED"
+                embedding_claimed_at TIMESTAMPTZ, -- When an embedding worker last claimed the pending task
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
             );
         """
         )
 
         await conn.execute(
-            """
+            f"""
             CREATE TABLE task_embeddings (
                 id SERIAL PRIMARY KEY,
                 uuid UUID DEFAULT gen_random_uuid(),
                 task_id INT NOT NULL REFERENCES tasks(id) ON DELETE CASCADE, -- Links embedding to task
-                embedding VECTOR(1536) NOT NULL -- Vector representation of the task
+                embedding VECTOR({EMBEDDING_DIMENSIONS}) NOT NULL -- Vector representation of the task
             );
         """
         )
+        await conn.execute(EMBEDDING_CACHE_TABLE)
 
         await conn.execute(
             """
@@ -156,7 +477,7 @@ async def init_db():
                 task_id INT NOT NULL REFERENCES tasks(id) ON DELETE CASCADE, -- Links to task
                 event_type TEXT NOT NULL, -- Type of event (e.g., "TASK_CREATED", "EMBEDDING_GENERATED")
                 event_data JSONB NOT NULL, -- Payload associated with the event
-                created_at TIMESTAMPTZ DEFAULT NOW() -- Timestamp of event creation
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW() -- Timestamp of event creation
             );
         """
         )
@@ -191,6 +512,7 @@ async def init_db():
                 uuid UUID DEFAULT gen_random_uuid(), 
                 user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE, -- API key belongs to a user
                 project_id INT NOT NULL REFERENCES projects(id) ON DELETE CASCADE, -- API key linked to a project
+                key_id TEXT UNIQUE, -- Public lookup id embedded in the key (NULL for legacy keys)
                 key TEXT NOT NULL UNIQUE, -- The actual API key (hashed for security)
                 created_at TIMESTAMPTZ DEFAULT NOW(), -- Timestamp when the key was created
                 expires_at TIMESTAMPTZ, -- Optional expiration date
@@ -199,12 +521,19 @@ async def init_db():
         """
         )
 
-        await conn.execute("CREATE INDEX ON tasks (project_id);")
+        await conn.execute(API_KEY_REVOKED_TRIGGER)
+        await conn.execute(EMBEDDING_QUEUE)
+        await conn.execute(TASK_VECTORS_CHANGED)
+
+        # Keyset pagination walks these in (created_at, id) order
+        await conn.execute(PAGINATION_INDEXES)
+        await conn.execute(FILTER_INDEXES)
+        await create_trigram_index(conn)
+        await conn.execute(TASK_SEARCH)
         await conn.execute("CREATE INDEX ON task_embeddings (task_id);")
         await conn.execute("CREATE INDEX ON user_projects (user_id);")
         await conn.execute("CREATE INDEX ON user_projects (project_id);")
         await conn.execute("CREATE INDEX ON task_metadata (task_id);")
-        await conn.execute("CREATE INDEX ON events (task_id);")
         await conn.execute("CREATE INDEX ON task_tools (task_id);")
         await conn.execute("CREATE INDEX ON task_tools (tool_id);")
 
@@ -213,9 +542,7 @@ async def init_db():
         await conn.execute("CREATE INDEX ON projects (name);")
         await conn.execute("CREATE INDEX ON users (username);")
         await conn.execute("CREATE INDEX ON tools (name);")
-        await conn.execute(
-            "CREATE INDEX ON task_embeddings USING hnsw (embedding vector_l2_ops)"
-        )
+        await create_vector_index(conn)
 
         await conn.execute("CREATE INDEX ON tasks (uuid);")
         await conn.execute("CREATE INDEX ON projects (uuid);")
@@ -1779,11 +2106,14 @@ async def init_db():
                 0.009214324876666069,
                 -0.029299480840563774,
             ]
-            await conn.execute(
-                "INSERT INTO task_embeddings (task_id, embedding) VALUES ($1, $2) RETURNING *",
-                result["id"],
-                embedding,
-            )
+            # A text-embedding-ada-002 embedding. With other dimensions, the embedding worker embeds the task instead.
+            if len(embedding) == EMBEDDING_DIMENSIONS:
+                await conn.execute(
+                    "INSERT INTO task_embeddings (task_id, embedding) VALUES ($1, $2) RETURNING *",
+                    result["id"],
+                    embedding,
+                )
+                await conn.execute("UPDATE tasks SET embedding_status = 'READY' WHERE id = $1", result["id"])
 
             test_api_key = os.getenv("TEST_API_KEY", "TEST")
 
@@ -1794,7 +2124,67 @@ async def init_db():
             )
 
 
+async def migrate_db():
+    """
+    Applies schema changes to a database created by an older version of init_db().
+    Every statement must be safe to run more than once.
+    """
+    async with DB() as conn:
+        await conn.execute("ALTER TABLE api_keys ADD COLUMN IF NOT EXISTS key_id TEXT UNIQUE;")
+        await conn.execute(API_KEY_REVOKED_TRIGGER)
+        await conn.execute(EMBEDDING_CACHE_TABLE)
+        for table in ("tasks", "events"):
+            await conn.execute(f"UPDATE {table} SET created_at = NOW() WHERE created_at IS NULL;")
+            await conn.execute(f"ALTER TABLE {table} ALTER COLUMN created_at SET NOT NULL;")
+        if not await conn.fetchval(
+            "SELECT exists(SELECT 1 FROM information_schema.columns WHERE table_name = 'tasks' AND column_name = 'embedding_status')"
+        ):
+            # Tasks created before the embedding worker were embedded when they were created
+            await conn.execute("ALTER TABLE tasks ADD COLUMN embedding_status TEXT NOT NULL DEFAULT 'PENDING';")
+            await conn.execute(
+                "UPDATE tasks SET embedding_status = 'READY' WHERE exists(SELECT 1 FROM task_embeddings WHERE task_id = tasks.id);"
+            )
+        await conn.execute("ALTER TABLE tasks ADD COLUMN IF NOT EXISTS embedding_claimed_at TIMESTAMPTZ;")
+        await conn.execute(EMBEDDING_QUEUE)
+        await conn.execute(TASK_VECTORS_CHANGED)
+        await conn.execute(PAGINATION_INDEXES)
+        await conn.execute(FILTER_INDEXES)
+        await create_trigram_index(conn)
+        # Generated columns can't be altered, so one indexing the whole input is replaced
+        search_vector = await conn.fetchval(
+            """
+            SELECT pg_get_expr(adbin, adrelid) FROM pg_attrdef
+            INNER JOIN pg_attribute ON attrelid = adrelid AND attnum = adnum
+            WHERE adrelid = 'tasks'::regclass AND attname = 'search_vector'
+            """
+        )
+        if search_vector is not None and f'"left"(input, {TASK_SEARCH_INPUT_CHARS})' not in search_vector:
+            logger.info("Re-indexing task inputs for full-text search")
+            await conn.execute("ALTER TABLE tasks DROP COLUMN search_vector;")
+        await conn.execute(TASK_SEARCH)
+
+        # A vector column's type modifier is its dimensions
+        dimensions = await conn.fetchval(
+            "SELECT atttypmod FROM pg_attribute WHERE attrelid = 'task_embeddings'::regclass AND attname = 'embedding'"
+        )
+        if dimensions != EMBEDDING_DIMENSIONS:
+            logger.warning(
+                "Embeddings have %d dimensions but EMBEDDING_DIMENSIONS is %d, dropping them to re-embed every task",
+                dimensions,
+                EMBEDDING_DIMENSIONS,
+            )
+            await conn.execute(f"DROP INDEX IF EXISTS {VECTOR_INDEX};")
+            await conn.execute("TRUNCATE task_embeddings, embedding_cache;")
+            for table in ("task_embeddings", "embedding_cache"):
+                await conn.execute(f"ALTER TABLE {table} ALTER COLUMN embedding TYPE VECTOR({EMBEDDING_DIMENSIONS});")
+            await conn.execute("UPDATE tasks SET embedding_status = 'PENDING';")
+            await conn.execute("NOTIFY task_vectors_changed, '*'")
+        await create_vector_index(conn)
+
+
 async def refresh_db():
     await init_db_pool()
     await drop_db()
     await init_db()
+    # Reconnect so every pooled connection registers codecs and prepares statements against the new schema
+    await _pool.expire_connections()
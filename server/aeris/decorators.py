@@ -7,14 +7,16 @@ def decorate_task(task: Record) -> dict[str, Any]:
     task_dict = dict(task)
     task_dict["id"] = task_dict.pop("uuid")
     task_dict["createdAt"] = task_dict["created_at"].isoformat()
+    task_dict["embeddingStatus"] = task_dict["embedding_status"]
     return task_dict
 
 
 def decorate_task_similarity(task: Record) -> dict[str, Any]:
-    task_dict = dict(task)
+    task_dict = decorate_task(task)
     similarity = task_dict.pop("similarity_score")
-    task_dict["id"] = task_dict.pop("uuid")
-    return {"similarity": similarity, "task": task_dict}
+    score = task_dict.pop("fusion_score", None)
+    chunk_score = task_dict.pop("chunk_score", None)
+    return {"similarity": similarity, "score": score if score is not None else chunk_score, "task": task_dict}
 
 
 def decorate_project(project: Record) -> dict[str, Any]:
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+from collections import deque
+from itertools import islice
+
+import numpy as np
+from asyncpg import Connection
+
+from aeris.chunking import chunk_text, halve
+from aeris.data.task import (
+    claim_pending_embeddings,
+    create_task_embeddings,
+    finish_embedding_claim,
+    release_embedding_claim,
+)
+from aeris.db import create_listener
+from aeris.embeddings import EmbeddingInputError, generate_embeddings
+from aeris.env import get_setting
+
+logger = logging.getLogger(__name__)
+
+# Tasks are created with a PENDING embedding and embedded here, in batches, instead of while the client waits.
+# Every worker process runs one of these. Each leases a batch in a short transaction, embeds it with no transaction
+# open, and stores it in another, so adding workers adds throughput and a slow provider doesn't hold connections.
+EMBEDDING_WORKER_ENABLED = get_setting("EMBEDDING_WORKER_ENABLED", "true").lower() == "true"
+# Tasks embedded with one provider call
+EMBEDDING_BATCH_SIZE = int(get_setting("EMBEDDING_BATCH_SIZE", 64))
+# Seconds between checks for pending tasks when no notification arrives, e.g. while the listener is disconnected
+EMBEDDING_WORKER_POLL_INTERVAL = float(get_setting("EMBEDDING_WORKER_POLL_INTERVAL", 5))
+# Seconds to wait before retrying a batch the provider or database failed
+EMBEDDING_WORKER_RETRY_DELAY = float(get_setting("EMBEDDING_WORKER_RETRY_DELAY", 30))
+# Seconds after which a claimed batch that was never stored, e.g. because its worker died, can be claimed again
+EMBEDDING_LEASE_TIMEOUT = float(get_setting("EMBEDDING_LEASE_TIMEOUT", 300))
+# Inputs are embedded in chunks of up to this many tokens, each overlapping the previous by EMBEDDING_CHUNK_OVERLAP,
+# so a long input is matched by its passages instead of one diluted embedding, see aeris.chunking
+EMBEDDING_CHUNK_TOKENS = int(get_setting("EMBEDDING_CHUNK_TOKENS", 512))
+EMBEDDING_CHUNK_OVERLAP = int(get_setting("EMBEDDING_CHUNK_OVERLAP", 64))
+# And of up to this many characters, for text the chunker's tokens underestimate, like Chinese or Japanese, which takes
+# about a model token per character
+EMBEDDING_CHUNK_CHARS = int(get_setting("EMBEDDING_CHUNK_CHARS", EMBEDDING_CHUNK_TOKENS * 4))
+# Chunks embedded per task, so at most about EMBEDDING_MAX_CHUNKS * (EMBEDDING_CHUNK_TOKENS - EMBEDDING_CHUNK_OVERLAP)
+# tokens of its input. The rest of a longer input isn't embedded, and is only found by text search. Each such task is
+# logged, and counted in the worker's "truncated" stat.
+EMBEDDING_MAX_CHUNKS = int(get_setting("EMBEDDING_MAX_CHUNKS", 64))
+
+TASK_EMBEDDING_PENDING_CHANNEL = "task_embedding_pending"
+
+_worker: asyncio.Task | None = None
+_listener: Connection | None = None
+_wakeup: asyncio.Event | None = None
+
+_batches = 0
+_embedded = 0
+_failed = 0
+_truncated = 0
+_errors = 0
+
+
+def _chunks(text: str) -> tuple[list[str], bool]:
+    """
+    Returns the text's first EMBEDDING_MAX_CHUNKS chunks, and whether it has more, which aren't embedded.
+    """
+    chunks = chunk_text(text, EMBEDDING_CHUNK_TOKENS, EMBEDDING_CHUNK_OVERLAP, EMBEDDING_CHUNK_CHARS)
+    first = list(islice(chunks, EMBEDDING_MAX_CHUNKS + 1))
+    return first[:EMBEDDING_MAX_CHUNKS], len(first) > EMBEDDING_MAX_CHUNKS
+
+
+def query_chunk(text: str) -> str:
+    """
+    Returns the part of a search query that's embedded: its first chunk, which is no longer than the chunks of task
+    inputs it's compared with, so a query can't be longer than the model accepts.
+    """
+    return next(chunk_text(text, EMBEDDING_CHUNK_TOKENS, max_chars=EMBEDDING_CHUNK_CHARS), text)
+
+
+async def _embed_chunks(task_id: int, chunks: list[str]) -> list[tuple[int, np.ndarray]]:
+    """
+    Embeds a task's chunks one at a time, halving any the provider rejects until it accepts the halves. Chunks that
+    are down to a single token and still rejected are left out.
+    """
+    embedded = []
+    pending = deque(chunks)
+    while pending:
+        chunk = pending.popleft()
+        try:
+            (embedding,) = await generate_embeddings([chunk], cache=False)
+        except EmbeddingInputError:
+            if (halves := halve(chunk)) is not None:
+                pending.extendleft(reversed(halves))
+            continue
+        embedded.append((task_id, embedding))
+    return embedded
+
+
+async def _embed(tasks: list[tuple[int, list[str]]]) -> tuple[list[tuple[int, np.ndarray]], list[int]]:
+    """
+    Embeds every chunk of the tasks' inputs, given as (task id, chunks), in one provider call. Returns the
+    (task id, embedding) pairs, and the ids of tasks none of whose input the provider accepted. Rejected input is
+    found by embedding the batch one task at a time, then a rejected task one chunk at a time, so a chunk that takes
+    more model tokens than the chunker estimated only costs the task that chunk's embedding.
+    """
+    try:
+        # Chunks are stored with their task, and a task's input is rarely embedded again
+        embeddings = await generate_embeddings([chunk for _, chunks in tasks for chunk in chunks], cache=False)
+        task_ids = [task_id for task_id, chunks in tasks for _ in chunks]
+        return list(zip(task_ids, embeddings, strict=True)), []
+    except EmbeddingInputError as e:
+        if len(tasks) == 1:
+            task_id, chunks = tasks[0]
+            # A task's only chunk is the one that was rejected
+            accepted = await _embed_chunks(task_id, chunks if len(chunks) > 1 else list(halve(chunks[0]) or ()))
+            if not accepted:
+                logger.warning("Could not embed task %d: %s", task_id, e)
+                return [], [task_id]
+            return accepted, []
+
+    embedded: list[tuple[int, np.ndarray]] = []
+    failed: list[int] = []
+    for task in tasks:
+        task_embedded, task_failed = await _embed([task])
+        embedded += task_embedded
+        failed += task_failed
+    return embedded, failed
+
+
+async def embed_pending_tasks(batch_size: int = EMBEDDING_BATCH_SIZE) -> int:
+    """
+    Embeds up to `batch_size` pending tasks and returns how many were claimed. If the provider or the database fails,
+    nothing is written and the tasks stay pending for the next attempt, which can claim them again straight away, or
+    after EMBEDDING_LEASE_TIMEOUT if the lease couldn't be released.
+    """
+    global _batches, _embedded, _failed, _truncated
+
+    tasks = await claim_pending_embeddings(batch_size, EMBEDDING_LEASE_TIMEOUT)
+    if not tasks:
+        return 0
+    # Every task claimed together shares the lease
+    lease = tasks[0]["embedding_claimed_at"]
+
+    try:
+        chunked = []
+        truncated = 0
+        for task in tasks:
+            chunks, more = _chunks(task["input"])
+            if more:
+                logger.warning("Embedding only the first %d chunks of task %d", EMBEDDING_MAX_CHUNKS, task["id"])
+                truncated += 1
+            chunked.append((task["id"], chunks))
+        # Input that is only whitespace has nothing to embed
+        failed = [task_id for task_id, chunks in chunked if not chunks]
+        embedded: list[tuple[int, np.ndarray]] = []
+        if embeddable := [(task_id, chunks) for task_id, chunks in chunked if chunks]:
+            embedded, rejected = await _embed(embeddable)
+            failed += rejected
+
+        # Tasks whose lease expired and was taken by another worker are that worker's to count
+        stored = await create_task_embeddings(embedded, lease) if embedded else 0
+        marked_failed = await finish_embedding_claim(failed, lease, "FAILED") if failed else 0
+    except BaseException:
+        # Best effort, so the error that matters is the one raised
+        try:
+            await asyncio.shield(release_embedding_claim([task["id"] for task in tasks], lease))
+        except Exception:
+            logger.exception("Could not release the claim on %d tasks", len(tasks))
+        raise
+
+    _batches += 1
+    _embedded += stored
+    _failed += marked_failed
+    _truncated += truncated
+    return len(tasks)
+
+
+def _on_task_embedding_pending(*_) -> None:
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def _on_listener_closed(_) -> None:
+    global _listener
+    logger.warning("Embedding worker listener disconnected, polling every %s seconds", EMBEDDING_WORKER_POLL_INTERVAL)
+    _listener = None
+
+
+async def _listen() -> None:
+    global _listener
+    try:
+        _listener = await create_listener(TASK_EMBEDDING_PENDING_CHANNEL, _on_task_embedding_pending, _on_listener_closed)
+    except Exception:
+        logger.exception("Could not listen for new tasks, polling every %s seconds", EMBEDDING_WORKER_POLL_INTERVAL)
+
+
+async def _run(wakeup: asyncio.Event) -> None:
+    global _errors
+
+    while True:
+        # Cleared before looking, so a task created while a batch is embedded is picked up straight after
+        wakeup.clear()
+        try:
+            claimed = await embed_pending_tasks()
+        except Exception:
+            _errors += 1
+            logger.exception("Embedding pending tasks failed, retrying in %s seconds", EMBEDDING_WORKER_RETRY_DELAY)
+            await asyncio.sleep(EMBEDDING_WORKER_RETRY_DELAY)
+            continue
+
+        # A full batch means more tasks are probably waiting
+        if claimed == EMBEDDING_BATCH_SIZE:
+            continue
+
+        if _listener is None:
+            await _listen()
+        try:
+            await asyncio.wait_for(wakeup.wait(), EMBEDDING_WORKER_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def start_embedding_worker() -> None:
+    global _worker, _wakeup
+    if not EMBEDDING_WORKER_ENABLED or _worker is not None:
+        return
+
+    _wakeup = asyncio.Event()
+    await _listen()
+    _worker = asyncio.create_task(_run(_wakeup))
+
+
+async def stop_embedding_worker() -> None:
+    global _worker, _listener
+    if _worker is not None:
+        worker, _worker = _worker, None
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+
+    if _listener is not None:
+        listener, _listener = _listener, None
+        await listener.close()
+
+
+def embedding_worker_stats() -> dict[str, float]:
+    return {
+        "running": _worker is not None,
+        "listening": _listener is not None,
+        "batches": _batches,
+        "embedded": _embedded,
+        "failed": _failed,
+        "truncated": _truncated,
+        "errors": _errors,
+    }
@@ -1,15 +1,335 @@
-from openai import OpenAI
+import asyncio
+import base64
+import binascii
+import hashlib
+import multiprocessing
+import os
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
+import httpx
+import numpy as np
+from openai import NOT_GIVEN, AsyncOpenAI, BadRequestError
+
+from aeris.cache import TTLCache
+from aeris.data.embedding_cache import cache_embeddings, get_cached_embeddings
 from aeris.env import get_setting
+from aeris.local_embeddings import embed_texts
+from aeris.vector_index import EMBEDDING_DIMENSIONS
+
+EMBEDDING_PROVIDER = get_setting("EMBEDDING_PROVIDER", "openai")
+EMBEDDING_MODEL = get_setting("EMBEDDING_MODEL", "text-embedding-ada-002")
+# Seconds before a request to the provider is abandoned, and how often it's retried with backoff after a timeout,
+# connection error, rate limit or server error
+EMBEDDING_TIMEOUT = float(get_setting("EMBEDDING_TIMEOUT", 10))
+EMBEDDING_MAX_RETRIES = int(get_setting("EMBEDDING_MAX_RETRIES", 3))
+# Requests in flight to the provider at once, which is also the number of kept-alive connections
+EMBEDDING_MAX_CONCURRENCY = int(get_setting("EMBEDDING_MAX_CONCURRENCY", 8))
+# Texts sent to the OpenAI API per request. Larger batches are split into concurrent requests, which keeps each within
+# the API's limits on inputs and tokens per request even when every text is a full chunk, see aeris.embedding_worker.
+EMBEDDING_REQUEST_SIZE = int(get_setting("EMBEDDING_REQUEST_SIZE", 256))
+# Processes the local provider spreads large batches over, in chunks of up to LOCAL_EMBEDDING_CHUNK_CHARS characters.
+# Embedding takes time in proportion to the characters, so batches with fewer are embedded on the event loop, which
+# takes a few milliseconds at most. 0 never uses processes.
+LOCAL_EMBEDDING_POOL_SIZE = int(get_setting("LOCAL_EMBEDDING_POOL_SIZE", min(4, os.cpu_count() or 1)))
+LOCAL_EMBEDDING_CHUNK_CHARS = int(get_setting("LOCAL_EMBEDDING_CHUNK_CHARS", 16384))
+
+
+class EmbeddingInputError(ValueError):
+    """
+    Raised when the provider rejects an input, e.g. one longer than the model accepts. Retrying won't help.
+    """
+
+
+class EmbeddingProvider(ABC):
+    """
+    Turns text into embedding vectors. Providers are long-lived and shared by every request.
+    """
+
+    def __init__(self, model: str, max_concurrency: int = EMBEDDING_MAX_CONCURRENCY):
+        self.model = model
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+
+    async def embed(self, texts: list[str]) -> list[list[float]] | np.ndarray:
+        """
+        Returns one embedding per text, in order.
+        """
+        if not texts or not all(text and isinstance(text, str) for text in texts):
+            raise ValueError("Input text must be a non-empty string.")
+        return await self._embed(texts)
+
+    @asynccontextmanager
+    async def _call(self) -> AsyncIterator[None]:
+        """
+        Holds one of the provider's `max_concurrency` slots for a call, which it counts and times. Providers that split
+        a batch into several calls hold a slot for each, so a large batch can't exceed the limit.
+        """
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                yield
+            except Exception:
+                self.errors += 1
+                raise
+            finally:
+                self.calls += 1
+                self.total_time += time.perf_counter() - started
+
+    @abstractmethod
+    async def _embed(self, texts: list[str]) -> list[list[float]] | np.ndarray: ...
+
+    @abstractmethod
+    async def close(self) -> None: ...
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "mean_ms": self.total_time / self.calls * 1000 if self.calls else 0.0,
+        }
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """
+    The OpenAI embeddings API, or anything serving the same API at `base_url`. The client's retries back off
+    exponentially and honour Retry-After.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str = EMBEDDING_MODEL,
+        base_url: str | None = None,
+        timeout: float = EMBEDDING_TIMEOUT,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+        max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+        dimensions: int = EMBEDDING_DIMENSIONS,
+        request_size: int = EMBEDDING_REQUEST_SIZE,
+    ):
+        super().__init__(model, max_concurrency)
+        self.dimensions = dimensions
+        self.request_size = request_size
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            max_retries=max_retries,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+                timeout=timeout,
+            ),
+        )
+
+    async def _embed(self, texts: list[str]) -> list[list[float]]:
+        if len(texts) > self.request_size:
+            requests = [texts[start : start + self.request_size] for start in range(0, len(texts), self.request_size)]
+            embedded = await asyncio.gather(*(self._request(request) for request in requests))
+            return [embedding for request in embedded for embedding in request]
+        return await self._request(texts)
+
+    async def _request(self, texts: list[str]) -> list[list[float]]:
+        # Only the text-embedding-3 models can be asked for fewer dimensions
+        dimensions = self.dimensions if self.model.startswith("text-embedding-3") else NOT_GIVEN
+        async with self._call():
+            try:
+                response = await self.client.embeddings.create(model=self.model, input=texts, dimensions=dimensions)
+            except BadRequestError as e:
+                raise EmbeddingInputError(e.message) from e
+        return [datum.embedding for datum in sorted(response.data, key=lambda datum: datum.index)]
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+def _chunks_by_characters(texts: list[str], chunk_chars: int) -> list[list[str]]:
+    """
+    Splits texts, in order, into chunks of up to `chunk_chars` characters, or of one text longer than that.
+    """
+    chunks: list[list[str]] = [[]]
+    size = 0
+    for text in texts:
+        if chunks[-1] and size + len(text) > chunk_chars:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(text)
+        size += len(text)
+    return chunks
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    Embeds on this machine by feature hashing, see aeris.local_embeddings. It needs no network access or API key and
+    is deterministic, but only matches texts by shared words and word fragments, not by meaning.
+    """
+
+    def __init__(
+        self,
+        dimensions: int = EMBEDDING_DIMENSIONS,
+        pool_size: int = LOCAL_EMBEDDING_POOL_SIZE,
+        chunk_chars: int = LOCAL_EMBEDDING_CHUNK_CHARS,
+        max_concurrency: int = EMBEDDING_MAX_CONCURRENCY,
+    ):
+        # The model name keys the embedding cache, so it changes with anything that changes the embeddings
+        super().__init__(f"local-hashing-{dimensions}", max_concurrency)
+        self.dimensions = dimensions
+        self.chunk_chars = chunk_chars
+        # Spawned rather than forked, which isn't safe with the event loop's threads. Processes start on first use.
+        self._pool = (
+            ProcessPoolExecutor(pool_size, mp_context=multiprocessing.get_context("spawn")) if pool_size > 0 else None
+        )
+
+    async def _embed(self, texts: list[str]) -> np.ndarray:
+        async with self._call():
+            if self._pool is None or sum(map(len, texts)) <= self.chunk_chars:
+                return embed_texts(texts, self.dimensions)
+
+            # The processes bound how many chunks are embedded at once
+            loop = asyncio.get_running_loop()
+            chunks = _chunks_by_characters(texts, self.chunk_chars)
+            embedded = await asyncio.gather(
+                *(loop.run_in_executor(self._pool, embed_texts, chunk, self.dimensions) for chunk in chunks)
+            )
+            return np.concatenate(embedded)
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+def create_embedding_provider(name: str = EMBEDDING_PROVIDER) -> EmbeddingProvider:
+    if name == "openai":
+        api_key = get_setting("OPENAI_API_KEY", "")
+        return OpenAIEmbeddingProvider(api_key, base_url=get_setting("OPENAI_BASE_URL", "") or None)
+    if name == "local":
+        return LocalEmbeddingProvider()
+    raise ValueError(f"Unknown EMBEDDING_PROVIDER {name!r}")
+
+
+_provider: EmbeddingProvider | None = None
+
+
+def get_embedding_provider() -> EmbeddingProvider:
+    global _provider
+    if _provider is None:
+        _provider = create_embedding_provider()
+    return _provider
+
+
+async def close_embedding_provider() -> None:
+    global _provider
+    if _provider is not None:
+        provider, _provider = _provider, None
+        await provider.close()
+
+
+# The first tier of the embedding cache. The second is the embedding_cache table, shared by every worker.
+# Embeddings are kept as float32 arrays, 4 bytes per dimension.
+_cached_embeddings: TTLCache[bytes, np.ndarray] = TTLCache(
+    max_size=int(get_setting("EMBEDDING_CACHE_SIZE", 4096)),
+    ttl=float(get_setting("EMBEDDING_CACHE_TTL", 86400)),
+)
+_database_hits = 0
+_database_misses = 0
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes text that embeds the same: Unicode normalization and collapsed whitespace.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_cache_key(model: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode()).digest()
+
+
+async def generate_embeddings(texts: list[str], cache: bool = True) -> list[np.ndarray]:
+    """
+    Returns one embedding per text, from the in-process cache, then the embedding_cache table, and only then the
+    provider, which is asked for every remaining text in one call. Without `cache`, e.g. for text embedded once and
+    stored elsewhere, neither cache is read or filled, so it can't evict the embeddings that are asked for again.
+    """
+    global _database_hits, _database_misses
+
+    provider = get_embedding_provider()
+    keys = [embedding_cache_key(provider.model, text) for text in texts]
+    found = {key: embedding for key in keys if cache and (embedding := _cached_embeddings.get(key)) is not None}
+
+    missing = [key for key in dict.fromkeys(keys) if key not in found] if cache else []
+    if missing:
+        stored = await get_cached_embeddings(missing)
+        _database_hits += len(stored)
+        _database_misses += len(missing) - len(stored)
+        found.update(stored)
+
+    # The provider embeds the normalized text, so an embedding only depends on its key
+    texts_by_key = {key: normalize_text(text) for key, text in zip(keys, texts, strict=True) if key not in found}
+    if texts_by_key:
+        embedded = await provider.embed(list(texts_by_key.values()))
+        if any(len(embedding) != EMBEDDING_DIMENSIONS for embedding in embedded):
+            raise ValueError(f"{provider.model} embeddings don't have EMBEDDING_DIMENSIONS ({EMBEDDING_DIMENSIONS})")
+        created = {
+            key: np.asarray(embedding, dtype=np.float32)
+            for key, embedding in zip(texts_by_key, embedded, strict=True)
+        }
+        if cache:
+            await cache_embeddings(provider.model, created)
+        found.update(created)
+
+    for key in missing:
+        _cached_embeddings.set(key, found[key])
+    return [found[key] for key in keys]
+
+
+def client_embedding(values: list[float] | None, encoded: str | None, model: str | None) -> np.ndarray | None:
+    """
+    Validates an embedding the client computed itself, sent as a list of floats or, more compactly, as base64 of
+    little-endian float32s. It must be tagged with the model this server embeds with, or it couldn't be compared with
+    the stored embeddings. Returns None if the client didn't send one.
+    """
+    if values is None and encoded is None:
+        return None
+    if values is not None and encoded is not None:
+        raise ValueError("Send either embedding or embeddingBase64, not both")
+
+    expected = get_embedding_provider().model
+    if model != expected:
+        raise ValueError(f"embeddingModel must be {expected!r}, the model this server embeds with")
+
+    if encoded is not None:
+        try:
+            packed = base64.b64decode(encoded, validate=True)
+        except binascii.Error as e:
+            raise ValueError("embeddingBase64 is not valid base64") from e
+        if len(packed) % 4:
+            raise ValueError("embeddingBase64 must encode float32 values")
+        embedding = np.frombuffer(packed, dtype="<f4").astype(np.float32)
+    else:
+        embedding = np.asarray(values, dtype=np.float32)
+
+    if embedding.shape != (EMBEDDING_DIMENSIONS,):
+        raise ValueError(f"Embeddings must have {EMBEDDING_DIMENSIONS} dimensions, not {embedding.size}")
+    if not np.isfinite(embedding).all():
+        raise ValueError("Embeddings must be finite")
+    return embedding
 
 
-def generate_openai_embedding(text: str, model: str = "text-embedding-ada-002") -> list[float]:
-    # Ensure the input text is within the token limit for the model
-    if not text or not isinstance(text, str):
-        raise ValueError("Input text must be a non-empty string.")
+async def generate_embedding(text: str) -> np.ndarray:
+    (embedding,) = await generate_embeddings([text])
+    return embedding
 
-    api_key = get_setting("OPENAI_API_KEY", "")
-    client = OpenAI(api_key=api_key)
 
-    response = client.embeddings.create(model=model, input=text)
-    return response.data[0].embedding
+def embedding_stats() -> dict[str, float | dict[str, float]]:
+    provider_stats = _provider.stats() if _provider is not None else {"calls": 0, "errors": 0, "mean_ms": 0.0}
+    return {
+        **provider_stats,
+        "cache": _cached_embeddings.stats(),
+        "database_cache": {"hits": _database_hits, "misses": _database_misses},
+    }
@@ -0,0 +1,51 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+
+def parse_timestamp(value: str) -> datetime:
+    """
+    Parses an ISO 8601 timestamp. Timestamps without an offset are taken to be UTC.
+    """
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError as e:
+        raise ValueError(f"Invalid timestamp: {value!r}") from e
+
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=timezone.utc)
+
+
+def contains_pattern(value: str) -> str:
+    """
+    Returns a LIKE pattern matching strings that contain `value` literally.
+    """
+    escaped = value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+@dataclass(frozen=True)
+class Filter:
+    """
+    A SQL condition for one GraphQL filter field. `{}` in `condition` is replaced by the parameter's number.
+    """
+
+    condition: str
+    convert: Callable[[Any], Any] = lambda value: value
+
+
+def select_filters(available: dict[str, Filter], filters: dict | None) -> tuple[tuple[str, ...], list]:
+    """
+    Returns the names of the fields set in `filters`, which identify the statement's shape, and their arguments.
+    """
+    filters = filters or {}
+    names = tuple(name for name in available if filters.get(name) is not None)
+    return names, [available[name].convert(filters[name]) for name in names]
+
+
+def filter_conditions(available: dict[str, Filter], names: tuple[str, ...], first_param: int) -> str:
+    """
+    Renders the named filters as AND-ed conditions with parameters numbered from `first_param`.
+    """
+    return "".join(
+        f"\n      AND {available[name].condition.format(param)}" for param, name in enumerate(names, first_param)
+    )
@@ -0,0 +1,81 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from bcrypt import checkpw, gensalt, hashpw
+
+from aeris.env import get_setting
+
+T = TypeVar("T")
+
+# bcrypt releases the GIL while hashing, so a small thread pool keeps it off the event loop without the cost of
+# shipping work to other processes.
+HASH_POOL_SIZE = int(get_setting("HASH_POOL_SIZE", min(4, os.cpu_count() or 1)))
+# Hash operations waiting for a free thread beyond this are rejected instead of queued
+HASH_MAX_QUEUE = int(get_setting("HASH_MAX_QUEUE", 64))
+# Seconds a client turned away because the queue was full is asked to wait before retrying
+HASH_RETRY_AFTER = int(get_setting("HASH_RETRY_AFTER", 1))
+
+_executor = ThreadPoolExecutor(max_workers=HASH_POOL_SIZE, thread_name_prefix="aeris-hash")
+_slots = asyncio.Semaphore(HASH_POOL_SIZE)
+_stats = {"queued": 0, "running": 0, "completed": 0, "rejected": 0}
+
+
+class HashingBusyError(Exception):
+    """
+    Raised when too many hash operations are already waiting for the pool. This is overload rather than a bad key, so
+    it isn't a ValueError, and is answered with a 503.
+    """
+
+    retry_after = HASH_RETRY_AFTER
+
+    def __init__(self):
+        super().__init__("Too many pending API key checks, try again later")
+
+
+async def _run(fn: Callable[..., T], *args) -> T:
+    if _stats["queued"] >= HASH_MAX_QUEUE:
+        _stats["rejected"] += 1
+        raise HashingBusyError()
+
+    _stats["queued"] += 1
+    try:
+        await _slots.acquire()
+    finally:
+        _stats["queued"] -= 1
+
+    _stats["running"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    finally:
+        _stats["running"] -= 1
+        _stats["completed"] += 1
+        _slots.release()
+
+
+async def hash_secret(secret: str, salt: bytes | None = None) -> str:
+    hashed = await _run(hashpw, secret.encode(), salt or gensalt())
+    return hashed.decode()
+
+
+async def check_secret(secret: str, hashed: str) -> bool:
+    return await _run(checkpw, secret.encode(), hashed.encode())
+
+
+def hashing_stats() -> dict[str, int]:
+    """
+    Returns the hash pool's queue depth, in-flight operations and counters.
+    """
+    return {
+        "queue_depth": _stats["queued"],
+        "running": _stats["running"],
+        "completed": _stats["completed"],
+        "rejected": _stats["rejected"],
+        "pool_size": HASH_POOL_SIZE,
+        "max_queue": HASH_MAX_QUEUE,
+    }
+
+
+def shutdown_hashing() -> None:
+    _executor.shutdown(wait=False, cancel_futures=True)
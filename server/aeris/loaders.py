@@ -0,0 +1,86 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, Hashable, TypeVar
+from uuid import UUID
+
+from asyncpg import Record
+
+from aeris.data.task import get_embeddings_for_tasks, get_events_for_tasks, get_metadata_for_tasks
+from aeris.pagination import Page
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class DataLoader(Generic[K, V]):
+    """
+    Collects the keys loaded in one pass of the event loop and fetches them with a single call to `batch_load`,
+    which returns a value for every key it's given. Results are kept for the loader's lifetime, so loaders are
+    created per request.
+    """
+
+    def __init__(self, batch_load: Callable[[list[K]], Awaitable[dict[K, V]]]):
+        self.batch_load = batch_load
+        self._results: dict[K, asyncio.Future[V]] = {}
+        self._queue: list[K] = []
+
+    def load(self, key: K) -> Awaitable[V]:
+        if key not in self._results:
+            loop = asyncio.get_running_loop()
+            if not self._queue:
+                # Resolvers for sibling fields are started together, so by the time this runs they've all queued
+                loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+            self._queue.append(key)
+            self._results[key] = loop.create_future()
+        return self._results[key]
+
+    async def _dispatch(self) -> None:
+        keys, self._queue = self._queue, []
+        try:
+            values = await self.batch_load(keys)
+        except Exception as e:
+            for key in keys:
+                self._results.pop(key).set_exception(e)
+            return
+
+        for key in keys:
+            self._results[key].set_result(values[key])
+
+
+class Loaders:
+    """
+    The per-request loaders for fields resolved once per task.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.metadata: DataLoader[UUID, list[Record]] = DataLoader(self._load_metadata)
+        self._embeddings: dict[bool, DataLoader[UUID, list[Record]]] = {}
+        self._events: dict[tuple, DataLoader[UUID, list[Record]]] = {}
+
+    def embeddings(self, vectors: bool) -> DataLoader[UUID, list[Record]]:
+        """
+        Returns the embeddings loader for tasks whose embeddings are selected with or without their vectors.
+        """
+        if vectors not in self._embeddings:
+
+            async def load_embeddings(task_uuids: list[UUID]) -> dict[UUID, list[Record]]:
+                return await get_embeddings_for_tasks(task_uuids, self.user_id, vectors)
+
+            self._embeddings[vectors] = DataLoader(load_embeddings)
+        return self._embeddings[vectors]
+
+    def events(self, page: Page, filters: dict | None) -> DataLoader[UUID, list[Record]]:
+        """
+        Returns the events loader for tasks sharing these pagination and filter arguments.
+        """
+        key = (page, tuple(sorted((filters or {}).items())))
+        if key not in self._events:
+
+            async def load_events(task_uuids: list[UUID]) -> dict[UUID, list[Record]]:
+                return await get_events_for_tasks(task_uuids, self.user_id, page, filters)
+
+            self._events[key] = DataLoader(load_events)
+        return self._events[key]
+
+    async def _load_metadata(self, task_uuids: list[UUID]) -> dict[UUID, list[Record]]:
+        return await get_metadata_for_tasks(task_uuids, self.user_id)
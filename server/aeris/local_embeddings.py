@@ -0,0 +1,81 @@
+import hashlib
+import re
+from functools import lru_cache
+
+import numpy as np
+
+# Runs in the local embedding provider's worker processes too, so it imports nothing from aeris, which keeps
+# starting them cheap.
+
+# Words, and punctuation as tokens of its own so text without words still embeds to something
+TOKEN = re.compile(r"\w+|[^\w\s]")
+
+# How much each kind of feature counts. Character trigrams match inflections and typos, but there are many per word,
+# so each counts for less.
+WORD_WEIGHT = 1.0
+BIGRAM_WEIGHT = 1.0
+TRIGRAM_WEIGHT = 0.25
+
+
+def _hash(feature: str) -> int:
+    # Python's hash() is salted per process, which would make embeddings differ between workers and restarts
+    return int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+
+
+@lru_cache(maxsize=2**16)
+def _word_features(word: str) -> tuple[tuple[int, ...], tuple[float, ...]]:
+    padded = f"<{word}>"
+    trigrams = [_hash(f"c:{padded[i:i + 3]}") for i in range(len(padded) - 2)]
+    return (_hash(f"w:{word}"), *trigrams), (WORD_WEIGHT, *[TRIGRAM_WEIGHT] * len(trigrams))
+
+
+def _features(text: str) -> tuple[list[int], list[float]]:
+    words = TOKEN.findall(text.lower())
+    hashes = [_hash(f"b:{first} {second}") for first, second in zip(words, words[1:], strict=False)]
+    weights = [BIGRAM_WEIGHT] * len(hashes)
+    for word in words:
+        word_hashes, word_weights = _word_features(word)
+        hashes += word_hashes
+        weights += word_weights
+    return hashes, weights
+
+
+def embed_texts(texts: list[str], dimensions: int) -> np.ndarray:
+    """
+    Embeds texts by feature hashing: each word, word pair and character trigram is hashed to one of `dimensions`
+    buckets, with a hashed sign so collisions tend to cancel out, and weighted by its sublinear term frequency.
+    Rows are L2-normalized, so texts sharing more features are closer by any metric. The same text always gets the
+    same embedding.
+
+    There is no IDF weighting, which needs document frequencies from a corpus, and would change every embedding as
+    the corpus grows.
+    """
+    text_rows: list[int] = []
+    text_hashes: list[int] = []
+    text_weights: list[float] = []
+    for row, text in enumerate(texts):
+        hashes, weights = _features(text)
+        text_rows += [row] * len(hashes)
+        text_hashes += hashes
+        text_weights += weights
+
+    matrix = np.zeros((len(texts), dimensions), dtype=np.float64)
+    if text_hashes:
+        # Group each text's occurrences of a feature, to count them
+        order = np.lexsort((np.array(text_hashes, dtype=np.uint64), np.array(text_rows, dtype=np.int64)))
+        sorted_rows = np.array(text_rows, dtype=np.int64)[order]
+        sorted_hashes = np.array(text_hashes, dtype=np.uint64)[order]
+        first = np.flatnonzero(
+            np.r_[True, (sorted_rows[1:] != sorted_rows[:-1]) | (sorted_hashes[1:] != sorted_hashes[:-1])]
+        )
+        counts = np.diff(np.r_[first, len(order)])
+        feature_rows, feature_hashes = sorted_rows[first], sorted_hashes[first]
+
+        values = (1 + np.log(counts)) * np.array(text_weights)[order[first]]
+        values[feature_hashes >> np.uint64(63) == 1] *= -1
+        cells = feature_rows * dimensions + (feature_hashes % np.uint64(dimensions)).astype(np.int64)
+        summed: np.ndarray = np.bincount(cells, weights=values, minlength=len(texts) * dimensions)
+        matrix = summed.reshape(len(texts), dimensions)
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.where(norms == 0, 1, norms)).astype(np.float32)
@@ -1,17 +1,39 @@
+import logging
+import secrets
+from contextlib import asynccontextmanager
+
 from ariadne import load_schema_from_path, make_executable_schema
 from ariadne.asgi import GraphQL
 from ariadne.asgi.handlers import GraphQLHTTPHandler
 from fastapi.responses import JSONResponse
 from graphql import GraphQLError
+from starlette.applications import Starlette
 from starlette.requests import Request
 from starlette.responses import Response
-
-from aeris.api_key import verify_api_key
+from starlette.routing import Mount, Route
+
+from aeris.api_key import api_key_cache_stats, start_revocation_listener, stop_revocation_listener, verify_api_key
+from aeris.db import DB, UnitOfWork, close_db_pool, init_db_pool
+from aeris.embedding_worker import embedding_worker_stats, start_embedding_worker, stop_embedding_worker
+from aeris.embeddings import close_embedding_provider, embedding_stats
+from aeris.env import get_setting
+from aeris.hashing import HashingBusyError, hashing_stats, shutdown_hashing
+from aeris.loaders import Loaders
+from aeris.project_index import project_index_stats, start_project_index, stop_project_index
 from aeris.resolvers.mutations import mutation
 from aeris.resolvers.queries import query
 from aeris.resolvers.types import event, project, task, user
+from aeris.similarity_cache import similarity_cache_stats, start_similarity_cache, stop_similarity_cache
+from aeris.statements import statement_stats
 
 type_defs = load_schema_from_path("aeris/schemas/schema.graphql")
+logger = logging.getLogger(__name__)
+
+# Set once the lifespan handler has finished warming up, cleared again on shutdown
+_ready = False
+
+# Bearer token that /metrics requires. The endpoint is disabled while this is unset.
+METRICS_TOKEN = get_setting("METRICS_TOKEN", "")
 
 
 class AuthenticationError(GraphQLError):
@@ -58,6 +80,7 @@ async def get_context_value(request: Request, _):
         "request": request,
         "project_id": verification["project_id"],
         "user_id": verification["user_id"],
+        "loaders": Loaders(verification["user_id"]),
     }
 
 
@@ -76,6 +99,22 @@ class CustomGraphQL(GraphQL):
 
 
 class ContextErrorHandler(GraphQLHTTPHandler):
+    async def execute_graphql_query(self, request, data, *, context_value=None, query_document=None):
+        # Authenticate before the unit of work, so a key check waiting on the hash pool doesn't hold its connection.
+        # The key lookup takes a pooled connection of its own and releases it before hashing.
+        if context_value is None:
+            context_value = await self.get_context_for_request(request, data)
+
+        # Every operation uses one connection and commits its writes atomically
+        async with UnitOfWork() as unit_of_work:
+            context_value["unit_of_work"] = unit_of_work
+            success, result = await super().execute_graphql_query(
+                request, data, context_value=context_value, query_document=query_document
+            )
+            if not success:
+                unit_of_work.failed = True
+            return success, result
+
     async def graphql_http_server(self, request: Request) -> Response:
         try:
             return await super().graphql_http_server(request)
@@ -90,11 +129,83 @@ class ContextErrorHandler(GraphQLHTTPHandler):
                 status_code=e.status_code,
             )
 
+        except HashingBusyError as e:
+            return JSONResponse(
+                {"errors": [{"message": str(e), "extensions": {"code": "SERVICE_UNAVAILABLE", "status_code": 503}}]},
+                status_code=503,
+                headers={"Retry-After": str(e.retry_after)},
+            )
+
 
 schema = make_executable_schema(type_defs, query, mutation, project, task, event, user)
 
 
-# ASGI app
-app = CustomGraphQL(
+graphql_app = CustomGraphQL(
     schema, error_formatter=custom_error_formatter, context_value=get_context_value, http_handler=ContextErrorHandler()
 )
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Opens and warms the database pool before the first request is served, and drains it on shutdown.
+    """
+    global _ready
+
+    # Opening the pool connects DB_POOL_MIN_SIZE connections, each registering codecs and preparing hot statements
+    await init_db_pool()
+    async with DB() as conn:
+        await conn.execute("SELECT 1")
+    await start_revocation_listener()
+    await start_embedding_worker()
+    await start_project_index()
+    await start_similarity_cache()
+    _ready = True
+    logger.info("Aeris is ready")
+
+    try:
+        yield
+    finally:
+        _ready = False
+        await stop_similarity_cache()
+        await stop_project_index()
+        await stop_embedding_worker()
+        await stop_revocation_listener()
+        await close_db_pool()
+        await close_embedding_provider()
+        shutdown_hashing()
+
+
+async def readiness(request: Request) -> Response:
+    if not _ready:
+        return JSONResponse({"status": "starting"}, status_code=503)
+    return JSONResponse({"status": "ready"})
+
+
+async def metrics(request: Request) -> Response:
+    """
+    Reports this worker's in-process metrics to callers presenting METRICS_TOKEN.
+    """
+    if not METRICS_TOKEN:
+        return JSONResponse({"error": "Metrics are disabled"}, status_code=404)
+    auth_header = request.headers.get("Authorization", "")
+    if not secrets.compare_digest(auth_header.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    return JSONResponse(
+        {
+            "statements": statement_stats(),
+            "hashing": hashing_stats(),
+            "api_key_cache": api_key_cache_stats(),
+            "embeddings": embedding_stats(),
+            "embedding_worker": embedding_worker_stats(),
+            "project_index": project_index_stats(),
+            "similarity_cache": similarity_cache_stats(),
+        }
+    )
+
+
+# ASGI app
+app = Starlette(
+    routes=[Route("/ready", readiness), Route("/metrics", metrics), Mount("/", app=graphql_app)], lifespan=lifespan
+)
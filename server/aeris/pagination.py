@@ -0,0 +1,89 @@
+import base64
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+from asyncpg import Record
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Keyset bounds used when a page has no after/before cursor, so the same statement (and index range scan) serves
+# every page
+_LOWEST_KEY = (datetime.min.replace(tzinfo=timezone.utc), 0)
+_HIGHEST_KEY = (datetime.max.replace(tzinfo=timezone.utc), 2**31 - 1)
+
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(id)
+    except ValueError as e:
+        raise ValueError("Invalid cursor") from e
+
+
+@dataclass(frozen=True)
+class Page:
+    """
+    A Relay page request over rows ordered by (created_at, id).
+    """
+
+    limit: int = DEFAULT_PAGE_SIZE
+    after: tuple[datetime, int] | None = None
+    before: tuple[datetime, int] | None = None
+    backward: bool = False
+
+    @classmethod
+    def from_input(cls, pagination: dict | None) -> "Page":
+        """
+        Builds a page from a PaginationInput. `last` pages backwards from `before` (or the end).
+        """
+        pagination = pagination or {}
+        first, last = pagination.get("first"), pagination.get("last")
+        if first is not None and last is not None:
+            raise ValueError("Pass either first or last, not both")
+
+        limit = first if last is None else last
+        if limit is None:
+            limit = DEFAULT_PAGE_SIZE
+        if limit < 0:
+            raise ValueError("first and last must not be negative")
+
+        after, before = pagination.get("after"), pagination.get("before")
+        return cls(
+            limit=min(limit, MAX_PAGE_SIZE),
+            after=decode_cursor(after) if after else None,
+            before=decode_cursor(before) if before else None,
+            backward=last is not None,
+        )
+
+    def bounds(self) -> tuple[datetime, int, datetime, int]:
+        """
+        Returns the exclusive (created_at, id) bounds as statement parameters.
+        """
+        return (*(self.after or _LOWEST_KEY), *(self.before or _HIGHEST_KEY))
+
+
+def paginate(rows: list[Record], page: Page, decorate: Callable[[Record], Any]) -> dict:
+    """
+    Builds a Relay connection from rows fetched with `page.limit + 1` as their limit, in the page's direction.
+    """
+    has_more = len(rows) > page.limit
+    rows = rows[: page.limit]
+    if page.backward:
+        rows = rows[::-1]
+
+    edges = [{"cursor": encode_cursor(row["created_at"], row["id"]), "node": decorate(row)} for row in rows]
+    return {
+        "edges": edges,
+        "pageInfo": {
+            "hasNextPage": has_more if not page.backward else page.before is not None,
+            "hasPreviousPage": has_more if page.backward else page.after is not None,
+            "startCursor": edges[0]["cursor"] if edges else None,
+            "endCursor": edges[-1]["cursor"] if edges else None,
+        },
+    }
@@ -0,0 +1,424 @@
+import asyncio
+import contextvars
+import logging
+from collections import OrderedDict
+from typing import Sequence
+from uuid import UUID
+
+import numpy as np
+from asyncpg import Connection, Record
+
+from aeris.data.embedding_cache import as_array
+from aeris.data.task import (
+    CHUNK_AGGREGATION_TOP_K,
+    LARGE_TASK_COLUMNS,
+    MAX_SIMILAR_TASKS,
+    get_project_embeddings,
+    get_project_id,
+    get_searchable_task_embeddings,
+    get_searchable_tasks_by_id,
+)
+from aeris.db import create_listener
+from aeris.env import get_setting
+from aeris.vector_index import EMBEDDING_DIMENSIONS, vector_distances
+
+logger = logging.getLogger(__name__)
+
+# Serves findSimilarTasks in a project from this process's memory instead of Postgres's vector index, for projects
+# searched so often that the round trip dominates. Each worker loads a project's embeddings on its first search and
+# keeps them current from the task_vectors_changed notifications, see db.TASK_VECTORS_CHANGED. The search is exact.
+PROJECT_INDEX_ENABLED = get_setting("PROJECT_INDEX_ENABLED", "false").lower() == "true"
+# Memory for every project index in this worker. The least recently searched projects are dropped to stay within it,
+# and a project that doesn't fit on its own is searched in Postgres.
+PROJECT_INDEX_MEMORY_MB = float(get_setting("PROJECT_INDEX_MEMORY_MB", 256))
+# Searching in memory compares the query with every embedding, which takes longer as a project grows than the vector
+# index does. Projects with more embeddings are searched in Postgres, see scripts/bench_project_index.py.
+PROJECT_INDEX_MAX_EMBEDDINGS = int(get_setting("PROJECT_INDEX_MAX_EMBEDDINGS", 4000))
+
+TASK_VECTORS_CHANGED_CHANNEL = "task_vectors_changed"
+
+
+class ProjectIndex:
+    """
+    The embeddings of one project's finished tasks, as the rows of a float32 matrix, with each row's task id. Rows
+    past `size` are spare capacity, so adding embeddings rarely copies the matrix.
+    """
+
+    def __init__(self, project_uuid: UUID, project_id: int, task_ids: np.ndarray, vectors: np.ndarray):
+        self.project_uuid = project_uuid
+        self.project_id = project_id
+        self.size = len(task_ids)
+        self.task_ids = np.array(task_ids, dtype=np.int64)
+        self.vectors = np.array(vectors, dtype=np.float32).reshape(self.size, EMBEDDING_DIMENSIONS)
+        # Squared norms, which turn the dot products into l2 and cosine distances
+        self.norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+
+    @property
+    def nbytes(self) -> int:
+        return self.task_ids.nbytes + self.vectors.nbytes + self.norms.nbytes
+
+    def add(self, task_ids: np.ndarray, vectors: np.ndarray) -> None:
+        end = self.size + len(task_ids)
+        if end > len(self.task_ids):
+            self._resize(max(end, len(self.task_ids) * 5 // 4 + 16))
+        added = self.vectors[self.size : end]
+        added[:] = vectors
+        self.task_ids[self.size : end] = task_ids
+        self.norms[self.size : end] = np.einsum("ij,ij->i", added, added)
+        self.size = end
+
+    def _resize(self, capacity: int) -> None:
+        for name in ("task_ids", "vectors", "norms"):
+            current = getattr(self, name)
+            resized = np.zeros((capacity, *current.shape[1:]), dtype=current.dtype)
+            resized[: self.size] = current[: self.size]
+            setattr(self, name, resized)
+
+    def remove(self, task_id: int) -> None:
+        # Each removed row is filled with the last row. Going backwards, the last row is never one still to remove.
+        for row in np.flatnonzero(self.task_ids[: self.size] == task_id)[::-1]:
+            last = self.size - 1
+            self.task_ids[row], self.norms[row] = self.task_ids[last], self.norms[last]
+            self.vectors[row] = self.vectors[last]
+            self.size = last
+
+    def search(self, query: np.ndarray, k: int, max_distance: float) -> list[tuple[int, float]]:
+        """
+        Returns up to `k` (task id, distance) pairs for the tasks whose nearest embedding is closer than
+        `max_distance`, nearest first.
+        """
+        distances = vector_distances(self.vectors[: self.size], query, self.norms[: self.size])
+        within = np.flatnonzero(distances < max_distance)
+
+        # Sort only the nearest rows, and more of them if some tasks have several among them
+        limit = k
+        while True:
+            nearest = within if len(within) <= limit else within[np.argpartition(distances[within], limit)[:limit]]
+            nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+            # The first occurrence of each task is its nearest embedding
+            task_ids, first = np.unique(self.task_ids[nearest], return_index=True)
+            if len(task_ids) >= k or len(nearest) == len(within):
+                break
+            limit *= 4
+
+        order = np.argsort(first)[:k]
+        return list(zip(task_ids[order].tolist(), distances[nearest[first[order]]].tolist(), strict=True))
+
+    def search_sum(
+        self, query: np.ndarray, k: int, max_distance: float, top_k: int = CHUNK_AGGREGATION_TOP_K
+    ) -> list[tuple[int, float, float]]:
+        """
+        Like search(), but ranks tasks by the sum of 1 - distance over their `top_k` nearest embeddings closer than
+        `max_distance`, as data.task does for SUM aggregation. Returns (task id, nearest distance, score) triples.
+        """
+        distances = vector_distances(self.vectors[: self.size], query, self.norms[: self.size])
+        within = np.flatnonzero(distances < max_distance)
+        task_ids, distances = self.task_ids[within], distances[within]
+
+        # Group each task's rows, nearest first, and number them within the group
+        order = np.lexsort((distances, task_ids))
+        task_ids, distances = task_ids[order], distances[order]
+        starts = np.flatnonzero(np.r_[True, task_ids[1:] != task_ids[:-1]]) if len(task_ids) else np.zeros(0, int)
+        groups = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(task_ids)]))
+        top = np.arange(len(task_ids)) - starts[groups] < top_k
+
+        scores = np.bincount(groups[top], weights=1 - distances[top], minlength=len(starts))
+        nearest = distances[starts]
+        best = np.lexsort((nearest, -scores))[:k]
+        return list(zip(task_ids[starts[best]].tolist(), nearest[best].tolist(), scores[best].tolist(), strict=True))
+
+
+# Least recently searched first
+_indexes: OrderedDict[int, ProjectIndex] = OrderedDict()
+_project_ids: dict[UUID, int] = {}
+# The project of every indexed task
+_task_projects: dict[int, int] = {}
+# Projects with too many embeddings, or that didn't fit within the memory budget, when last loaded
+_too_large: set[UUID] = set()
+# Held while loading each project, with how many searches hold or wait for it, so it's dropped after the last one
+_load_locks: dict[int, tuple[asyncio.Lock, int]] = {}
+# Tasks that changed while each project was loading, which may or may not be in what was loaded
+_changed_while_loading: dict[int, set[int]] = {}
+# Bumped whenever the indexes are dropped, so a load that raced with it isn't kept
+_generation = 0
+
+_listener: Connection | None = None
+_listener_lock = asyncio.Lock()
+_pending: set[int] = set()
+_updater: asyncio.Task | None = None
+
+_searches = 0
+_fallbacks = 0
+_loads = 0
+_evictions = 0
+_updates = 0
+
+
+def _memory() -> int:
+    return sum(index.nbytes for index in _indexes.values())
+
+
+def _forget(index: ProjectIndex) -> None:
+    for task_id in np.unique(index.task_ids[: index.size]).tolist():
+        _task_projects.pop(task_id, None)
+    _project_ids.pop(index.project_uuid, None)
+
+
+def _evict() -> None:
+    global _evictions
+    budget = PROJECT_INDEX_MEMORY_MB * 2**20
+    while _indexes and _memory() > budget:
+        _, index = _indexes.popitem(last=False)
+        _forget(index)
+        _evictions += 1
+        if index.nbytes > budget:
+            _too_large.add(index.project_uuid)
+
+
+def _clear() -> None:
+    global _generation
+    _generation += 1
+    _indexes.clear()
+    _project_ids.clear()
+    _task_projects.clear()
+    _too_large.clear()
+    _pending.clear()
+
+
+def _vectors(rows: list[Record]) -> np.ndarray:
+    if not rows:
+        return np.zeros((0, EMBEDDING_DIMENSIONS), dtype=np.float32)
+    return np.stack([as_array(row["embedding"]) for row in rows])
+
+
+def _update(indexes: dict[int, ProjectIndex], task_ids: list[int], rows: list[Record]) -> None:
+    """
+    Replaces the embeddings of `task_ids` in `indexes`, the indexes loaded when `rows` were read, with `rows`.
+    """
+    for task_id in task_ids:
+        project_id = _task_projects.get(task_id)
+        if project_id is not None and project_id in indexes and _indexes.get(project_id) is indexes[project_id]:
+            indexes[project_id].remove(task_id)
+            del _task_projects[task_id]
+
+    by_project: dict[int, list[Record]] = {}
+    for row in rows:
+        by_project.setdefault(row["project_id"], []).append(row)
+    for project_id, project_rows in by_project.items():
+        index = indexes[project_id]
+        if _indexes.get(project_id) is index:
+            index.add(np.array([row["task_id"] for row in project_rows]), _vectors(project_rows))
+            _task_projects.update((row["task_id"], project_id) for row in project_rows)
+            if index.size > PROJECT_INDEX_MAX_EMBEDDINGS:
+                del _indexes[project_id]
+                _forget(index)
+                _too_large.add(index.project_uuid)
+    _evict()
+
+
+async def _update_pending() -> None:
+    global _updates
+    # One update at a time, so an older read never overwrites a newer one
+    while _pending:
+        task_ids = list(_pending)
+        _pending.clear()
+        indexes = dict(_indexes)
+        try:
+            rows = await get_searchable_task_embeddings(task_ids, list(indexes))
+        except Exception:
+            logger.exception("Could not update the project indexes, dropping them")
+            _clear()
+            return
+        _update(indexes, task_ids, rows)
+        _updates += 1
+
+
+def _schedule_update(task_ids: set[int]) -> None:
+    global _updater
+    _pending.update(task_ids)
+    if _updater is None or _updater.done():
+        # Outside the context of the request that started the listener, whose unit of work may be over
+        _updater = contextvars.Context().run(asyncio.create_task, _update_pending())
+
+
+def _on_task_vectors_changed(connection, pid, channel, payload) -> None:
+    if payload == "*":
+        _clear()
+        return
+
+    # The payload is each task's id and its project's uuid
+    task_ids = {int(changed.partition(":")[0]) for changed in payload.split(",")}
+    for changed in _changed_while_loading.values():
+        changed.update(task_ids)
+    if _indexes:
+        _schedule_update(task_ids)
+
+
+def _on_listener_closed(connection) -> None:
+    global _listener
+    logger.warning("Project index listener disconnected, dropping the project indexes")
+    _listener = None
+    _clear()
+
+
+async def start_project_index() -> bool:
+    """
+    Starts listening for changed embeddings if this worker isn't already. Returns whether the listener is running,
+    without which the indexes can't be kept current and aren't used.
+    """
+    global _listener
+    if not PROJECT_INDEX_ENABLED:
+        return False
+    if _listener is not None:
+        return True
+
+    async with _listener_lock:
+        if _listener is None:
+            try:
+                _listener = await create_listener(
+                    TASK_VECTORS_CHANGED_CHANNEL, _on_task_vectors_changed, _on_listener_closed
+                )
+            except Exception:
+                logger.exception("Could not start the project index listener, searching in Postgres")
+                return False
+
+    return True
+
+
+async def stop_project_index() -> None:
+    global _listener, _updater
+    if _updater is not None:
+        updater, _updater = _updater, None
+        updater.cancel()
+        try:
+            await updater
+        except asyncio.CancelledError:
+            pass
+
+    if _listener is not None:
+        listener, _listener = _listener, None
+        await listener.close()
+    _clear()
+
+
+async def _load(project_uuid: UUID, project_id: int) -> ProjectIndex | None:
+    global _loads
+    generation = _generation
+    _changed_while_loading[project_id] = changed = set[int]()
+    try:
+        rows = await get_project_embeddings(project_id, PROJECT_INDEX_MAX_EMBEDDINGS + 1)
+    finally:
+        del _changed_while_loading[project_id]
+
+    if generation != _generation:
+        return None
+    if len(rows) > PROJECT_INDEX_MAX_EMBEDDINGS:
+        logger.info("Project %s has too many embeddings to search in memory", project_uuid)
+        _too_large.add(project_uuid)
+        return None
+
+    index = ProjectIndex(project_uuid, project_id, np.array([row["task_id"] for row in rows]), _vectors(rows))
+    _loads += 1
+    if index.nbytes > PROJECT_INDEX_MEMORY_MB * 2**20:
+        logger.info("Project %s doesn't fit in PROJECT_INDEX_MEMORY_MB, searching it in Postgres", project_uuid)
+        _too_large.add(project_uuid)
+        return None
+
+    _indexes[project_id] = index
+    _project_ids[project_uuid] = project_id
+    _task_projects.update((task_id, project_id) for task_id in np.unique(index.task_ids[: index.size]).tolist())
+    _evict()
+    if changed:
+        _schedule_update(changed)
+    return index
+
+
+async def _project_index(project_uuid: UUID, user_id: int) -> ProjectIndex | None:
+    # A loaded project's results are limited to the user's tasks like any other
+    project_id = _project_ids.get(project_uuid)
+    if project_id is not None and (index := _indexes.get(project_id)) is not None:
+        _indexes.move_to_end(project_id)
+        return index
+
+    # Only the project's members load it, so nobody else can fill the memory budget or evict other projects
+    if project_uuid in _too_large:
+        return None
+    project_id = await get_project_id(project_uuid, user_id)
+    if project_id is None:
+        return None
+
+    # Concurrent first searches of a project load it once
+    lock, holders = _load_locks.get(project_id, (asyncio.Lock(), 0))
+    _load_locks[project_id] = lock, holders + 1
+    try:
+        async with lock:
+            if (index := _indexes.get(project_id)) is not None:
+                _indexes.move_to_end(project_id)
+                return index
+            if project_uuid in _too_large:
+                return None
+            return await _load(project_uuid, project_id)
+    finally:
+        lock, holders = _load_locks.pop(project_id)
+        if holders > 1:
+            _load_locks[project_id] = lock, holders - 1
+
+
+async def search_project_index(
+    project_uuid: UUID | str,
+    embeddings: list[np.ndarray],
+    user_id: int,
+    k: int,
+    max_distance: float,
+    large: tuple[str, ...] = LARGE_TASK_COLUMNS,
+    aggregation: str = "MAX",
+) -> list[list[dict]] | None:
+    """
+    Like data.task.find_similar_tasks_batch() in one project, searched in this process. Returns None if the project
+    isn't served from memory, and should be searched in Postgres.
+    """
+    global _searches, _fallbacks
+    if not PROJECT_INDEX_ENABLED:
+        return None
+    if not 1 <= k <= MAX_SIMILAR_TASKS:
+        raise ValueError(f"k must be between 1 and {MAX_SIMILAR_TASKS}")
+
+    index = await _project_index(UUID(str(project_uuid)), user_id) if await start_project_index() else None
+    if index is None:
+        _fallbacks += len(embeddings)
+        return None
+
+    queries = [np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
+    # (task id, distance, chunk score) for each query
+    nearest: list[Sequence[tuple[int, float, float | None]]]
+    if aggregation == "SUM":
+        nearest = [index.search_sum(query, k, max_distance) for query in queries]
+    else:
+        nearest = [[(*found, None) for found in index.search(query, k, max_distance)] for query in queries]
+    _searches += len(embeddings)
+
+    task_ids = list({task_id for results in nearest for task_id, _, _ in results})
+    tasks = await get_searchable_tasks_by_id(task_ids, user_id, large) if task_ids else {}
+    scores = (lambda score: {"chunk_score": score}) if aggregation == "SUM" else (lambda score: {})
+    return [
+        [
+            dict(tasks[task_id], similarity_score=distance, **scores(score))
+            for task_id, distance, score in results
+            if task_id in tasks
+        ]
+        for results in nearest
+    ]
+
+
+def project_index_stats() -> dict[str, float]:
+    return {
+        "enabled": PROJECT_INDEX_ENABLED,
+        "listening": _listener is not None,
+        "projects": len(_indexes),
+        "memory_mb": _memory() / 2**20,
+        "searches": _searches,
+        "fallbacks": _fallbacks,
+        "loads": _loads,
+        "evictions": _evictions,
+        "updates": _updates,
+    }
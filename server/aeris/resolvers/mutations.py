@@ -6,13 +6,11 @@ from aeris.data.project import create_project, delete_project, update_project
 from aeris.data.task import (
     create_event,
     create_task,
-    create_task_embedding,
     delete_task,
-    get_task_by_uuid,
     update_task,
 )
 from aeris.decorators import decorate_event, decorate_project, decorate_task
-from aeris.embeddings import generate_openai_embedding
+from aeris.embeddings import client_embedding
 
 mutation = MutationType()
 logger = logging.getLogger(__name__)
@@ -39,16 +37,15 @@ async def resolve_delete_project(_, info, id):
 
 # Tasks
 @mutation.field("createTask")
-async def resolve_create_task(_, info, projectId, name, input):
+async def resolve_create_task(_, info, projectId, name, input, embedding=None, embeddingBase64=None, embeddingModel=None):
     user_id = info.context["user_id"]
-    task = await create_task(projectId, user_id, name, input)
+    # Without an embedding from the client, the input is embedded by the embedding worker, see aeris.embedding_worker
+    embedding = client_embedding(embedding, embeddingBase64, embeddingModel)
+    task = await create_task(projectId, user_id, name, input, embedding)
     if not task:
         # TODO: Error handling
         return None
 
-    embedding = generate_openai_embedding(input)
-    await create_task_embedding(task["id"], embedding)
-
     return decorate_task(task)
 
 
@@ -72,13 +69,11 @@ async def resolve_delete_task(_, info, id):
 async def resolve_log_event(_, info, taskId, eventType, eventData):
     user_id = info.context["user_id"]
 
-    task = await get_task_by_uuid(taskId, user_id)
-    if not task:
-        raise ValueError("Task not found or access denied")
-
-    # Create the event
+    # Create the event, checking access to the task in the same statement
     logger.info(f"Logging event: {eventType} - {eventData}")
-    event = await create_event(task["id"], eventType, eventData)
+    event = await create_event(taskId, user_id, eventType, eventData)
+    if not event:
+        raise ValueError("Task not found or access denied")
 
     # Decorate the event for GraphQL
     return decorate_event(event)
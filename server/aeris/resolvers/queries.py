@@ -1,7 +1,19 @@
+from typing import Sequence
+from uuid import UUID
+
+import numpy as np
 from ariadne import QueryType
 
 from aeris.data.project import get_project_by_uuid, get_projects, get_tasks_for_project
-from aeris.data.task import find_similar_tasks, get_task_by_uuid
+from aeris.data.task import (
+    DEFAULT_MAX_DISTANCE,
+    DEFAULT_SIMILAR_TASKS,
+    LARGE_TASK_COLUMNS,
+    MAX_SIMILAR_TASK_QUERIES,
+    find_similar_tasks,
+    find_similar_tasks_batch,
+    get_task_by_uuid,
+)
 from aeris.data.user import get_user_by_id
 from aeris.decorators import (
     decorate_project,
@@ -9,7 +21,12 @@ from aeris.decorators import (
     decorate_task_similarity,
     decorate_user,
 )
-from aeris.embeddings import generate_openai_embedding
+from aeris.embedding_worker import query_chunk
+from aeris.embeddings import client_embedding, generate_embedding, generate_embeddings
+from aeris.pagination import Page, paginate
+from aeris.project_index import search_project_index
+from aeris.selection import selected_columns
+from aeris.similarity_cache import SearchScope, SimilarTasks, cached_search
 
 query = QueryType()
 
@@ -42,25 +59,138 @@ async def resolve_project(_, info, id):
 @query.field("tasks")
 async def resolve_tasks(_, info, projectId, pagination=None, filters=None):
     user_id = info.context["user_id"]
-    tasks = [
-        decorate_task(task)
-        for task in await get_tasks_for_project(projectId, user_id, pagination, filters)
-    ]
-    edges = [{"cursor": task["id"], "node": task} for task in tasks]
-    return {
-        "edges": edges,
-        "pageInfo": {"hasNextPage": False, "hasPreviousPage": False},
-    }
+    page = Page.from_input(pagination)
+    large = selected_columns(info, LARGE_TASK_COLUMNS, "edges", "node")
+    tasks = await get_tasks_for_project(projectId, user_id, page, filters, large)
+    return paginate(tasks, page, decorate_task)
 
 
 @query.field("task")
 async def resolve_task(_, info, id):
     user_id = info.context["user_id"]
-    return decorate_task(await get_task_by_uuid(id, user_id))
+    return decorate_task(await get_task_by_uuid(id, user_id, selected_columns(info, LARGE_TASK_COLUMNS)))
+
+
+async def _find_similar_tasks(scope: SearchScope, embeddings: list[np.ndarray]) -> Sequence[SimilarTasks]:
+    """
+    Searches a project's in-process index if it has one, and Postgres otherwise.
+    """
+    if scope.text is None and scope.project_uuid is not None:
+        results = await search_project_index(
+            scope.project_uuid,
+            embeddings,
+            scope.user_id,
+            scope.k,
+            scope.max_distance,
+            scope.large,
+            scope.aggregation,
+        )
+        if results is not None:
+            return results
+
+    if len(embeddings) == 1:
+        return [
+            await find_similar_tasks(
+                embeddings[0],
+                scope.user_id,
+                scope.k,
+                scope.max_distance,
+                scope.project_uuid,
+                scope.large,
+                scope.search_effort,
+                scope.text,
+                scope.aggregation,
+            )
+        ]
+    return await find_similar_tasks_batch(
+        embeddings,
+        scope.user_id,
+        scope.k,
+        scope.max_distance,
+        scope.project_uuid,
+        scope.large,
+        scope.search_effort,
+        scope.aggregation,
+    )
 
 
 @query.field("findSimilarTasks")
-async def resolve_find_similar_tasks(_, info, input):
-    embedding = generate_openai_embedding(input)
-    similar_tasks = await find_similar_tasks(embedding)
+async def resolve_find_similar_tasks(
+    _,
+    info,
+    input=None,
+    mode="VECTOR",
+    aggregation="MAX",
+    embedding=None,
+    embeddingBase64=None,
+    embeddingModel=None,
+    projectId=None,
+    k=DEFAULT_SIMILAR_TASKS,
+    maxDistance=DEFAULT_MAX_DISTANCE,
+    searchEffort=None,
+):
+    user_id = info.context["user_id"]
+    if mode == "HYBRID" and not input:
+        raise ValueError("HYBRID mode needs an input to match")
+    if mode == "HYBRID" and aggregation != "MAX":
+        raise ValueError("HYBRID mode only supports MAX aggregation")
+    embedding = client_embedding(embedding, embeddingBase64, embeddingModel)
+    if embedding is None:
+        if not input:
+            raise ValueError("Send an input or an embedding")
+        embedding = await generate_embedding(query_chunk(input))
+    scope = SearchScope(
+        UUID(projectId) if projectId is not None else None,
+        user_id,
+        k,
+        maxDistance,
+        selected_columns(info, LARGE_TASK_COLUMNS, "task"),
+        searchEffort,
+        input if mode == "HYBRID" else None,
+        aggregation,
+    )
+    (similar_tasks,) = await cached_search(
+        scope, [embedding], lambda embeddings: _find_similar_tasks(scope, embeddings)
+    )
     return [decorate_task_similarity(task) for task in similar_tasks]
+
+
+@query.field("findSimilarTasksBatch")
+async def resolve_find_similar_tasks_batch(
+    _,
+    info,
+    inputs=None,
+    embeddings=None,
+    embeddingsBase64=None,
+    embeddingModel=None,
+    aggregation="MAX",
+    projectId=None,
+    k=DEFAULT_SIMILAR_TASKS,
+    maxDistance=DEFAULT_MAX_DISTANCE,
+    searchEffort=None,
+):
+    user_id = info.context["user_id"]
+    queries = [argument for argument in (inputs, embeddings, embeddingsBase64) if argument is not None]
+    if len(queries) != 1:
+        raise ValueError("Send one of inputs, embeddings or embeddingsBase64")
+    if not 1 <= len(queries[0]) <= MAX_SIMILAR_TASK_QUERIES:
+        raise ValueError(f"Send between 1 and {MAX_SIMILAR_TASK_QUERIES} queries")
+
+    if inputs is not None:
+        vectors = await generate_embeddings([query_chunk(text) for text in inputs])
+    elif embeddings is not None:
+        vectors = [client_embedding(embedding, None, embeddingModel) for embedding in embeddings]
+    else:
+        vectors = [client_embedding(None, encoded, embeddingModel) for encoded in embeddingsBase64]
+
+    scope = SearchScope(
+        UUID(projectId) if projectId is not None else None,
+        user_id,
+        k,
+        maxDistance,
+        selected_columns(info, LARGE_TASK_COLUMNS, "task"),
+        searchEffort,
+        aggregation=aggregation,
+    )
+    results = await cached_search(scope, vectors, lambda embeddings: _find_similar_tasks(scope, embeddings))
+    return [[decorate_task_similarity(task) for task in similar_tasks] for similar_tasks in results]
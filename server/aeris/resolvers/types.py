@@ -3,13 +3,10 @@ import json
 from ariadne import ObjectType, ScalarType
 
 from aeris.data.project import get_tasks_for_project
-from aeris.data.task import (
-    get_embeddings_for_task,
-    get_events_for_task,
-    get_metadata_for_task,
-    get_task_by_uuid,
-)
-from aeris.decorators import decorate_event
+from aeris.data.task import LARGE_TASK_COLUMNS
+from aeris.decorators import decorate_event, decorate_task
+from aeris.pagination import Page, paginate
+from aeris.selection import selected_columns, selected_fields
 
 project = ObjectType("Project")
 task = ObjectType("Task")
@@ -19,20 +16,23 @@ user = ObjectType("User")
 
 # Resolve related fields
 @project.field("tasks")
-def resolve_project_tasks(obj, info, pagination=None, filters=None):
-    return get_tasks_for_project(obj.id, pagination, filters)
+async def resolve_project_tasks(obj, info, pagination=None, filters=None):
+    user_id = info.context["user_id"]
+    page = Page.from_input(pagination)
+    large = selected_columns(info, LARGE_TASK_COLUMNS, "edges", "node")
+    tasks = await get_tasks_for_project(obj["id"], user_id, page, filters, large)
+    return paginate(tasks, page, decorate_task)
 
 
 @task.field("embeddings")
 async def resolve_task_embeddings(obj, info):
-    user_id = info.context["user_id"]
-    task_record = await get_task_by_uuid(obj["id"], user_id)
-    result = await get_embeddings_for_task(task_record["id"])
+    vectors = "embedding" in selected_fields(info)
+    result = await info.context["loaders"].embeddings(vectors).load(obj["id"])
     decorated = [
         {
             "id": embedding["id"],
-            "task_id": task_record["id"],
-            "embedding": embedding["embedding"].tolist(),
+            "task_id": embedding["task_id"],
+            "embedding": embedding["embedding"].tolist() if vectors else None,
         }
         for embedding in result
     ]
@@ -41,24 +41,17 @@ async def resolve_task_embeddings(obj, info):
 
 @task.field("metadata")
 async def resolve_task_metadata(obj, info):
-    user_id = info.context["user_id"]
-    task_record = await get_task_by_uuid(obj["id"], user_id)
-    return await get_metadata_for_task(task_record["id"])
+    return [
+        {"id": metadata["uuid"], "key": metadata["key"], "value": metadata["value"]}
+        for metadata in await info.context["loaders"].metadata.load(obj["id"])
+    ]
 
 
 @task.field("events")
-async def resolve_events(obj, info):
-    user_id = info.context["user_id"]
-    # Perform auth via fetching the task
-    task_record = await get_task_by_uuid(obj["id"], user_id)
-    events = [
-        decorate_event(event) for event in await get_events_for_task(task_record["id"])
-    ]
-    edges = [{"cursor": event["id"], "node": event} for event in events]
-    return {
-        "edges": edges,
-        "pageInfo": {"hasNextPage": False, "hasPreviousPage": False},
-    }
+async def resolve_events(obj, info, pagination=None, filters=None):
+    page = Page.from_input(pagination)
+    events = await info.context["loaders"].events(page, filters).load(obj["id"])
+    return paginate(events, page, decorate_event)
 
 
 # Define the JSON scalar
@@ -0,0 +1,38 @@
+from graphql import FieldNode, FragmentSpreadNode, GraphQLResolveInfo, InlineFragmentNode, SelectionSetNode
+
+
+def _fields(selection_set: SelectionSetNode | None, info: GraphQLResolveInfo) -> list[FieldNode]:
+    """
+    Returns the fields in a selection set, expanding fragments.
+    """
+    if selection_set is None:
+        return []
+
+    fields = []
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            fields.append(selection)
+        elif isinstance(selection, InlineFragmentNode):
+            fields.extend(_fields(selection.selection_set, info))
+        elif isinstance(selection, FragmentSpreadNode):
+            fields.extend(_fields(info.fragments[selection.name.value].selection_set, info))
+    return fields
+
+
+def selected_fields(info: GraphQLResolveInfo, *path: str) -> set[str]:
+    """
+    Returns the names of the fields selected on the resolved field's result, or on the object reached by following
+    `path` through nested fields, e.g. selected_fields(info, "edges", "node") for a connection's nodes.
+    """
+    fields = [field for node in info.field_nodes for field in _fields(node.selection_set, info)]
+    for name in path:
+        fields = [nested for field in fields if field.name.value == name for nested in _fields(field.selection_set, info)]
+    return {field.name.value for field in fields}
+
+
+def selected_columns(info: GraphQLResolveInfo, columns: tuple[str, ...], *path: str) -> tuple[str, ...]:
+    """
+    Returns which of `columns`, named like the fields they back, the query selects, in their original order.
+    """
+    selected = selected_fields(info, *path)
+    return tuple(column for column in columns if column in selected)
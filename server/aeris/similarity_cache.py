@@ -0,0 +1,273 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Sequence
+from uuid import UUID
+
+import numpy as np
+from asyncpg import Connection, Record
+
+from aeris.data.task import get_searchable_tasks_by_id
+from aeris.db import create_listener
+from aeris.env import get_setting
+from aeris.vector_index import vector_distances
+
+logger = logging.getLogger(__name__)
+
+# Caches findSimilarTasks results in each worker, for agents asking nearly the same question in quick succession.
+# Entries are dropped when a task in their project is embedded or changes state, see db.TASK_VECTORS_CHANGED.
+# Entries only keep the tasks' ids and scores, and the tasks are read again by id, as for aeris.project_index, so an
+# entry's size doesn't depend on the tasks' inputs and a hit has their current names, feedback and so on.
+# 0 disables the cache.
+SIMILARITY_CACHE_SIZE = int(get_setting("SIMILARITY_CACHE_SIZE", 1024))
+# Seconds an entry is served for at most, which bounds staleness the notifications don't cover
+SIMILARITY_CACHE_TTL = float(get_setting("SIMILARITY_CACHE_TTL", 30))
+# A search also gets the results of a cached search whose query embedding is closer than this, in the configured
+# metric. Their distances are then from that query. 0 only reuses results for the same embedding.
+SIMILARITY_CACHE_DISTANCE = float(get_setting("SIMILARITY_CACHE_DISTANCE", 0.02))
+
+TASK_VECTORS_CHANGED_CHANNEL = "task_vectors_changed"
+
+# The columns a search adds to each task, which are cached with its id
+SCORE_COLUMNS = ("similarity_score", "chunk_score", "fusion_score")
+
+# A search's results, Records from Postgres, or dicts from aeris.project_index or this cache
+SimilarTasks = Sequence[Record | dict[str, Any]]
+
+
+@dataclass(frozen=True)
+class SearchScope:
+    """
+    Everything except the query embedding that a similar-task search's results depend on.
+    """
+
+    project_uuid: UUID | None
+    user_id: int
+    k: int
+    max_distance: float
+    large: tuple[str, ...]
+    search_effort: int | None = None
+    text: str | None = None
+    aggregation: str = "MAX"
+
+
+@dataclass
+class _Entry:
+    scope: SearchScope
+    key: bytes
+    embedding: np.ndarray
+    # The (task id, scores) of each result
+    results: list[tuple[int, dict[str, Any]]]
+    deadline: float
+
+
+# Least recently used first
+_entries: OrderedDict[tuple[SearchScope, bytes], _Entry] = OrderedDict()
+# Each scope's entries, stacked into a matrix when first searched for a near embedding
+_scopes: dict[SearchScope, dict[bytes, _Entry]] = {}
+_matrices: dict[SearchScope, tuple[list[_Entry], np.ndarray]] = {}
+# Bumped on every change, so a search that raced with one doesn't cache what it read before it
+_changes = 0
+_project_changes: dict[UUID, int] = {}
+_cleared = 0
+
+_listener: Connection | None = None
+_listener_lock = asyncio.Lock()
+
+_hits = 0
+_near_hits = 0
+_misses = 0
+_invalidations = 0
+
+
+def _key(embedding: np.ndarray) -> bytes:
+    # Half precision absorbs the float noise between embeddings of the same query computed in different places
+    return hashlib.blake2b(np.asarray(embedding, dtype=np.float16).tobytes(), digest_size=16).digest()
+
+
+def _remove(entry: _Entry) -> None:
+    del _entries[(entry.scope, entry.key)]
+    scope_entries = _scopes[entry.scope]
+    del scope_entries[entry.key]
+    if not scope_entries:
+        del _scopes[entry.scope]
+    _matrices.pop(entry.scope, None)
+
+
+def _nearest(scope: SearchScope, embedding: np.ndarray) -> _Entry | None:
+    if SIMILARITY_CACHE_DISTANCE <= 0 or scope not in _scopes:
+        return None
+    if scope not in _matrices:
+        entries = list(_scopes[scope].values())
+        _matrices[scope] = entries, np.stack([entry.embedding for entry in entries])
+    entries, matrix = _matrices[scope]
+
+    distances = vector_distances(matrix, embedding)
+    nearest = int(np.argmin(distances))
+    return entries[nearest] if distances[nearest] < SIMILARITY_CACHE_DISTANCE else None
+
+
+def _get(scope: SearchScope, embedding: np.ndarray) -> list[tuple[int, dict[str, Any]]] | None:
+    global _hits, _near_hits, _misses
+    entry = _entries.get((scope, _key(embedding)))
+    near = entry is None
+    if near:
+        entry = _nearest(scope, embedding)
+
+    if entry is None or entry.deadline <= time.monotonic():
+        if entry is not None:
+            _remove(entry)
+        _misses += 1
+        return None
+
+    _entries.move_to_end((scope, entry.key))
+    _hits += 1
+    _near_hits += near
+    return entry.results
+
+
+def _set(scope: SearchScope, embedding: np.ndarray, found: SimilarTasks) -> None:
+    key = _key(embedding)
+    results = [
+        (task["id"], {column: task[column] for column in SCORE_COLUMNS if column in task.keys()}) for task in found
+    ]
+    if (existing := _entries.get((scope, key))) is not None:
+        _remove(existing)
+
+    entry = _Entry(scope, key, embedding, results, time.monotonic() + SIMILARITY_CACHE_TTL)
+    _entries[(scope, key)] = entry
+    _scopes.setdefault(scope, {})[key] = entry
+    _matrices.pop(scope, None)
+    while len(_entries) > SIMILARITY_CACHE_SIZE:
+        _remove(next(iter(_entries.values())))
+
+
+def _version(scope: SearchScope) -> tuple[int, int]:
+    if scope.project_uuid is None:
+        return _cleared, _changes
+    return _cleared, _project_changes.get(scope.project_uuid, 0)
+
+
+async def cached_search(
+    scope: SearchScope,
+    embeddings: list[np.ndarray],
+    search: Callable[[list[np.ndarray]], Awaitable[Sequence[SimilarTasks]]],
+) -> list[SimilarTasks]:
+    """
+    Returns the similar tasks for each of `embeddings` in `scope`, from the cache where it can, searching for the rest
+    with `search`, which takes the embeddings and returns their results in the same order.
+    """
+    if SIMILARITY_CACHE_SIZE <= 0 or not await start_similarity_cache():
+        return list(await search(embeddings))
+
+    cached = [_get(scope, np.asarray(embedding, dtype=np.float32)) for embedding in embeddings]
+    results: list[SimilarTasks] = [[] for _ in embeddings]
+    if task_ids := list({task_id for hit in cached if hit is not None for task_id, _ in hit}):
+        # Tasks that stopped being searchable, or visible to the user, since their entry was cached are left out
+        tasks = await get_searchable_tasks_by_id(task_ids, scope.user_id, scope.large)
+        for i, hit in enumerate(cached):
+            if hit is not None:
+                results[i] = [dict(tasks[task_id], **scores) for task_id, scores in hit if task_id in tasks]
+
+    missing = [i for i, hit in enumerate(cached) if hit is None]
+    if not missing:
+        return results
+
+    version = _version(scope)
+    searched = await search([embeddings[i] for i in missing])
+    cacheable = _listener is not None and _version(scope) == version
+    for i, found in zip(missing, searched, strict=True):
+        results[i] = found
+        if cacheable:
+            _set(scope, np.asarray(embeddings[i], dtype=np.float32), found)
+    return results
+
+
+def _invalidate(project_uuid: UUID | None) -> None:
+    """
+    Drops the entries that changes to a task in the project may have made stale: the project's, and those of searches
+    across every project. Without a project, drops everything.
+    """
+    global _changes, _cleared, _invalidations
+    _invalidations += 1
+    if project_uuid is None:
+        _cleared += 1
+        _entries.clear()
+        _scopes.clear()
+        _matrices.clear()
+        return
+
+    _changes += 1
+    _project_changes[project_uuid] = _project_changes.get(project_uuid, 0) + 1
+    for scope in [scope for scope in _scopes if scope.project_uuid in (project_uuid, None)]:
+        for entry in list(_scopes[scope].values()):
+            _remove(entry)
+
+
+def _on_task_vectors_changed(connection, pid, channel, payload) -> None:
+    if payload == "*":
+        _invalidate(None)
+        return
+
+    # The payload is each task's id and its project's uuid, which is missing if the task was deleted
+    project_uuids = {changed.partition(":")[2] for changed in payload.split(",")}
+    if "" in project_uuids:
+        _invalidate(None)
+        return
+    for project_uuid in project_uuids:
+        _invalidate(UUID(project_uuid))
+
+
+def _on_listener_closed(connection) -> None:
+    global _listener
+    logger.warning("Similar task cache listener disconnected, clearing the cache")
+    _listener = None
+    _invalidate(None)
+
+
+async def start_similarity_cache() -> bool:
+    """
+    Starts listening for changed tasks if this worker isn't already. Returns whether the listener is running, without
+    which nothing is cached.
+    """
+    global _listener
+    if SIMILARITY_CACHE_SIZE <= 0:
+        return False
+    if _listener is not None:
+        return True
+
+    async with _listener_lock:
+        if _listener is None:
+            try:
+                _listener = await create_listener(
+                    TASK_VECTORS_CHANGED_CHANNEL, _on_task_vectors_changed, _on_listener_closed
+                )
+            except Exception:
+                logger.exception("Could not start the similar task cache listener, similar tasks won't be cached")
+                return False
+
+    return True
+
+
+async def stop_similarity_cache() -> None:
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        await listener.close()
+    _invalidate(None)
+
+
+def similarity_cache_stats() -> dict[str, float]:
+    lookups = _hits + _misses
+    return {
+        "listening": _listener is not None,
+        "entries": len(_entries),
+        "hits": _hits,
+        "near_hits": _near_hits,
+        "misses": _misses,
+        "hit_rate": _hits / lookups if lookups else 0.0,
+        "invalidations": _invalidations,
+    }
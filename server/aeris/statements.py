@@ -0,0 +1,104 @@
+import math
+import time
+from collections import deque
+from typing import Any
+
+from asyncpg import Record
+
+from aeris.env import get_setting
+
+# How many recent latencies each statement keeps for its percentiles
+STATEMENT_LATENCY_SAMPLES = int(get_setting("STATEMENT_LATENCY_SAMPLES", 1024))
+
+
+class Statement:
+    """
+    A named, parameterized SQL statement. Every pooled connection prepares the registered statements when it is
+    opened, and its statement cache keeps them once first run. Calls are timed for statement_stats().
+    """
+
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        self.calls = 0
+        self.total_time = 0.0
+        self.latencies: deque[float] = deque(maxlen=STATEMENT_LATENCY_SAMPLES)
+
+    def __repr__(self) -> str:
+        return f"Statement({self.name!r})"
+
+    def _record(self, started: float) -> None:
+        elapsed = time.perf_counter() - started
+        self.calls += 1
+        self.total_time += elapsed
+        self.latencies.append(elapsed)
+
+    async def fetch(self, conn, *args) -> list[Record]:
+        started = time.perf_counter()
+        try:
+            return await conn.fetch(self.sql, *args)
+        finally:
+            self._record(started)
+
+    async def fetchrow(self, conn, *args) -> Record | None:
+        started = time.perf_counter()
+        try:
+            return await conn.fetchrow(self.sql, *args)
+        finally:
+            self._record(started)
+
+    async def fetchval(self, conn, *args) -> Any:
+        started = time.perf_counter()
+        try:
+            return await conn.fetchval(self.sql, *args)
+        finally:
+            self._record(started)
+
+    async def execute(self, conn, *args) -> str:
+        started = time.perf_counter()
+        try:
+            return await conn.execute(self.sql, *args)
+        finally:
+            self._record(started)
+
+    async def executemany(self, conn, args: list[tuple]) -> None:
+        started = time.perf_counter()
+        try:
+            await conn.executemany(self.sql, args)
+        finally:
+            self._record(started)
+
+    def stats(self) -> dict[str, float]:
+        latencies = sorted(self.latencies)
+        # Nearest-rank percentile
+        p99 = latencies[math.ceil(len(latencies) * 0.99) - 1] if latencies else 0.0
+        return {
+            "calls": self.calls,
+            "mean_ms": self.total_time / self.calls * 1000 if self.calls else 0.0,
+            "p99_ms": p99 * 1000,
+        }
+
+
+_registry: dict[str, Statement] = {}
+
+
+def statement(name: str, sql: str) -> Statement:
+    """
+    Registers a statement under `name`. Names must be unique.
+    """
+    if name in _registry:
+        raise ValueError(f"Statement {name!r} is already registered")
+
+    _registry[name] = Statement(name, sql)
+    return _registry[name]
+
+
+def registered_statements() -> list[Statement]:
+    return list(_registry.values())
+
+
+def statement_stats() -> dict[str, dict[str, float]]:
+    """
+    Returns the call count, mean and p99 latency of every registered statement.
+    """
+    return {name: registered.stats() for name, registered in _registry.items()}
@@ -0,0 +1,154 @@
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+from asyncpg import Connection
+
+from aeris.env import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Metric:
+    """
+    A pgvector distance metric. `distance` turns the operator's result into a distance where smaller is closer.
+    """
+
+    operator: str
+    opclass: str
+    distance: str
+
+
+METRICS = {
+    "l2": Metric("<->", "vector_l2_ops", "{}"),
+    # <#> is the negated inner product. For normalized embeddings, like OpenAI's, 1 - inner product is the cosine
+    # distance, which this gets without the normalization <=> does.
+    "inner_product": Metric("<#>", "vector_ip_ops", "1 + ({})"),
+    "cosine": Metric("<=>", "vector_cosine_ops", "{}"),
+}
+
+VECTOR_METRIC = get_setting("VECTOR_METRIC", "l2")
+VECTOR_INDEX_TYPE = get_setting("VECTOR_INDEX_TYPE", "hnsw")
+HNSW_M = int(get_setting("HNSW_M", 16))
+HNSW_EF_CONSTRUCTION = int(get_setting("HNSW_EF_CONSTRUCTION", 64))
+IVFFLAT_LISTS = int(get_setting("IVFFLAT_LISTS", 100))
+# Index a smaller copy of each embedding: halfvec (16-bit floats, half the size) or binary (one bit per dimension,
+# 1/32 of the size, compared by Hamming distance). Either way the table keeps full-precision vectors, which re-rank
+# the index's candidates. Needs pgvector 0.7 or later.
+VECTOR_QUANTIZATION = get_setting("VECTOR_QUANTIZATION", "none")
+# How many more candidates a quantized index fetches for re-ranking, to make up for its coarser ordering
+QUANTIZED_OVERFETCH = int(get_setting("QUANTIZED_OVERFETCH", 4))
+# Must match the embedding provider's output. Changing it makes migrate_db() drop every embedding and re-embed.
+EMBEDDING_DIMENSIONS = int(get_setting("EMBEDDING_DIMENSIONS", 1536))
+
+if VECTOR_METRIC not in METRICS:
+    raise ValueError(f"VECTOR_METRIC must be one of {', '.join(METRICS)}")
+if VECTOR_INDEX_TYPE not in ("hnsw", "ivfflat"):
+    raise ValueError("VECTOR_INDEX_TYPE must be hnsw or ivfflat")
+if VECTOR_QUANTIZATION not in ("none", "halfvec", "binary"):
+    raise ValueError("VECTOR_QUANTIZATION must be none, halfvec or binary")
+
+METRIC = METRICS[VECTOR_METRIC]
+
+VECTOR_INDEX = "task_embeddings_embedding_idx"
+# Upper bound for hnsw.ef_search, and a sensible one for ivfflat.probes
+MAX_SEARCH_EFFORT = 1000
+# pgvector's default hnsw.ef_search, the most rows an HNSW index scan returns unless it's raised
+HNSW_DEFAULT_EF_SEARCH = 40
+
+
+def _indexed(quantization: str) -> tuple[str, str]:
+    """
+    Returns the indexed expression and its operator class.
+    """
+    if quantization == "halfvec":
+        return f"(embedding::halfvec({EMBEDDING_DIMENSIONS}))", METRIC.opclass.replace("vector_", "halfvec_")
+    if quantization == "binary":
+        return f"(binary_quantize(embedding)::bit({EMBEDDING_DIMENSIONS}))", "bit_hamming_ops"
+    return "embedding", METRIC.opclass
+
+
+def search_order(param: str, quantization: str = VECTOR_QUANTIZATION) -> str:
+    """
+    Returns the ORDER BY expression, comparing each row's embedding with `param`, that the index serves.
+    """
+    if quantization == "halfvec":
+        return f"embedding::halfvec({EMBEDDING_DIMENSIONS}) {METRIC.operator} {param}::halfvec({EMBEDDING_DIMENSIONS})"
+    if quantization == "binary":
+        return f"binary_quantize(embedding)::bit({EMBEDDING_DIMENSIONS}) <~> binary_quantize({param})"
+    return f"embedding {METRIC.operator} {param}"
+
+
+def distance(param: str) -> str:
+    """
+    Returns the full-precision distance between each row's embedding and `param`.
+    """
+    return METRIC.distance.format(f"embedding {METRIC.operator} {param}")
+
+
+def vector_distances(vectors: np.ndarray, query: np.ndarray, norms: np.ndarray | None = None) -> np.ndarray:
+    """
+    Returns the distance between each of `vectors` and `query`, as distance() does in SQL. `norms` are the vectors'
+    squared norms, if already known.
+    """
+    dots = vectors @ query
+    if VECTOR_METRIC == "inner_product":
+        return 1 - dots
+    if norms is None:
+        norms = np.einsum("ij,ij->i", vectors, vectors)
+    query_norm = query @ query
+    if VECTOR_METRIC == "cosine":
+        # Like pgvector, the distance from a zero vector is NaN, which is never within a maximum distance
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return 1 - dots / np.sqrt(norms * query_norm)
+    return np.sqrt(np.maximum(norms + query_norm - 2 * dots, 0))
+
+
+def candidate_count(candidates: int, quantization: str = VECTOR_QUANTIZATION) -> int:
+    return candidates * QUANTIZED_OVERFETCH if quantization != "none" else candidates
+
+
+def vector_index_profile(quantization: str = VECTOR_QUANTIZATION) -> str:
+    """
+    Describes the configured index. It's stored as the index's comment, so a changed profile can be detected.
+    """
+    expression, opclass = _indexed(quantization)
+    if VECTOR_INDEX_TYPE == "hnsw":
+        return f"hnsw {expression} {opclass} m={HNSW_M} ef_construction={HNSW_EF_CONSTRUCTION}"
+    return f"ivfflat {expression} {opclass} lists={IVFFLAT_LISTS}"
+
+
+async def create_vector_index(
+    conn: Connection, table: str = "task_embeddings", name: str = VECTOR_INDEX, quantization: str = VECTOR_QUANTIZATION
+):
+    """
+    Builds the embedding index for the configured profile, replacing one built for a different profile.
+    """
+    profile = vector_index_profile(quantization)
+    current = await conn.fetchval("SELECT obj_description(to_regclass($1), 'pg_class')", name)
+    if current == profile:
+        return
+
+    expression, opclass = _indexed(quantization)
+    if VECTOR_INDEX_TYPE == "hnsw":
+        options = f"m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION}"
+    else:
+        options = f"lists = {IVFFLAT_LISTS}"
+
+    logger.info("Building %s (%s)", name, profile)
+    await conn.execute(f"DROP INDEX IF EXISTS {name}")
+    await conn.execute(f"CREATE INDEX {name} ON {table} USING {VECTOR_INDEX_TYPE} ({expression} {opclass}) WITH ({options})")
+    await conn.execute(f"COMMENT ON INDEX {name} IS '{profile}'")
+
+
+async def set_search_effort(conn: Connection, effort: int):
+    """
+    Sets how much of the index a search inside the current transaction explores: hnsw.ef_search for HNSW, the
+    candidate list size, or ivfflat.probes for IVFFlat, the number of lists scanned. Higher trades latency for recall.
+    """
+    if not 1 <= effort <= MAX_SEARCH_EFFORT:
+        raise ValueError(f"searchEffort must be between 1 and {MAX_SEARCH_EFFORT}")
+
+    setting = "hnsw.ef_search" if VECTOR_INDEX_TYPE == "hnsw" else "ivfflat.probes"
+    await conn.execute("SELECT set_config($1, $2, true)", setting, str(effort))
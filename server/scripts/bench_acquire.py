@@ -0,0 +1,60 @@
+"""
+Measures the cost of acquiring a pooled connection and running one indexed lookup on it, comparing registering
+codecs on every acquire (the old behaviour) with registering them once per connection in the pool's init hook.
+
+    poetry run python scripts/bench_acquire.py [--iterations 2000]
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from asyncpg import create_pool  # noqa: E402
+
+from aeris.db import DATABASE_URL, _init_connection, register_codecs  # noqa: E402
+
+LOOKUP = "SELECT * FROM tasks WHERE uuid = $1"
+TEST_TASK_UUID = "123e4567-e89b-12d3-a456-426614174000"
+
+
+async def measure(pool, iterations: int, register_per_acquire: bool) -> list[float]:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        async with pool.acquire() as conn:
+            if register_per_acquire:
+                await register_codecs(conn)
+            await conn.fetchrow(LOOKUP, TEST_TASK_UUID)
+        timings.append((time.perf_counter() - start) * 1_000_000)
+    return timings
+
+
+def report(label: str, timings: list[float]) -> None:
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(f"{label:<24} mean {statistics.mean(timings):9.1f} us   p50 {statistics.median(timings):9.1f} us   p99 {p99:9.1f} us")
+
+
+async def main(iterations: int):
+    # Single-connection pools so both runs reuse one physical connection, like a busy worker does
+    before = await create_pool(DATABASE_URL, min_size=1, max_size=1)
+    after = await create_pool(DATABASE_URL, min_size=1, max_size=1, init=_init_connection)
+
+    await measure(before, 50, register_per_acquire=True)
+    await measure(after, 50, register_per_acquire=False)
+
+    report("register on acquire", await measure(before, iterations, register_per_acquire=True))
+    report("register in init hook", await measure(after, iterations, register_per_acquire=False))
+
+    await before.close()
+    await after.close()
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--iterations", type=int, default=2000)
+asyncio.run(main(parser.parse_args().iterations))
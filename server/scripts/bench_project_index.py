@@ -0,0 +1,112 @@
+"""
+Compares searching one project's embeddings in process, as aeris.project_index does, with the vector index in
+Postgres, on a scratch table of clustered random embeddings. Reports recall@k against exact search, latency, and how
+long loading the embeddings into memory takes. The metric and index settings come from the usual settings. Either
+way, findSimilarTasks then reads the found tasks by primary key, which isn't measured.
+
+    poetry run python scripts/bench_project_index.py [--rows 10000] [--queries 100] [--k 10]
+"""
+
+import argparse
+import asyncio
+import math
+import statistics
+import sys
+import time
+from pathlib import Path
+from uuid import uuid4
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import numpy as np  # noqa: E402
+from asyncpg import connect  # noqa: E402
+
+from aeris.data.embedding_cache import as_array  # noqa: E402
+from aeris.data.task import SIMILAR_TASKS_OVERFETCH  # noqa: E402
+from aeris.db import DATABASE_URL, register_codecs  # noqa: E402
+from aeris.project_index import ProjectIndex  # noqa: E402
+from aeris.vector_index import EMBEDDING_DIMENSIONS, create_vector_index, distance, search_order  # noqa: E402
+
+TABLE = "bench_project_embeddings"
+INDEX = "bench_project_embeddings_embedding_idx"
+CLUSTERS = 50
+
+
+def clustered_embeddings(rng: np.random.Generator, rows: int) -> np.ndarray:
+    """
+    Embeddings scattered around a few centres, which is closer to real embeddings than uniform noise.
+    """
+    centres = rng.normal(size=(CLUSTERS, EMBEDDING_DIMENSIONS))
+    embeddings = centres[rng.integers(CLUSTERS, size=rows)] + rng.normal(scale=0.5, size=(rows, EMBEDDING_DIMENSIONS))
+    return (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(np.float32)
+
+
+def report(name: str, timings: list[float], recalls: list[float], k: int) -> None:
+    timings.sort()
+    print(
+        f"{name:<10} recall@{k} {statistics.mean(recalls):6.3f}   "
+        f"p50 {statistics.median(timings):7.2f} ms   p99 {timings[math.ceil(len(timings) * 0.99) - 1]:7.2f} ms"
+    )
+
+
+async def main(rows: int, query_count: int, k: int):
+    conn = await connect(DATABASE_URL)
+    await register_codecs(conn)
+
+    await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    await conn.execute(f"CREATE TABLE {TABLE} (id SERIAL PRIMARY KEY, embedding VECTOR({EMBEDDING_DIMENSIONS}))")
+    try:
+        rng = np.random.default_rng(0)
+        embeddings = clustered_embeddings(rng, rows)
+        await conn.copy_records_to_table(TABLE, records=[(e,) for e in embeddings], columns=["embedding"])
+        await conn.execute(f"ANALYZE {TABLE}")
+        await create_vector_index(conn, TABLE, INDEX)
+
+        # Queries near stored embeddings, answered exactly by a sequential scan
+        queries = embeddings[rng.integers(rows, size=query_count)]
+        queries += rng.normal(scale=0.1 / math.sqrt(EMBEDDING_DIMENSIONS), size=queries.shape).astype(np.float32)
+        await conn.execute("SET enable_indexscan = off")
+        exact_sql = f"SELECT id FROM {TABLE} ORDER BY {distance('$1')} LIMIT $2"
+        exact = [{row["id"] for row in await conn.fetch(exact_sql, query, k)} for query in queries]
+        await conn.execute("RESET enable_indexscan")
+
+        # The same shape as the similar-task search: the index's candidates, re-ranked by distance
+        sql = f"""
+            SELECT id FROM (
+                SELECT id, {distance("$1")} AS distance FROM {TABLE} ORDER BY {search_order("$1")} LIMIT $2
+            ) candidates
+            ORDER BY distance
+            LIMIT $3
+        """
+        timings, recalls = [], []
+        for query, expected in zip(queries, exact, strict=True):
+            start = time.perf_counter()
+            found = {row["id"] for row in await conn.fetch(sql, query, k * SIMILAR_TASKS_OVERFETCH, k)}
+            timings.append((time.perf_counter() - start) * 1000)
+            recalls.append(len(found & expected) / k)
+        report("pgvector", timings, recalls, k)
+
+        start = time.perf_counter()
+        loaded = await conn.fetch(f"SELECT id, embedding FROM {TABLE}")
+        index = ProjectIndex(uuid4(), 0, [row["id"] for row in loaded], [as_array(row["embedding"]) for row in loaded])
+        load_ms = (time.perf_counter() - start) * 1000
+
+        timings, recalls = [], []
+        for query, expected in zip(queries, exact, strict=True):
+            start = time.perf_counter()
+            found = {task_id for task_id, _ in index.search(query, k, math.inf)}
+            timings.append((time.perf_counter() - start) * 1000)
+            recalls.append(len(found & expected) / k)
+        report("in-process", timings, recalls, k)
+        print(f"loading {rows} embeddings took {load_ms:.0f} ms and uses {index.nbytes / 2**20:.1f} MB")
+    finally:
+        await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        await conn.close()
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--rows", type=int, default=10000)
+parser.add_argument("--queries", type=int, default=100)
+parser.add_argument("--k", type=int, default=10)
+args = parser.parse_args()
+asyncio.run(main(args.rows, args.queries, args.k))
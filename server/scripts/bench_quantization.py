@@ -0,0 +1,118 @@
+"""
+Measures recall@k and latency of the similar-task search for each VECTOR_QUANTIZATION mode, against exact search,
+on a scratch table of clustered random embeddings. The index type, metric and build parameters come from the usual
+settings. halfvec and binary need pgvector 0.7 or later and are skipped on older versions.
+
+    poetry run python scripts/bench_quantization.py [--rows 10000] [--queries 100] [--k 10]
+"""
+
+import argparse
+import asyncio
+import math
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from asyncpg import connect  # noqa: E402
+
+from aeris.data.task import SIMILAR_TASKS_OVERFETCH  # noqa: E402
+from aeris.db import DATABASE_URL, register_codecs  # noqa: E402
+from aeris.vector_index import (  # noqa: E402
+    EMBEDDING_DIMENSIONS,
+    MAX_SEARCH_EFFORT,
+    VECTOR_INDEX_TYPE,
+    candidate_count,
+    create_vector_index,
+    distance,
+    search_order,
+)
+
+TABLE = "bench_embeddings"
+INDEX = "bench_embeddings_embedding_idx"
+CLUSTERS = 50
+
+
+def normalized(vector: list[float]) -> list[float]:
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector]
+
+
+def clustered_embeddings(rows: int) -> list[list[float]]:
+    """
+    Embeddings scattered around a few centres, which is closer to real embeddings than uniform noise.
+    """
+    centres = [[random.gauss(0, 1) for _ in range(EMBEDDING_DIMENSIONS)] for _ in range(CLUSTERS)]
+    return [normalized([x + random.gauss(0, 0.5) for x in random.choice(centres)]) for _ in range(rows)]
+
+
+def search_sql(quantization: str) -> str:
+    return f"""
+        SELECT id FROM (
+            SELECT id, {distance("$1")} AS distance FROM {TABLE} ORDER BY {search_order("$1", quantization)} LIMIT $2
+        ) candidates
+        ORDER BY distance
+        LIMIT $3
+    """
+
+
+async def run(conn, quantization: str, queries: list[list[float]], exact: list[set[int]], k: int) -> None:
+    await create_vector_index(conn, TABLE, INDEX, quantization)
+    candidates = candidate_count(k * SIMILAR_TASKS_OVERFETCH, quantization)
+    if VECTOR_INDEX_TYPE == "hnsw":
+        await conn.execute(f"SET hnsw.ef_search = {min(max(candidates, 40), MAX_SEARCH_EFFORT)}")
+
+    sql = search_sql(quantization)
+    timings, recalls = [], []
+    for query, expected in zip(queries, exact, strict=True):
+        start = time.perf_counter()
+        found = {row["id"] for row in await conn.fetch(sql, query, candidates, k)}
+        timings.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(found & expected) / k)
+
+    timings.sort()
+    size = await conn.fetchval("SELECT pg_relation_size($1::regclass)", INDEX)
+    print(
+        f"{quantization:<8} index {size / 2**20:8.1f} MB   recall@{k} {statistics.mean(recalls):6.3f}   "
+        f"p50 {statistics.median(timings):7.2f} ms   p99 {timings[math.ceil(len(timings) * 0.99) - 1]:7.2f} ms"
+    )
+
+
+async def main(rows: int, query_count: int, k: int):
+    conn = await connect(DATABASE_URL)
+    await register_codecs(conn)
+
+    version = await conn.fetchval("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+    quantized = tuple(int(part) for part in version.split(".")[:2]) >= (0, 7)
+    modes = ["none", "halfvec", "binary"] if quantized else ["none"]
+    if not quantized:
+        print(f"pgvector {version} has no halfvec or bit types, only measuring unquantized search")
+
+    await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+    await conn.execute(f"CREATE TABLE {TABLE} (id SERIAL PRIMARY KEY, embedding VECTOR({EMBEDDING_DIMENSIONS}))")
+    try:
+        embeddings = clustered_embeddings(rows)
+        await conn.copy_records_to_table(TABLE, records=[(e,) for e in embeddings], columns=["embedding"])
+        await conn.execute(f"ANALYZE {TABLE}")
+
+        # Queries near stored embeddings, answered exactly by a sequential scan
+        queries = [normalized([x + random.gauss(0, 0.1) for x in random.choice(embeddings)]) for _ in range(query_count)]
+        exact_sql = f"SELECT id FROM {TABLE} ORDER BY {distance('$1')} LIMIT $2"
+        exact = [{row["id"] for row in await conn.fetch(exact_sql, query, k)} for query in queries]
+
+        for quantization in modes:
+            await run(conn, quantization, queries, exact, k)
+    finally:
+        await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        await conn.close()
+
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--rows", type=int, default=10000)
+parser.add_argument("--queries", type=int, default=100)
+parser.add_argument("--k", type=int, default=10)
+args = parser.parse_args()
+asyncio.run(main(args.rows, args.queries, args.k))
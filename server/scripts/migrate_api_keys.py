@@ -0,0 +1,20 @@
+import argparse
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from aeris.api_key import reissue_legacy_api_keys  # noqa: E402
+from aeris.db import init_db_pool  # noqa: E402
+
+
+async def main(deactivate: bool):
+    await init_db_pool()
+    for key in await reissue_legacy_api_keys(deactivate=deactivate):
+        print(f"{key['legacy_id']}\tuser={key['user_id']}\tproject={key['project_id']}\t{key['api_key']}")
+
+
+parser = argparse.ArgumentParser(description="Reissue legacy API keys in the indexed key format.")
+parser.add_argument("--deactivate", action="store_true", help="Disable the legacy keys after reissuing them")
+asyncio.run(main(parser.parse_args().deactivate))
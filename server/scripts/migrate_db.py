@@ -0,0 +1,15 @@
+import asyncio
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from aeris.db import init_db_pool, migrate_db  # noqa: E402
+
+
+async def main():
+    await init_db_pool()
+    await migrate_db()
+
+
+asyncio.run(main())
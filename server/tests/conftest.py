@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import subprocess
@@ -13,6 +14,8 @@ from aeris.db import refresh_db
 from aeris.env import env
 
 env()
+# Embed locally, so tests need neither network access nor an API key. The server inherits this too.
+os.environ.setdefault("EMBEDDING_PROVIDER", "local")
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -34,19 +37,22 @@ def graphql_server():
     Start the GraphQL server in the background for the duration of the test session.
     """
     # Start the server
+    # Tests run the embedding worker themselves, see test_embeddings.py
     server_process = subprocess.Popen(
         ["uvicorn", "aeris.main:app", "--port", PORT],
+        env={**os.environ, "EMBEDDING_WORKER_ENABLED": "false"},
         stdout=sys.stdout,
         stderr=sys.stderr,
     )
     time.sleep(1.5)
 
-    # Wait for the server to start by polling the port
+    # Wait for the server to finish warming up by polling the readiness endpoint
     start_time = time.time()
     while time.time() - start_time < 5:
         try:
-            httpx.get(f"http://localhost:{PORT}")
-            break
+            if httpx.get(f"http://localhost:{PORT}/ready").status_code == 200:
+                break
+            time.sleep(0.1)
         except httpx.RequestError:
             logger.exception("Server not started yet")
             time.sleep(0.1)
@@ -67,3 +73,15 @@ def event_loop(request):
     loop = get_event_loop_policy().new_event_loop()
     yield loop
     loop.close()
+
+
+async def eventually(search):
+    """
+    Retries a search until it returns something new, as the project index and similarity cache apply changes when notified of them.
+    """
+    previous = await search()
+    for _ in range(50):
+        await asyncio.sleep(0.05)
+        if (found := await search()) != previous:
+            return found
+    return previous
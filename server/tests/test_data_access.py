@@ -0,0 +1,331 @@
+import asyncio
+from contextlib import asynccontextmanager
+from uuid import uuid4
+
+import numpy as np
+import pytest
+
+from aeris.data.project import create_project, delete_project, get_tasks_for_project, update_project
+from aeris.data.task import (
+    LARGE_TASK_COLUMNS,
+    _similar_tasks,
+    _similar_tasks_batch,
+    create_event,
+    create_task,
+    delete_task,
+    find_similar_tasks,
+    find_similar_tasks_batch,
+    get_embeddings_for_tasks,
+    get_events_for_task,
+    get_task_by_uuid,
+    update_task,
+)
+from aeris.db import DB, UnitOfWork
+from aeris.env import env
+from aeris.loaders import Loaders
+from aeris.local_embeddings import embed_texts
+from aeris.pagination import Page
+from aeris.project_index import ProjectIndex
+from aeris.statements import statement_stats
+from aeris.vector_index import EMBEDDING_DIMENSIONS
+
+env()
+
+TEST_PROJECT_UUID = "36e8705e-6604-4e44-b58f-4e8c347a9f31"
+TEST_TASK_UUID = "123e4567-e89b-12d3-a456-426614174000"
+TEST_USER_ID = 1
+OTHER_USER_ID = 2
+
+TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "ROLLBACK")
+
+
+@asynccontextmanager
+async def statements():
+    """
+    Records the statements sent to the database, excluding transaction control, inside a unit of work.
+    """
+    issued: list[str] = []
+
+    def log(record):
+        if not record.query.strip().upper().startswith(TRANSACTION_CONTROL):
+            issued.append(record.query)
+
+    async with UnitOfWork():
+        async with DB() as conn:
+            conn.add_query_logger(log)
+        try:
+            yield issued
+        finally:
+            conn.remove_query_logger(log)
+
+
+@pytest.mark.asyncio
+async def test_log_event_is_one_statement():
+    async with statements() as issued:
+        event = await create_event(TEST_TASK_UUID, TEST_USER_ID, "TOOL_CALL", {"tool": "search"})
+    assert event["event_data"] == {"tool": "search"}
+    assert len(issued) == 1
+
+    async with statements() as issued:
+        assert await create_event(TEST_TASK_UUID, OTHER_USER_ID, "TOOL_CALL", {}) is None
+    assert len(issued) == 1
+
+
+@pytest.mark.asyncio
+async def test_task_writes_are_one_statement():
+    async with statements() as issued:
+        task = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "New Task", "Test Input")
+    assert task["name"] == "New Task"
+    assert len(issued) == 1
+
+    async with statements() as issued:
+        updated = await update_task(task["uuid"], TEST_USER_ID, state="SUCCESS", feedback="Good")
+    assert (updated["state"], updated["feedback"]) == ("SUCCESS", "Good")
+    assert len(issued) == 1
+
+    async with statements() as issued:
+        assert await update_task(task["uuid"], OTHER_USER_ID, state="FAILURE") is None
+        assert await delete_task(task["uuid"], OTHER_USER_ID) is None
+    assert len(issued) == 2
+
+    async with statements() as issued:
+        assert (await delete_task(task["uuid"], TEST_USER_ID))["uuid"] == task["uuid"]
+    assert len(issued) == 1
+
+
+@pytest.mark.asyncio
+async def test_project_writes_are_one_statement():
+    async with statements() as issued:
+        project = await create_project(TEST_USER_ID, "New Project")
+    assert len(issued) == 1
+
+    async with DB() as conn:
+        assert await conn.fetchval(
+            "SELECT count(*) FROM user_projects WHERE user_id = $1 AND project_id = $2", TEST_USER_ID, project["id"]
+        )
+
+    async with statements() as issued:
+        assert (await update_project(project["uuid"], TEST_USER_ID, description="Updated"))["description"] == "Updated"
+        assert await delete_project(project["uuid"], OTHER_USER_ID) is None
+        assert (await delete_project(project["uuid"], TEST_USER_ID))["uuid"] == project["uuid"]
+    assert len(issued) == 3
+
+
+@pytest.mark.asyncio
+async def test_authorized_reads_are_one_statement():
+    async with statements() as issued:
+        assert len(await get_tasks_for_project(TEST_PROJECT_UUID, TEST_USER_ID)) == 1
+        assert await get_tasks_for_project(TEST_PROJECT_UUID, OTHER_USER_ID) == []
+        assert await get_events_for_task(TEST_TASK_UUID, TEST_USER_ID) == []
+    assert len(issued) == 3
+
+
+@pytest.mark.asyncio
+async def test_loaders_batch_per_field():
+    tasks = [await create_task(TEST_PROJECT_UUID, TEST_USER_ID, f"Task {i}", "Test Input") for i in range(3)]
+    task_uuids = [TEST_TASK_UUID] + [task["uuid"] for task in tasks]
+    for task in tasks:
+        await create_event(task["uuid"], TEST_USER_ID, "TOOL_CALL", {"task": task["name"]})
+
+    loaders = Loaders(TEST_USER_ID)
+    async with statements() as issued:
+        events = await asyncio.gather(*(loaders.events(Page(), None).load(task_uuid) for task_uuid in task_uuids))
+        await asyncio.gather(*(loaders.metadata.load(task_uuid) for task_uuid in task_uuids))
+    assert len(issued) == 2
+    assert events[0] == []
+    assert [[event["event_data"] for event in task_events] for task_events in events[1:]] == [
+        [{"task": task["name"]}] for task in tasks
+    ]
+
+    # Another user's batch has the same shape but nothing in it
+    other_loaders = Loaders(OTHER_USER_ID)
+    assert await asyncio.gather(*(other_loaders.embeddings(True).load(task_uuid) for task_uuid in task_uuids)) == [[]] * 4
+
+
+@pytest.mark.asyncio
+async def test_large_columns_are_read_only_when_selected():
+    task = await get_task_by_uuid(TEST_TASK_UUID, TEST_USER_ID, large=())
+    assert task["name"] == "Test Task"
+    assert "input" not in task.keys() and "feedback" not in task.keys()
+
+    task = await get_task_by_uuid(TEST_TASK_UUID, TEST_USER_ID, large=("input",))
+    assert task["input"] == "Write a blog post about the latest news stories" and "feedback" not in task.keys()
+
+    (embedding,) = (await get_embeddings_for_tasks([TEST_TASK_UUID], TEST_USER_ID, vectors=False))[TEST_TASK_UUID]
+    assert "embedding" not in embedding.keys()
+
+
+@pytest.mark.asyncio
+async def test_similar_tasks_uses_hnsw_index():
+    async with DB() as conn:
+        embedding = await conn.fetchval("SELECT embedding FROM task_embeddings LIMIT 1")
+        async with conn.transaction():
+            # The test table is tiny, so make a sequential scan the last resort. If the query stops being a shape the
+            # index can serve, the plan falls back to one anyway.
+            await conn.execute("SET LOCAL enable_seqscan = off")
+            plan = await conn.fetch(
+                f"EXPLAIN {_similar_tasks(LARGE_TASK_COLUMNS, 'MAX').sql}", embedding, TEST_USER_ID, 0.5, 50, None, 5
+            )
+    plan = "\n".join(row[0] for row in plan)
+    assert "Index Scan using task_embeddings_embedding_idx" in plan, plan
+
+
+@pytest.mark.asyncio
+async def test_similar_tasks_batch_uses_hnsw_index():
+    rng = np.random.default_rng(0)
+    queries = rng.standard_normal(2 * EMBEDDING_DIMENSIONS).astype(np.float32)
+    async with DB() as conn:
+        async with conn.transaction():
+            # As above: the index, once per query, unless the LATERAL search stops being a shape it can serve
+            await conn.execute("SET LOCAL enable_seqscan = off")
+            plan = await conn.fetch(
+                f"EXPLAIN {_similar_tasks_batch(LARGE_TASK_COLUMNS, 'MAX').sql}", queries, TEST_USER_ID, 0.5, 50, None, 5
+            )
+    plan = "\n".join(row[0] for row in plan)
+    assert "Index Scan using task_embeddings_embedding_idx" in plan and "Seq Scan on task_embeddings" not in plan, plan
+
+
+@pytest.mark.asyncio
+async def test_find_similar_tasks_is_scoped_to_user():
+    async with DB() as conn:
+        embedding = await conn.fetchval("SELECT embedding FROM task_embeddings LIMIT 1")
+    await update_task(TEST_TASK_UUID, TEST_USER_ID, state="SUCCESS")
+
+    (similar,) = await find_similar_tasks(embedding, TEST_USER_ID, k=1, project_uuid=TEST_PROJECT_UUID)
+    assert str(similar["uuid"]) == TEST_TASK_UUID and similar["similarity_score"] < 1e-6
+    assert await find_similar_tasks(embedding, OTHER_USER_ID) == []
+    assert await find_similar_tasks(embedding, TEST_USER_ID, max_distance=-1) == []
+
+    assert len(await find_similar_tasks(embedding, TEST_USER_ID, search_effort=100)) == 1
+    with pytest.raises(ValueError):
+        await find_similar_tasks(embedding, TEST_USER_ID, search_effort=0)
+
+
+@pytest.mark.asyncio
+async def test_find_similar_tasks_sees_past_other_users_near_duplicates():
+    query = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    query[0] = 1
+    async with DB() as conn:
+        other_user_id = await conn.fetchval("INSERT INTO users (username, email) VALUES ('other', 'o@x.com') RETURNING id")
+    other_project = await create_project(other_user_id, "Other")
+
+    # 45 of another user's tasks are nearer than the user's own, more than HNSW returns by default
+    for i in range(1, 46):
+        duplicate = query.copy()
+        duplicate[i] = 0.01
+        task = await create_task(other_project["uuid"], other_user_id, f"Duplicate {i}", "Duplicate", duplicate)
+        await update_task(task["uuid"], other_user_id, state="SUCCESS")
+    own_embedding = query.copy()
+    own_embedding[46] = 0.02
+    own = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Own", "Own", own_embedding)
+    await update_task(own["uuid"], TEST_USER_ID, state="SUCCESS")
+
+    async with UnitOfWork():
+        async with DB(transaction=True) as conn:
+            # Make sure the index serves the search, as it would on a table this size in production
+            await conn.execute("SET LOCAL enable_seqscan = off")
+            similar = await find_similar_tasks(query, TEST_USER_ID, project_uuid=TEST_PROJECT_UUID)
+    assert [task["uuid"] for task in similar] == [own["uuid"]]
+
+
+@pytest.mark.asyncio
+async def test_find_similar_tasks_batch_is_one_statement():
+    async with DB() as conn:
+        embedding = await conn.fetchval("SELECT embedding FROM task_embeddings LIMIT 1")
+    await update_task(TEST_TASK_UUID, TEST_USER_ID, state="SUCCESS")
+    embedding = np.asarray(embedding.to_numpy() if hasattr(embedding, "to_numpy") else embedding)
+
+    async with statements() as issued:
+        results = await find_similar_tasks_batch([embedding, -embedding, embedding], TEST_USER_ID, k=1)
+    assert len(issued) == 1
+    assert [[str(task["uuid"]) for task in similar] for similar in results] == [[TEST_TASK_UUID], [], [TEST_TASK_UUID]]
+    assert results[0][0]["similarity_score"] == (await find_similar_tasks(embedding, TEST_USER_ID, k=1))[0]["similarity_score"]
+
+    assert await find_similar_tasks_batch([embedding], OTHER_USER_ID) == [[]]
+    with pytest.raises(ValueError):
+        await find_similar_tasks_batch([], TEST_USER_ID)
+
+
+@pytest.mark.asyncio
+async def test_hybrid_search_matches_exact_terms():
+    (embedding,) = embed_texts(["Rotate the API signing keys"], EMBEDDING_DIMENSIONS)
+    task = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "OPS-4821", "Rotate the API signing keys", embedding)
+    await update_task(task["uuid"], TEST_USER_ID, state="SUCCESS")
+
+    # A ticket id alone embeds nowhere near the task, but matches its name
+    (query,) = embed_texts(["OPS-4821"], EMBEDDING_DIMENSIONS)
+    assert await find_similar_tasks(query, TEST_USER_ID) == []
+    (found,) = await find_similar_tasks(query, TEST_USER_ID, text="OPS-4821")
+    assert found["uuid"] == task["uuid"] and found["fusion_score"] > 0
+    assert found["similarity_score"] > 0.5
+
+    # A task found by both searches outranks one found by either
+    both, *_ = await find_similar_tasks(embedding, TEST_USER_ID, text="signing keys")
+    assert both["uuid"] == task["uuid"] and both["fusion_score"] == pytest.approx(2 / 61)
+
+    assert await find_similar_tasks(query, OTHER_USER_ID, text="OPS-4821") == []
+
+
+@pytest.mark.asyncio
+async def test_hybrid_search_indexes_the_start_of_long_inputs():
+    # A log of unique ids whose tsvector would be far over Postgres's 1 MB limit
+    log = " ".join(f"request-{uuid4().hex}" for _ in range(50_000))
+    task = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Long log", log)
+    assert task is not None
+    assert await update_task(task["uuid"], TEST_USER_ID, input=log + " done") is not None
+
+    async with DB() as conn:
+        first, last = log.split()[0].split("-")[1], log.split()[-1].split("-")[1]
+        matches = "SELECT search_vector @@ plainto_tsquery('english', $2) FROM tasks WHERE uuid = $1"
+        assert await conn.fetchval(matches, task["uuid"], first)
+        assert not await conn.fetchval(matches, task["uuid"], last)
+
+
+@pytest.mark.asyncio
+async def test_sum_aggregation_ranks_tasks_by_their_chunks():
+    query = np.zeros(EMBEDDING_DIMENSIONS, dtype=np.float32)
+    query[0] = 1
+    # One task with the nearest chunk, another with several near ones
+    nearest = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Nearest", "One chunk", query)
+    chunked = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Chunked", "Three chunks")
+    chunks = np.repeat(query[None], 3, axis=0)
+    chunks[[0, 1, 2], [1, 2, 3]] = 0.3
+    async with DB() as conn:
+        await conn.executemany(
+            "INSERT INTO task_embeddings (task_id, embedding) VALUES ($1, $2)", [(chunked["id"], c) for c in chunks]
+        )
+    for task in (nearest, chunked):
+        await update_task(task["uuid"], TEST_USER_ID, state="SUCCESS")
+
+    def found(results):
+        return [(task["uuid"], pytest.approx(task["similarity_score"], abs=1e-4)) for task in results]
+
+    by_max = await find_similar_tasks(query, TEST_USER_ID, 5, 0.5, TEST_PROJECT_UUID)
+    assert found(by_max) == [(nearest["uuid"], 0), (chunked["uuid"], 0.3)]
+    by_sum = await find_similar_tasks(query, TEST_USER_ID, 5, 0.5, TEST_PROJECT_UUID, aggregation="SUM")
+    assert found(by_sum) == [(chunked["uuid"], 0.3), (nearest["uuid"], 0)]
+    assert [task["chunk_score"] for task in by_sum] == pytest.approx([2.1, 1], abs=1e-4)
+    (batch,) = await find_similar_tasks_batch([query], TEST_USER_ID, 5, 0.5, TEST_PROJECT_UUID, aggregation="SUM")
+    assert found(batch) == found(by_sum)
+
+    # The in-process index ranks them the same way
+    index = ProjectIndex(uuid4(), 1, [nearest["id"], *[chunked["id"]] * 3], [query, *chunks])
+    assert [task_id for task_id, _, _ in index.search_sum(query, 5, 0.5)] == [chunked["id"], nearest["id"]]
+    assert index.search_sum(query, 5, 0.5, top_k=1)[0][0] == nearest["id"]
+
+    with pytest.raises(ValueError):
+        await find_similar_tasks(query, TEST_USER_ID, text="chunks", aggregation="SUM")
+
+
+@pytest.mark.asyncio
+async def test_statement_stats():
+    calls = statement_stats()["update_task"]["calls"]
+
+    await update_task(TEST_TASK_UUID, TEST_USER_ID, name="Renamed")
+    # Fields left as None keep their values
+    task = await update_task(TEST_TASK_UUID, TEST_USER_ID, state="RUNNING")
+    assert (task["name"], task["state"]) == ("Renamed", "RUNNING")
+
+    stats = statement_stats()["update_task"]
+    assert stats["calls"] == calls + 2
+    assert 0 < stats["mean_ms"] <= stats["p99_ms"]
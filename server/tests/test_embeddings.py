@@ -0,0 +1,405 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import numpy as np
+import openai
+import pytest
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from aeris import embedding_worker, embeddings
+from aeris.chunking import chunk_text, halve
+from aeris.data.embedding_cache import as_array, get_cached_embeddings
+from aeris.data.task import create_task, get_embeddings_for_tasks, get_task_by_uuid
+from aeris.db import DB, UnitOfWork, current_unit_of_work
+from aeris.embedding_worker import embed_pending_tasks, query_chunk
+from aeris.embeddings import (
+    LocalEmbeddingProvider,
+    OpenAIEmbeddingProvider,
+    _chunks_by_characters,
+    generate_embedding,
+    generate_embeddings,
+)
+from aeris.local_embeddings import embed_texts
+
+TEST_PROJECT_UUID = "36e8705e-6604-4e44-b58f-4e8c347a9f31"
+TEST_USER_ID = 1
+
+
+@asynccontextmanager
+async def stub_embeddings_server(
+    failures: int = 0,
+    delay: float = 0.0,
+    dimensions: int = 2,
+    rejected: frozenset[str] = frozenset(),
+    max_chars: int | None = None,
+):
+    """
+    Serves the OpenAI embeddings API locally, answering the first `failures` requests with a 500, and requests for any
+    `rejected` text, or text longer than `max_chars`, with a 400. Each embedding starts with the length of its text, so
+    callers can tell them apart.
+    """
+    requests = []
+
+    async def embeddings(request: Request):
+        body = await request.json()
+        requests.append(body)
+        if len(requests) <= failures:
+            return JSONResponse({"error": {"message": "try again"}}, status_code=500)
+        if rejected.intersection(body["input"]) or any(len(text) > (max_chars or len(text)) for text in body["input"]):
+            return JSONResponse({"error": {"message": "input too long"}}, status_code=400)
+
+        await asyncio.sleep(delay)
+        data = [
+            {"object": "embedding", "index": index, "embedding": [float(len(text))] + [0.0] * (dimensions - 1)}
+            for index, text in enumerate(body["input"])
+        ]
+        return JSONResponse({"object": "list", "data": data, "model": body["model"], "usage": {}})
+
+    app = Starlette(routes=[Route("/v1/embeddings", embeddings, methods=["POST"])])
+    server = uvicorn.Server(uvicorn.Config(app, port=0, log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    port = server.servers[0].sockets[0].getsockname()[1]
+    try:
+        yield f"http://localhost:{port}/v1", requests
+    finally:
+        server.should_exit = True
+        await serving
+
+
+@pytest.mark.asyncio
+async def test_openai_provider_batches_in_order():
+    async with stub_embeddings_server() as (base_url, requests):
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url)
+        try:
+            assert await provider.embed(["a", "abc", "ab"]) == [[1.0, 0.0], [3.0, 0.0], [2.0, 0.0]]
+        finally:
+            await provider.close()
+    assert len(requests) == 1
+
+    with pytest.raises(ValueError):
+        await provider.embed([""])
+
+    # Larger batches are split into concurrent requests, and reassembled in order
+    async with stub_embeddings_server() as (base_url, requests):
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url, request_size=2)
+        try:
+            assert await provider.embed(["a", "abc", "ab"]) == [[1.0, 0.0], [3.0, 0.0], [2.0, 0.0]]
+        finally:
+            await provider.close()
+    assert sorted(request["input"] for request in requests) == [["a", "abc"], ["ab"]]
+
+
+@pytest.mark.asyncio
+async def test_openai_provider_retries_server_errors():
+    async with stub_embeddings_server(failures=2) as (base_url, requests):
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url, max_retries=2)
+        try:
+            assert await provider.embed(["abcd"]) == [[4.0, 0.0]]
+        finally:
+            await provider.close()
+    assert len(requests) == 3
+    assert provider.stats()["errors"] == 0
+
+
+@pytest.mark.asyncio
+async def test_openai_provider_bounds_concurrency_and_times_out():
+    async with stub_embeddings_server(delay=0.2) as (base_url, _):
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url, max_concurrency=2)
+        try:
+            started = asyncio.get_running_loop().time()
+            await asyncio.gather(*(provider.embed(["a"]) for _ in range(4)))
+            # Two at a time, so two rounds of the stub's delay
+            assert asyncio.get_running_loop().time() - started >= 0.4
+        finally:
+            await provider.close()
+
+        # Including the requests one large batch is split into
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url, max_concurrency=2, request_size=1)
+        try:
+            started = asyncio.get_running_loop().time()
+            await provider.embed(["a", "b", "c", "d"])
+            assert asyncio.get_running_loop().time() - started >= 0.4
+            assert provider.stats()["calls"] == 4
+        finally:
+            await provider.close()
+
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url, timeout=0.05, max_retries=0)
+        try:
+            with pytest.raises(openai.APITimeoutError):
+                await provider.embed(["a"])
+        finally:
+            await provider.close()
+        assert provider.stats()["errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache(monkeypatch):
+    async with stub_embeddings_server(dimensions=1536) as (base_url, requests):
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url)
+        monkeypatch.setattr(embeddings, "_provider", provider)
+        try:
+            # Texts that only differ in whitespace share an embedding, and are only embedded once
+            first = await generate_embeddings(["hello  world", "hello world ", "other"])
+            assert [embedding[0] for embedding in first] == [11.0, 11.0, 5.0]
+            assert [request["input"] for request in requests] == [["hello world", "other"]]
+
+            # A new worker finds them in the embedding_cache table
+            embeddings._cached_embeddings.clear()
+            second = await generate_embeddings(["other", "hello world", "new"])
+            assert [embedding[0] for embedding in second] == [5.0, 11.0, 3.0]
+            assert [request["input"] for request in requests[1:]] == [["new"]]
+
+            # And then in memory
+            third = await generate_embeddings(["new", "other"])
+            assert [embedding[0] for embedding in third] == [3.0, 5.0]
+            assert len(requests) == 2
+        finally:
+            await provider.close()
+
+    stats = embeddings.embedding_stats()
+    assert stats["database_cache"]["hits"] >= 2
+    assert stats["cache"]["hits"] >= 2
+
+
+@pytest.mark.asyncio
+async def test_embedding_doesnt_hold_the_unit_of_work_connection(monkeypatch):
+    provider = LocalEmbeddingProvider(dimensions=1536, pool_size=0)
+    embed = provider.embed
+    held = []
+
+    async def embed_and_record(texts):
+        held.append(current_unit_of_work().conn)
+        return await embed(texts)
+
+    monkeypatch.setattr(provider, "embed", embed_and_record)
+    monkeypatch.setattr(embeddings, "_provider", provider)
+    async with UnitOfWork() as unit_of_work:
+        await generate_embeddings(["not cached yet"])
+        # The cache lookup and write-back ran on connections of their own
+        assert held == [None] and unit_of_work.conn is None
+
+    key = embeddings.embedding_cache_key(provider.model, "not cached yet")
+    assert key in await get_cached_embeddings([key])
+
+
+@pytest.mark.asyncio
+async def test_embedding_worker(monkeypatch):
+    inputs = ["first", "second", "third", "unembeddable", "   "]
+    tasks = [await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Task", text) for text in inputs]
+    assert {task["embedding_status"] for task in tasks} == {"PENDING"}
+
+    async with stub_embeddings_server(dimensions=1536, rejected=frozenset(["unembeddable"])) as (base_url, requests):
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url)
+        monkeypatch.setattr(embeddings, "_provider", provider)
+        try:
+            assert await embed_pending_tasks(batch_size=2) == 2
+            assert await embed_pending_tasks(batch_size=10) == 3
+            assert await embed_pending_tasks(batch_size=10) == 0
+        finally:
+            await provider.close()
+
+    # One call per batch, and a rejected batch is retried a task at a time to find the culprit
+    assert [request["input"] for request in requests] == [
+        ["first", "second"],
+        ["third", "unembeddable"],
+        ["third"],
+        ["unembeddable"],
+    ]
+
+    statuses = [(await get_task_by_uuid(task["uuid"], TEST_USER_ID))["embedding_status"] for task in tasks]
+    assert statuses == ["READY", "READY", "READY", "FAILED", "FAILED"]
+    stored = await get_embeddings_for_tasks([task["uuid"] for task in tasks], TEST_USER_ID, vectors=False)
+    assert [len(stored[task["uuid"]]) for task in tasks] == [1, 1, 1, 0, 0]
+
+
+@pytest.mark.asyncio
+async def test_embedding_worker_leases_tasks_without_holding_locks(monkeypatch):
+    task = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Task", "first")
+    during_embedding = []
+
+    async def unavailable(texts, cache=True):
+        # The claim is committed: other workers skip the task, and nothing locks its row
+        during_embedding.append(await embed_pending_tasks())
+        async with DB() as conn:
+            await conn.execute("SET lock_timeout = '1s'")
+            await conn.execute("UPDATE tasks SET name = 'Renamed' WHERE uuid = $1", task["uuid"])
+            await conn.execute("RESET lock_timeout")
+        raise RuntimeError("provider unavailable")
+
+    monkeypatch.setattr(embedding_worker, "generate_embeddings", unavailable)
+    with pytest.raises(RuntimeError):
+        await embed_pending_tasks()
+    assert during_embedding == [0]
+
+    # A failed batch releases its lease, so the task can be claimed again straight away
+    monkeypatch.setattr(embeddings, "_provider", LocalEmbeddingProvider(dimensions=1536, pool_size=0))
+    monkeypatch.setattr(embedding_worker, "generate_embeddings", generate_embeddings)
+    async with DB() as conn:
+        await conn.execute("UPDATE tasks SET embedding_claimed_at = now() WHERE uuid = $1", task["uuid"])
+        # A lease newer than EMBEDDING_LEASE_TIMEOUT is skipped, and an older one, whose worker died, is reclaimed
+        assert await embed_pending_tasks() == 0
+        await conn.execute(
+            "UPDATE tasks SET embedding_claimed_at = now() - interval '1 hour' WHERE uuid = $1", task["uuid"]
+        )
+        assert await embed_pending_tasks() == 1
+
+    assert (await get_task_by_uuid(task["uuid"], TEST_USER_ID))["embedding_status"] == "READY"
+
+
+@pytest.mark.asyncio
+async def test_embedding_worker_counts_only_the_tasks_it_still_leases(monkeypatch):
+    task = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Task", "first")
+    embed = generate_embeddings
+
+    async def slow(texts, cache=True):
+        # The lease expires meanwhile, and another worker claims the task
+        async with DB() as conn:
+            await conn.execute(
+                "UPDATE tasks SET embedding_claimed_at = now() + interval '1 second' WHERE id = $1", task["id"]
+            )
+        return await embed(texts, cache)
+
+    monkeypatch.setattr(embeddings, "_provider", LocalEmbeddingProvider(dimensions=1536, pool_size=0))
+    monkeypatch.setattr(embedding_worker, "generate_embeddings", slow)
+    stats = embedding_worker.embedding_worker_stats()
+    assert await embed_pending_tasks() == 1
+
+    assert embedding_worker.embedding_worker_stats()["embedded"] == stats["embedded"]
+    assert (await get_task_by_uuid(task["uuid"], TEST_USER_ID))["embedding_status"] == "PENDING"
+    assert (await get_embeddings_for_tasks([task["uuid"]], TEST_USER_ID, vectors=False))[task["uuid"]] == []
+
+
+def test_chunk_text():
+    # Overlapping chunks keep the text's whitespace, and the last one ends with the text
+    assert list(chunk_text("one two,  three\nfour five", 3, 1)) == ["one two,", ",  three\nfour", "four five"]
+    assert list(chunk_text("one two three", 3, 1)) == ["one two three"]
+    assert list(chunk_text(" \n ", 3)) == []
+
+    # Only the chunks asked for are made
+    assert next(chunk_text("word " * 1_000_000, 2)) == "word word"
+
+    # A long word is split, so it can't make a chunk longer than the model accepts
+    assert list(chunk_text("a" * 100, 2)) == ["a" * 32] * 3 + ["a" * 4]
+
+    # Nor can text taking a model token per character, which the character budget bounds, overlap included
+    chunks = list(chunk_text("日本語のテキスト。" * 1000, 512, 64, max_chars=2048))
+    assert all(len(chunk) <= 2048 for chunk in chunks) and len(chunks) == 5
+
+    assert halve("one two three four") == ("one two", "three four")
+    assert halve("a" * 40) == ("a" * 16, "a" * 24)
+    assert halve("one") is None
+
+    with pytest.raises(ValueError):
+        list(chunk_text("one two", 2, 2))
+
+
+@pytest.mark.asyncio
+async def test_embedding_worker_chunks_long_inputs(monkeypatch):
+    monkeypatch.setattr(embedding_worker, "EMBEDDING_CHUNK_TOKENS", 4)
+    monkeypatch.setattr(embedding_worker, "EMBEDDING_CHUNK_OVERLAP", 1)
+    monkeypatch.setattr(embedding_worker, "EMBEDDING_MAX_CHUNKS", 2)
+    inputs = ["a bb ccc dddd eeeee ffffff ggggggg hhhhhhhh", "short"]
+    tasks = [await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Task", text) for text in inputs]
+    stats = embedding_worker.embedding_worker_stats()
+
+    async with stub_embeddings_server(dimensions=1536) as (base_url, requests):
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url)
+        monkeypatch.setattr(embeddings, "_provider", provider)
+        try:
+            assert await embed_pending_tasks(batch_size=10) == 2
+        finally:
+            await provider.close()
+
+    # Every chunk of the batch in one call, stopping at EMBEDDING_MAX_CHUNKS
+    assert [request["input"] for request in requests] == [["a bb ccc dddd", "dddd eeeee ffffff ggggggg", "short"]]
+    assert embedding_worker.embedding_worker_stats()["truncated"] == stats["truncated"] + 1
+    stored = await get_embeddings_for_tasks([task["uuid"] for task in tasks], TEST_USER_ID)
+    lengths = [[as_array(row["embedding"])[0] for row in stored[task["uuid"]]] for task in tasks]
+    assert lengths == [[13.0, 25.0], [5.0]]
+
+    # The chunks are stored with their tasks, so they don't take up room in the embedding caches
+    keys = [embeddings.embedding_cache_key(provider.model, chunk) for chunk in requests[0]["input"]]
+    assert await get_cached_embeddings(keys) == {}
+    assert all(embeddings._cached_embeddings.get(key) is None for key in keys)
+
+
+@pytest.mark.asyncio
+async def test_embedding_worker_splits_chunks_the_provider_rejects(monkeypatch):
+    # Chinese or Japanese text takes about a model token per character, so a chunk within EMBEDDING_CHUNK_CHARS can
+    # still be too long for the model
+    monkeypatch.setattr(embedding_worker, "EMBEDDING_CHUNK_CHARS", 20)
+    inputs = ["日本語のテキスト。" * 5, "ascii"]
+    tasks = [await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Task", text) for text in inputs]
+
+    async with stub_embeddings_server(dimensions=1536, max_chars=8) as (base_url, requests):
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url)
+        monkeypatch.setattr(embeddings, "_provider", provider)
+        try:
+            assert await embed_pending_tasks(batch_size=10) == 2
+        finally:
+            await provider.close()
+
+    assert [len(text) for text in requests[0]["input"]] == [18, 19, 10, 5]
+    # The rejected chunks are halved until the provider accepts them, instead of failing the task
+    statuses = [(await get_task_by_uuid(task["uuid"], TEST_USER_ID))["embedding_status"] for task in tasks]
+    assert statuses == ["READY", "READY"]
+    stored = await get_embeddings_for_tasks([task["uuid"] for task in tasks], TEST_USER_ID)
+    lengths = [[as_array(row["embedding"])[0] for row in stored[task["uuid"]]] for task in tasks]
+    assert lengths == [[8.0, 1.0, 8.0, 1.0, 1.0, 8.0, 1.0, 8.0, 1.0, 1.0, 8.0, 1.0], [5.0]]
+
+
+@pytest.mark.asyncio
+async def test_long_queries_are_embedded_by_their_first_chunk(monkeypatch):
+    assert query_chunk("Write a blog post about the news") == "Write a blog post about the news"
+    assert query_chunk(" \n ") == " \n "
+
+    query = "日本語のテキスト。" * 1000
+    async with stub_embeddings_server(dimensions=1536, max_chars=embedding_worker.EMBEDDING_CHUNK_CHARS) as (
+        base_url,
+        requests,
+    ):
+        provider = OpenAIEmbeddingProvider("stub", base_url=base_url)
+        monkeypatch.setattr(embeddings, "_provider", provider)
+        try:
+            embedding = await generate_embedding(query_chunk(query))
+        finally:
+            await provider.close()
+
+    assert [len(request["input"][0]) for request in requests] == [2043]
+    assert embedding[0] == 2043.0
+
+
+def test_local_embeddings():
+    texts = ["Write a blog post about the news", "Write a blog post about today's news", "Fix the migration", "!"]
+    embedded = embed_texts(texts, 256)
+    assert embedded.shape == (4, 256) and embedded.dtype == np.float32
+    assert np.allclose(np.linalg.norm(embedded, axis=1), 1)
+    assert np.array_equal(embedded, embed_texts(texts, 256))
+
+    similarity = embedded @ embedded.T
+    assert similarity[0, 1] > 0.5 > similarity[0, 2]
+
+
+@pytest.mark.asyncio
+async def test_local_provider_spreads_large_batches_over_processes():
+    texts = [f"task number {i}" for i in range(5)]
+    # Chunks of two texts, of 13 characters each
+    provider = LocalEmbeddingProvider(dimensions=32, pool_size=2, chunk_chars=30)
+    try:
+        assert np.array_equal(await provider.embed(texts), embed_texts(texts, 32))
+    finally:
+        await provider.close()
+
+
+def test_local_provider_chunks_by_characters():
+    # A batch is as slow to embed as it is long, however many texts it has
+    assert _chunks_by_characters(["aaaa", "bb", "cc", "d"], 4) == [["aaaa"], ["bb", "cc"], ["d"]]
+    assert _chunks_by_characters(["a" * 10, "b"], 4) == [["a" * 10], ["b"]]
+    assert _chunks_by_characters([], 4) == [[]]
@@ -0,0 +1,138 @@
+import asyncio
+from uuid import UUID, uuid4
+
+import numpy as np
+import pytest
+from conftest import eventually
+
+from aeris import project_index
+from aeris.data.project import create_project
+from aeris.data.task import create_task, delete_task, update_task
+from aeris.db import DB
+from aeris.env import env
+from aeris.local_embeddings import embed_texts
+from aeris.project_index import ProjectIndex, search_project_index, stop_project_index
+from aeris.vector_index import EMBEDDING_DIMENSIONS
+
+env()
+
+TEST_PROJECT_UUID = "36e8705e-6604-4e44-b58f-4e8c347a9f31"
+TEST_USER_ID = 1
+OTHER_USER_ID = 2
+
+
+def test_project_index_search_is_exact():
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(300, EMBEDDING_DIMENSIONS)).astype(np.float32)
+    # Three embeddings per task, added in two parts
+    task_ids = np.repeat(np.arange(100), 3)
+    index = ProjectIndex(uuid4(), 1, task_ids[:200], vectors[:200])
+    index.add(task_ids[200:], vectors[200:])
+    index.remove(7)
+
+    query = vectors[21] + rng.normal(scale=0.1, size=EMBEDDING_DIMENSIONS).astype(np.float32)
+    # Each task's nearest embedding by l2, the default VECTOR_METRIC
+    distances = np.linalg.norm(vectors - query, axis=1)
+    nearest = {task_id: distances[task_ids == task_id].min() for task_id in range(100) if task_id != 7}
+    expected = sorted(nearest.items(), key=lambda item: item[1])[:10]
+
+    found = index.search(query, 10, np.inf)
+    assert [task_id for task_id, _ in found] == [task_id for task_id, _ in expected]
+    assert [distance for _, distance in found] == pytest.approx([distance for _, distance in expected], rel=1e-4)
+    assert index.search(query, 10, expected[2][1] + 1e-3) == found[:3]
+
+
+@pytest.mark.asyncio
+async def test_project_index_follows_task_changes(monkeypatch):
+    monkeypatch.setattr(project_index, "PROJECT_INDEX_ENABLED", True)
+    first, second = embed_texts(["Rotate the API signing keys", "Summarize the sales report"], EMBEDDING_DIMENSIONS)
+    task = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Rotate keys", "Rotate the API signing keys", first)
+    await update_task(task["uuid"], TEST_USER_ID, state="SUCCESS")
+
+    async def search(embedding, user_id=TEST_USER_ID):
+        (found,) = await search_project_index(TEST_PROJECT_UUID, [embedding], user_id, 5, 0.5)
+        return [similar["uuid"] for similar in found]
+
+    loads = project_index.project_index_stats()["loads"]
+    try:
+        (found,) = await search_project_index(TEST_PROJECT_UUID, [first], TEST_USER_ID, 5, 0.5)
+        assert [similar["uuid"] for similar in found] == [task["uuid"]]
+        assert found[0]["similarity_score"] == pytest.approx(0, abs=1e-3)
+        assert await search(first, OTHER_USER_ID) == []
+
+        # Embedded, then finished
+        other = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Sales", "Summarize the sales report", second)
+        assert await search(second) == []
+        await update_task(other["uuid"], TEST_USER_ID, state="FAILURE")
+        assert await eventually(lambda: search(second)) == [other["uuid"]]
+
+        # No longer finished, then deleted
+        await update_task(task["uuid"], TEST_USER_ID, state="RUNNING")
+        assert await eventually(lambda: search(first)) == []
+        await delete_task(other["uuid"], TEST_USER_ID)
+        assert await eventually(lambda: search(second)) == []
+
+        # Loaded by the first search and kept up to date since
+        stats = project_index.project_index_stats()
+        assert (stats["projects"], stats["loads"]) == (1, loads + 1)
+    finally:
+        await stop_project_index()
+
+
+@pytest.mark.asyncio
+async def test_project_index_evicts_the_least_recently_searched(monkeypatch):
+    monkeypatch.setattr(project_index, "PROJECT_INDEX_ENABLED", True)
+    # Room for one embedding, so for one of the projects
+    monkeypatch.setattr(project_index, "PROJECT_INDEX_MEMORY_MB", 1.5 * EMBEDDING_DIMENSIONS * 4 / 2**20)
+    embedding = embed_texts(["Rotate the API signing keys"], EMBEDDING_DIMENSIONS)[0]
+    projects = [(await create_project(TEST_USER_ID, name))["uuid"] for name in ("First", "Second")]
+    for project_uuid in projects:
+        task = await create_task(project_uuid, TEST_USER_ID, "Rotate keys", "Rotate the API signing keys", embedding)
+        await update_task(task["uuid"], TEST_USER_ID, state="SUCCESS")
+
+    async def search(project_uuid, user_id=TEST_USER_ID):
+        return await search_project_index(project_uuid, [embedding], user_id, 5, 0.5)
+
+    stats = project_index.project_index_stats()
+    loads, evictions = stats["loads"], stats["evictions"]
+    try:
+        # Someone else's project isn't loaded for them
+        assert await search(projects[0], OTHER_USER_ID) is None
+        assert project_index.project_index_stats()["loads"] == loads
+
+        # The second project's load evicts the first, which is loaded again when searched next, evicting the second
+        for project_uuid, loaded in [(projects[0], 1), (projects[1], 2), (projects[1], 2), (projects[0], 3)]:
+            (found,) = await search(project_uuid)
+            assert len(found) == 1
+            stats = project_index.project_index_stats()
+            assert (stats["projects"], stats["loads"], stats["evictions"]) == (1, loads + loaded, evictions + loaded - 1)
+        assert list(project_index._project_ids) == [UUID(str(projects[0]))]
+        assert project_index._load_locks == {}
+    finally:
+        await stop_project_index()
+
+
+@pytest.mark.asyncio
+async def test_task_vectors_changed_notifies_once_per_statement():
+    tasks = [await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Task", text) for text in ("first", "second")]
+    task_uuids = [task["uuid"] for task in tasks]
+    notifications: asyncio.Queue[str] = asyncio.Queue()
+
+    def notified(connection, pid, channel, payload):
+        notifications.put_nowait(payload)
+
+    async with DB() as conn:
+        await conn.add_listener("task_vectors_changed", notified)
+        try:
+            # Tasks that haven't finished, or are still finished, aren't mentioned
+            await conn.execute("UPDATE tasks SET state = 'RUNNING' WHERE uuid = ANY($1::uuid[])", task_uuids)
+            await conn.execute("UPDATE tasks SET state = 'SUCCESS' WHERE uuid = ANY($1::uuid[])", task_uuids)
+            await conn.execute("UPDATE tasks SET state = 'FAILURE' WHERE uuid = ANY($1::uuid[])", task_uuids)
+            payload = await asyncio.wait_for(notifications.get(), 5)
+            await asyncio.sleep(0.1)
+        finally:
+            await conn.remove_listener("task_vectors_changed", notified)
+
+    task_ids = sorted(task["id"] for task in tasks)
+    assert payload == ",".join(f"{task_id}:{TEST_PROJECT_UUID}" for task_id in task_ids)
+    assert notifications.empty()
@@ -59,3 +59,25 @@ async def test_create_project():
         project = await conn.fetchrow("SELECT * FROM projects WHERE name = $1", "New Project")
         assert project is not None
         assert project["name"] == "New Project"
+
+
+@pytest.mark.asyncio
+async def test_failed_operation_rolls_back_writes():
+    query = """
+    mutation {
+        createProject(name: "Rolled Back Project") {
+            id
+        }
+        updateProject(id: "00000000-0000-0000-0000-000000000000", name: "Missing") {
+            id
+        }
+    }
+    """
+    headers = {"Authorization": "Bearer TEST"}
+    async with httpx.AsyncClient() as client:
+        response = await client.post(GRAPHQL_URL, json={"query": query}, headers=headers)
+        assert "errors" in response.json()
+
+    async with DB() as conn:
+        project = await conn.fetchrow("SELECT * FROM projects WHERE name = $1", "Rolled Back Project")
+        assert project is None
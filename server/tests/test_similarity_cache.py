@@ -0,0 +1,66 @@
+import asyncio
+from uuid import UUID
+
+import numpy as np
+import pytest
+from conftest import eventually
+
+from aeris import similarity_cache
+from aeris.data.task import LARGE_TASK_COLUMNS, create_task, find_similar_tasks, update_task
+from aeris.env import env
+from aeris.local_embeddings import embed_texts
+from aeris.similarity_cache import SearchScope, cached_search, similarity_cache_stats, stop_similarity_cache
+from aeris.vector_index import EMBEDDING_DIMENSIONS
+
+env()
+
+TEST_PROJECT_UUID = "36e8705e-6604-4e44-b58f-4e8c347a9f31"
+TEST_USER_ID = 1
+OTHER_USER_ID = 2
+
+
+@pytest.mark.asyncio
+async def test_similarity_cache():
+    (embedding,) = embed_texts(["Rotate the API signing keys"], EMBEDDING_DIMENSIONS)
+    task = await create_task(TEST_PROJECT_UUID, TEST_USER_ID, "Rotate keys", "Rotate the API signing keys", embedding)
+    searches = []
+
+    async def search(embeddings):
+        searches.append(len(embeddings))
+        return [await find_similar_tasks(embedding, TEST_USER_ID, 5, 0.5, TEST_PROJECT_UUID) for embedding in embeddings]
+
+    scope = SearchScope(UUID(TEST_PROJECT_UUID), TEST_USER_ID, 5, 0.5, LARGE_TASK_COLUMNS)
+    near = embedding + np.float32(0.0002)
+    hits = similarity_cache_stats()["hits"]
+    try:
+        assert await cached_search(scope, [embedding], search) == [[]]
+        # The same embedding, one close to it, and another user's search
+        assert await cached_search(scope, [embedding, near], search) == [[], []]
+        assert await cached_search(SearchScope(None, OTHER_USER_ID, 5, 0.5, LARGE_TASK_COLUMNS), [near], search) == [[]]
+        assert searches == [1, 1]
+        assert similarity_cache_stats()["hits"] == hits + 2
+
+        # Starting a task changes nothing searches can see, so the entries stay
+        invalidations = similarity_cache_stats()["invalidations"]
+        await update_task(task["uuid"], TEST_USER_ID, state="RUNNING")
+        await asyncio.sleep(0.2)
+        assert await cached_search(scope, [embedding], search) == [[]]
+        assert searches == [1, 1]
+        assert similarity_cache_stats()["invalidations"] == invalidations
+
+        # Finishing a task in the project makes it findable
+        await update_task(task["uuid"], TEST_USER_ID, state="SUCCESS")
+        (found,) = await eventually(lambda: cached_search(scope, [embedding], search))
+        assert [similar["uuid"] for similar in found] == [task["uuid"]]
+
+        # Entries keep the tasks' ids and scores, and a hit reads the tasks again
+        searched = len(searches)
+        await update_task(task["uuid"], TEST_USER_ID, name="Rotate the keys")
+        ((cached,),) = await cached_search(scope, [embedding], search)
+        assert len(searches) == searched
+        assert (cached["name"], cached["similarity_score"]) == ("Rotate the keys", found[0]["similarity_score"])
+        assert [entry.results for entry in similarity_cache._entries.values()][-1] == [
+            (task["id"], {"similarity_score": found[0]["similarity_score"]})
+        ]
+    finally:
+        await stop_similarity_cache()
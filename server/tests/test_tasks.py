@@ -1,9 +1,13 @@
+import base64
 import os
 
 import httpx
 import pytest
 
+from aeris.embeddings import LocalEmbeddingProvider
 from aeris.env import env
+from aeris.local_embeddings import embed_texts
+from aeris.vector_index import EMBEDDING_DIMENSIONS
 
 env()
 port = os.environ.get("PORT", 8001)
@@ -108,3 +112,259 @@ async def test_find_similar_tasks():
         assert data["data"]["findSimilarTasks"][0]["task"]["name"] == "Test Task"
         assert data["data"]["findSimilarTasks"][0]["task"]["id"] == "123e4567-e89b-12d3-a456-426614174000"
         assert data["data"]["findSimilarTasks"][0]["similarity"] < 0.5
+
+
+@pytest.mark.asyncio
+async def test_log_event():
+    mutation = """
+    mutation {
+      logEvent(taskId: "123e4567-e89b-12d3-a456-426614174000", eventType: "TOOL_CALL", eventData: {tool: "search", args: ["news"]}) {
+        id
+        eventType
+        eventData
+      }
+    }
+    """
+    query = """
+    query {
+      task(id: "123e4567-e89b-12d3-a456-426614174000") {
+        events {
+          edges {
+            node {
+              eventType
+              eventData
+            }
+          }
+        }
+      }
+    }
+    """
+    headers = {"Authorization": "Bearer TEST"}
+    async with httpx.AsyncClient() as client:
+        response = await client.post(GRAPHQL_URL, json={"query": mutation}, headers=headers)
+        assert response.status_code == 200
+
+        data = response.json()
+        assert data["data"]["logEvent"]["eventType"] == "TOOL_CALL"
+        assert data["data"]["logEvent"]["eventData"] == {"tool": "search", "args": ["news"]}
+
+        response = await client.post(GRAPHQL_URL, json={"query": query}, headers=headers)
+        assert response.status_code == 200
+
+        events = [edge["node"] for edge in response.json()["data"]["task"]["events"]["edges"]]
+        assert events == [{"eventType": "TOOL_CALL", "eventData": {"tool": "search", "args": ["news"]}}]
+
+
+@pytest.mark.asyncio
+async def test_paginate_events():
+    mutation = """
+    mutation($eventType: String!) {
+      logEvent(taskId: "123e4567-e89b-12d3-a456-426614174000", eventType: $eventType, eventData: {}) {
+        id
+      }
+    }
+    """
+    query = """
+    query($pagination: PaginationInput) {
+      task(id: "123e4567-e89b-12d3-a456-426614174000") {
+        events(pagination: $pagination) {
+          edges {
+            cursor
+            node {
+              eventType
+            }
+          }
+          pageInfo {
+            hasNextPage
+            hasPreviousPage
+            startCursor
+            endCursor
+          }
+        }
+      }
+    }
+    """
+    headers = {"Authorization": "Bearer TEST"}
+    async with httpx.AsyncClient() as client:
+
+        async def page(**pagination):
+            response = await client.post(
+                GRAPHQL_URL, json={"query": query, "variables": {"pagination": pagination}}, headers=headers
+            )
+            assert response.status_code == 200
+            events = response.json()["data"]["task"]["events"]
+            return [edge["node"]["eventType"] for edge in events["edges"]], events["pageInfo"]
+
+        for event_type in ("FIRST", "SECOND", "THIRD"):
+            response = await client.post(
+                GRAPHQL_URL, json={"query": mutation, "variables": {"eventType": event_type}}, headers=headers
+            )
+            assert response.status_code == 200
+
+        events, page_info = await page(first=2)
+        assert events == ["FIRST", "SECOND"]
+        assert page_info["hasNextPage"] and not page_info["hasPreviousPage"]
+
+        events, page_info = await page(first=2, after=page_info["endCursor"])
+        assert events == ["THIRD"]
+        assert not page_info["hasNextPage"] and page_info["hasPreviousPage"]
+
+        events, page_info = await page(last=2)
+        assert events == ["SECOND", "THIRD"]
+        assert page_info["hasPreviousPage"] and not page_info["hasNextPage"]
+
+        events, page_info = await page(last=2, before=page_info["startCursor"])
+        assert events == ["FIRST"]
+        assert not page_info["hasPreviousPage"] and page_info["hasNextPage"]
+
+
+@pytest.mark.asyncio
+async def test_filter_tasks_and_events():
+    tasks_query = """
+    query($filters: TaskFilters) {
+      tasks(projectId: "36e8705e-6604-4e44-b58f-4e8c347a9f31", filters: $filters) {
+        edges {
+          node {
+            name
+          }
+        }
+      }
+    }
+    """
+    events_query = """
+    query($filters: EventFilters) {
+      task(id: "123e4567-e89b-12d3-a456-426614174000") {
+        events(filters: $filters) {
+          edges {
+            node {
+              eventType
+            }
+          }
+        }
+      }
+    }
+    """
+    mutation = """
+    mutation($eventType: String!) {
+      logEvent(taskId: "123e4567-e89b-12d3-a456-426614174000", eventType: $eventType, eventData: {}) {
+        id
+      }
+    }
+    """
+    headers = {"Authorization": "Bearer TEST"}
+    async with httpx.AsyncClient() as client:
+
+        async def tasks(**filters):
+            response = await client.post(
+                GRAPHQL_URL, json={"query": tasks_query, "variables": {"filters": filters}}, headers=headers
+            )
+            assert response.status_code == 200
+            return [edge["node"]["name"] for edge in response.json()["data"]["tasks"]["edges"]]
+
+        async def events(**filters):
+            response = await client.post(
+                GRAPHQL_URL, json={"query": events_query, "variables": {"filters": filters}}, headers=headers
+            )
+            assert response.status_code == 200
+            return [edge["node"]["eventType"] for edge in response.json()["data"]["task"]["events"]["edges"]]
+
+        assert await tasks(state="PENDING", nameContains="test") == ["Test Task"]
+        assert await tasks(state="SUCCESS") == []
+        assert await tasks(nameContains="%") == []
+        assert await tasks(createdAfter="2000-01-01T00:00:00Z", createdBefore="2100-01-01") == ["Test Task"]
+        assert await tasks(createdAfter="2100-01-01") == []
+
+        for event_type in ("TOOL_CALL", "OUTPUT", "TOOL_CALL"):
+            response = await client.post(
+                GRAPHQL_URL, json={"query": mutation, "variables": {"eventType": event_type}}, headers=headers
+            )
+            assert response.status_code == 200
+
+        assert await events(eventType="TOOL_CALL") == ["TOOL_CALL", "TOOL_CALL"]
+        assert await events(eventType="OUTPUT", createdAfter="2000-01-01") == ["OUTPUT"]
+        assert await events(createdBefore="2000-01-01") == []
+
+
+@pytest.mark.asyncio
+async def test_client_supplied_embeddings():
+    # The tests' server embeds locally, see conftest.py
+    model = LocalEmbeddingProvider(pool_size=0).model
+    (embedding,) = embed_texts(["Summarize the quarterly report"], EMBEDDING_DIMENSIONS)
+    create = """
+    mutation($embedding: String, $model: String) {
+      createTask(projectId: "36e8705e-6604-4e44-b58f-4e8c347a9f31", name: "Report", input: "Summarize the quarterly report",
+                 embeddingBase64: $embedding, embeddingModel: $model) {
+        id
+        embeddingStatus
+      }
+    }
+    """
+    search = """
+    query($embedding: [Float!], $model: String) {
+      findSimilarTasks(embedding: $embedding, embeddingModel: $model, k: 1) {
+        similarity
+        task {
+          id
+        }
+      }
+    }
+    """
+    headers = {"Authorization": "Bearer TEST"}
+    async with httpx.AsyncClient() as client:
+
+        async def post(query, **variables):
+            response = await client.post(GRAPHQL_URL, json={"query": query, "variables": variables}, headers=headers)
+            return response.json()
+
+        packed = base64.b64encode(embedding.astype("<f4").tobytes()).decode()
+        task = (await post(create, embedding=packed, model=model))["data"]["createTask"]
+        assert task["embeddingStatus"] == "READY"
+
+        await post(f'mutation {{ updateTask(id: "{task["id"]}", state: SUCCESS) {{ id }} }}')
+        (similar,) = (await post(search, embedding=embedding.tolist(), model=model))["data"]["findSimilarTasks"]
+        assert similar["task"]["id"] == task["id"] and similar["similarity"] < 1e-6
+
+        # Embeddings from another model, or of another size, can't be compared with the stored ones
+        assert "errors" in await post(search, embedding=embedding.tolist(), model="text-embedding-ada-002")
+        assert "errors" in await post(search, embedding=[0.1, 0.2], model=model)
+        assert "errors" in await post(create, embedding="not base64!", model=model)
+
+
+@pytest.mark.asyncio
+async def test_find_similar_tasks_batch():
+    model = LocalEmbeddingProvider(pool_size=0).model
+    inputs = ["Summarize the quarterly report", "Book a flight to Lisbon"]
+    create = """
+    mutation($input: String!, $embedding: [Float!], $model: String) {
+      createTask(projectId: "36e8705e-6604-4e44-b58f-4e8c347a9f31", name: "Task", input: $input,
+                 embedding: $embedding, embeddingModel: $model) {
+        id
+      }
+    }
+    """
+    search = """
+    query($inputs: [String!]) {
+      findSimilarTasksBatch(inputs: $inputs, k: 1) {
+        similarity
+        task {
+          id
+          input
+        }
+      }
+    }
+    """
+    headers = {"Authorization": "Bearer TEST"}
+    async with httpx.AsyncClient() as client:
+
+        async def post(query, **variables):
+            response = await client.post(GRAPHQL_URL, json={"query": query, "variables": variables}, headers=headers)
+            return response.json()
+
+        for text, embedding in zip(inputs, embed_texts(inputs, EMBEDDING_DIMENSIONS), strict=True):
+            task = (await post(create, input=text, embedding=embedding.tolist(), model=model))["data"]["createTask"]
+            await post(f'mutation {{ updateTask(id: "{task["id"]}", state: SUCCESS) {{ id }} }}')
+
+        results = (await post(search, inputs=[*reversed(inputs), "zzz"]))["data"]["findSimilarTasksBatch"]
+        assert [[similar["task"]["input"] for similar in query] for query in results] == [[inputs[1]], [inputs[0]], []]
+
+        assert "errors" in await post(search, inputs=[])
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+from aeris.db import DB
+from aeris.env import env
+from aeris.vector_index import (
+    EMBEDDING_DIMENSIONS,
+    METRIC,
+    QUANTIZED_OVERFETCH,
+    _indexed,
+    candidate_count,
+    create_vector_index,
+    distance,
+    search_order,
+    vector_index_profile,
+)
+
+env()
+
+TABLE = "test_quantized_embeddings"
+INDEX = "test_quantized_embeddings_idx"
+
+
+def test_quantized_index_sql():
+    dimensions = EMBEDDING_DIMENSIONS
+    assert _indexed("none") == ("embedding", METRIC.opclass)
+    assert _indexed("halfvec") == (
+        f"(embedding::halfvec({dimensions}))",
+        METRIC.opclass.replace("vector_", "halfvec_"),
+    )
+    assert _indexed("binary") == (f"(binary_quantize(embedding)::bit({dimensions}))", "bit_hamming_ops")
+
+    assert search_order("$1", "none") == f"embedding {METRIC.operator} $1"
+    assert search_order("$1", "halfvec") == f"embedding::halfvec({dimensions}) {METRIC.operator} $1::halfvec({dimensions})"
+    assert search_order("$1", "binary") == f"binary_quantize(embedding)::bit({dimensions}) <~> binary_quantize($1)"
+    # The index can only serve an ORDER BY on the expression it indexed
+    for quantization in ("none", "halfvec", "binary"):
+        expression, _ = _indexed(quantization)
+        assert search_order("$1", quantization).startswith(expression.strip("()"))
+
+    assert candidate_count(10, "none") == 10
+    assert candidate_count(10, "halfvec") == candidate_count(10, "binary") == 10 * QUANTIZED_OVERFETCH
+    assert len({vector_index_profile(quantization) for quantization in ("none", "halfvec", "binary")}) == 3
+
+
+@pytest.mark.asyncio
+async def test_quantized_index_search():
+    async with DB() as conn:
+        version = await conn.fetchval("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        if tuple(int(part) for part in version.split(".")[:2]) < (0, 7):
+            pytest.skip(f"Quantized indexes need pgvector 0.7 or later, not {version}")
+
+        rng = np.random.default_rng(0)
+        embeddings = rng.normal(size=(200, EMBEDDING_DIMENSIONS)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
+        await conn.execute(f"CREATE TABLE {TABLE} (id SERIAL PRIMARY KEY, embedding VECTOR({EMBEDDING_DIMENSIONS}))")
+        try:
+            await conn.copy_records_to_table(TABLE, records=[(e,) for e in embeddings], columns=["embedding"])
+            for quantization in ("halfvec", "binary"):
+                await create_vector_index(conn, TABLE, INDEX, quantization)
+                sql = f"""
+                    SELECT id FROM (
+                        SELECT id, {distance("$1")} AS distance FROM {TABLE}
+                        ORDER BY {search_order("$1", quantization)} LIMIT $2
+                    ) candidates
+                    ORDER BY distance
+                    LIMIT 1
+                """
+                async with conn.transaction():
+                    await conn.execute("SET LOCAL enable_seqscan = off")
+                    plan = "\n".join(row[0] for row in await conn.fetch(f"EXPLAIN {sql}", embeddings[7], 40))
+                    assert f"Index Scan using {INDEX}" in plan, plan
+                    # Re-ranking by full-precision distance finds the stored embedding itself
+                    assert await conn.fetchval(sql, embeddings[7], candidate_count(10, quantization)) == 8
+        finally:
+            await conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
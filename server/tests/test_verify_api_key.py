@@ -1,11 +1,15 @@
+import asyncio
 import os
 
 import httpx
 import pytest
 from bcrypt import gensalt, hashpw
 
-from aeris.db import DB
+from aeris import hashing, main
+from aeris.api_key import create_api_key, format_api_key, parse_api_key
+from aeris.db import DB, current_unit_of_work
 from aeris.env import env
+from aeris.hashing import HashingBusyError, check_secret, hash_secret, hashing_stats
 
 env()
 port = os.environ.get("PORT", 8001)
@@ -111,3 +115,147 @@ async def test_api_key_expired():
         data = response.json()
         assert "errors" in data
         assert data["errors"][0]["message"] == "Authentication failed: Invalid API key"
+
+
+@pytest.mark.asyncio
+async def test_api_key_indexed_format():
+    api_key = await create_api_key(1, 1)
+    assert parse_api_key(api_key) is not None
+
+    query = """
+    query {
+        projects {
+            id
+            name
+        }
+    }
+    """
+    async with httpx.AsyncClient() as client:
+        response = await client.post(GRAPHQL_URL, json={"query": query}, headers={"Authorization": f"Bearer {api_key}"})
+        assert response.status_code == 200
+        assert response.json()["data"]["projects"][0]["name"] == "Test Project"
+
+        key_id, _ = parse_api_key(api_key)
+        forged_key = format_api_key(key_id, "not-the-secret")
+        response = await client.post(GRAPHQL_URL, json={"query": query}, headers={"Authorization": f"Bearer {forged_key}"})
+        assert response.status_code == 401
+        assert response.json()["errors"][0]["message"] == "Authentication failed: Invalid API key"
+
+
+@pytest.mark.asyncio
+async def test_api_key_revoked_while_cached():
+    api_key = await create_api_key(1, 1)
+    key_id, _ = parse_api_key(api_key)
+
+    query = """
+    query {
+        projects {
+            id
+        }
+    }
+    """
+    headers = {"Authorization": f"Bearer {api_key}"}
+    async with httpx.AsyncClient() as client:
+        # The first request verifies and caches the key, the second is served from the cache
+        for _ in range(2):
+            response = await client.post(GRAPHQL_URL, json={"query": query}, headers=headers)
+            assert response.status_code == 200
+
+        async with DB() as conn:
+            await conn.execute("UPDATE api_keys SET active = false WHERE key_id = $1", key_id)
+
+        # Revocations are delivered asynchronously through LISTEN/NOTIFY
+        for _ in range(20):
+            response = await client.post(GRAPHQL_URL, json={"query": query}, headers=headers)
+            if response.status_code == 401:
+                break
+            await asyncio.sleep(0.05)
+
+        assert response.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_hashing_runs_on_a_bounded_pool(monkeypatch):
+    monkeypatch.setattr(hashing, "_slots", asyncio.Semaphore(2))
+    hashed = await hash_secret("secret", gensalt(4))
+    completed = hashing_stats()["completed"]
+
+    checks = [asyncio.create_task(check_secret("secret" if i % 2 else "wrong", hashed)) for i in range(6)]
+    running = []
+    while not all(check.done() for check in checks):
+        running.append(hashing_stats()["running"])
+        await asyncio.sleep(0)
+
+    assert [check.result() for check in checks] == [False, True] * 3
+    assert max(running) <= 2
+    stats = hashing_stats()
+    assert stats["completed"] == completed + 6
+    assert (stats["queue_depth"], stats["running"]) == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_hashing_rejects_beyond_the_queue(monkeypatch):
+    slots = asyncio.Semaphore(1)
+    monkeypatch.setattr(hashing, "_slots", slots)
+    monkeypatch.setattr(hashing, "HASH_MAX_QUEUE", 1)
+    hashed = await hash_secret("secret", gensalt(4))
+    rejected = hashing_stats()["rejected"]
+
+    # With the only thread taken, one check waits and the next is turned away
+    await slots.acquire()
+    queued = asyncio.create_task(check_secret("secret", hashed))
+    await asyncio.sleep(0)
+    assert hashing_stats()["queue_depth"] == 1
+    with pytest.raises(HashingBusyError):
+        await check_secret("secret", hashed)
+    assert hashing_stats()["rejected"] == rejected + 1
+
+    slots.release()
+    assert await queued
+
+
+@pytest.mark.asyncio
+async def test_hashing_busy_is_a_503(monkeypatch):
+    async def busy(api_key):
+        raise HashingBusyError()
+
+    monkeypatch.setattr(main, "verify_api_key", busy)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://aeris") as client:
+        response = await client.post("/graphql", json={"query": "{ projects { id } }"}, headers={"Authorization": "Bearer TEST"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(hashing.HASH_RETRY_AFTER)
+    assert response.json()["errors"][0]["extensions"]["code"] == "SERVICE_UNAVAILABLE"
+
+
+@pytest.mark.asyncio
+async def test_authentication_runs_outside_the_unit_of_work(monkeypatch):
+    units = []
+
+    async def verify(api_key):
+        # A key check can wait on the hash pool, which mustn't hold the operation's connection
+        units.append(current_unit_of_work())
+        raise ValueError("Invalid API key")
+
+    monkeypatch.setattr(main, "verify_api_key", verify)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://aeris") as client:
+        response = await client.post("/graphql", json={"query": "{ projects { id } }"}, headers={"Authorization": "Bearer TEST"})
+
+    assert response.status_code == 401
+    assert units == [None]
+
+
+@pytest.mark.asyncio
+async def test_metrics_need_the_metrics_token(monkeypatch):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://aeris") as client:
+        monkeypatch.setattr(main, "METRICS_TOKEN", "")
+        assert (await client.get("/metrics", headers={"Authorization": "Bearer TEST"})).status_code == 404
+
+        monkeypatch.setattr(main, "METRICS_TOKEN", "scraper")
+        assert (await client.get("/metrics")).status_code == 401
+        assert (await client.get("/metrics", headers={"Authorization": "Bearer TEST"})).status_code == 401
+        response = await client.get("/metrics", headers={"Authorization": "Bearer scraper"})
+        assert response.status_code == 200 and "statements" in response.json()